@@ -1,29 +1,13 @@
 #!/usr/bin/env python3
 from olctools.accessoryFunctions.accessoryFunctions import MetadataObject, GenObject, make_path, SetupLogging
-from genemethods.typingclasses.typingclasses import GDCS, Resistance, Prophages, Serotype, Univec, Verotoxin, Virulence
-from genemethods.assemblypipeline.legacy_vtyper import Vtyper as LegacyVtyper
-import olctools.accessoryFunctions.metadataprinter as metadataprinter
-from genemethods.sixteenS.sixteens_full import SixteenS as SixteensFull
-import genemethods.assemblypipeline.assembly_evaluation as evaluate
-import genemethods.assemblypipeline.runMetadata as runMetadata
-from genemethods.assemblypipeline.basicAssembly import Basic
-import genemethods.assemblypipeline.fastqmover as fastqmover
-from genemethods.assemblypipeline.mobrecon import MobRecon
-from genemethods.assemblypipeline.ec_typer import ECTyper
-import genemethods.assemblypipeline.compress as compress
-import genemethods.assemblypipeline.prodigal as prodigal
-from genemethods.assemblypipeline.seqsero import SeqSero
-import genemethods.assemblypipeline.reporter as reporter
-import genemethods.assemblypipeline.quality as quality
-from genemethods.genesippr.genesippr import GeneSippr
-from genemethods.MLSTsippr.mlst import ReportParse
-import genemethods.assemblypipeline.sistr as sistr
-import genemethods.assemblypipeline.skesa as skesa
-from cowbat.metagenomefilter import automateCLARK
-import genemethods.assemblypipeline.phix as phix
-from genemethods.geneseekr.blast import BLAST
-from genemethods.MLST.mlst_kma import KMAMLST
-import genemethods.MASHsippr.mash as mash
+from cowbat.pipelinetools.blastcache import BlastCache
+from cowbat.pipelinetools.bundle import DatabaseBundle
+from cowbat.pipelinetools.ledger import StageLedger, checkpoint
+from cowbat.pipelinetools.metadatawriter import MetadataWriter
+from cowbat.pipelinetools.stagetimer import StageTimer
+from cowbat.pipelinetools.samplestream import SampleStream
+from cowbat.pipelinetools.stagegraph import StageGraph
+from cowbat.pipelinetools import resources
 from argparse import ArgumentParser
 import multiprocessing
 from time import time
@@ -32,6 +16,12 @@ import os
 
 __version__ = '0.5.0.15'
 __author__ = 'adamkoziol'
+# The genemethods modules (and their Biopython, pandas, and plotting dependencies) are imported by the stages that use
+# them rather than at startup, so that --help, --version, and pre-processing runs only import what they need
+# Approximate peak memory of the stages that run memory-intensive external tools. SKESA is run on one sample at a time
+stage_memory = {'assemble_genomes': 16 * 1024 ** 3,
+                'contamination_detection': 4 * 1024 ** 3,
+                'mob_suite': 4 * 1024 ** 3}
 
 
 class RunAssemble(object):
@@ -40,26 +30,335 @@ class RunAssemble(object):
         """
         Run the methods in the correct order
         """
-        # Start the assembly
-        self.helper()
-        # Create the quality object
-        self.create_quality_object()
-        # Run the quality analyses
-        self.quality()
-        # Perform assembly
-        self.assemble()
-        # Perform genus-agnostic typing
-        self.agnostictyping()
-        # Perform typing
-        self.typing()
+        if self.streaming:
+            # Process each sample independently until assembly is complete
+            self.stream()
+            # Exit if only pre-processing of data is requested
+            if self.preprocess:
+                self.print_metadata(force=True)
+                self.report_timing()
+                logging.info('Pre-processing complete')
+                quit()
+            if self.stagegraph:
+                # Run the remaining stages as soon as the stages they depend on are complete
+                self.stage_graph(complete=self.streamed_stages).run(pipeline=self)
+            else:
+                # CLARK analyses
+                self.clark()
+                # Perform genus-agnostic typing
+                self.agnostictyping()
+                # Perform typing
+                self.typing()
+        elif self.stagegraph:
+            # Run each stage as soon as the stages it depends on are complete
+            self.stage_graph().run(pipeline=self)
+            # Exit if only pre-processing of data is requested
+            if self.preprocess:
+                self.print_metadata(force=True)
+                self.report_timing()
+                logging.info('Pre-processing complete')
+                quit()
+        else:
+            # Start the assembly
+            self.helper()
+            # Create the quality object
+            self.create_quality_object()
+            # Run the quality analyses
+            self.quality()
+            # Perform assembly
+            self.assemble()
+            # Perform genus-agnostic typing
+            self.agnostictyping()
+            # Perform typing
+            self.typing()
         # Compress or remove all large, temporary files created by the pipeline
         if not self.debug:
+            import genemethods.assemblypipeline.compress as compress
             compress.Compress(self)
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata(force=True)
+        self.report_timing()
+
+    def stream(self):
+        """
+        Create the run metadata, and then send each sample through pre-processing and assembly independently of the
+        other samples. ConFindr is run on the whole run folder at the same time
+        """
+        self.helper()
+        self.create_quality_object()
+        share = max(1, self.cpus // 4)
+        graph = StageGraph(cpus=self.cpus,
+                           manager=self.resources)
+        graph.add(name='stream_samples',
+                  reads=['general.fastqfiles'],
+                  writes=['general.trimmedfastqfiles', 'general.trimmedcorrectedfastqfiles', 'general.bestassemblyfile',
+                          'quality', 'quast', 'qualimap', 'prodigal'],
+                  cores=self.cpus - share)
+        graph.add(name='contamination_detection',
+                  reads=['qualityobject'],
+                  writes=['confindr'],
+                  cores=share)
+        graph.run(pipeline=self)
+        self.streamed_stages = ['helper', 'create_quality_object', 'contamination_detection'] + self.sample_stages()
+
+    def stream_samples(self):
+        """
+        Run the per-sample stages on each sample with a bounded number of samples in progress at once
+        """
+        stream = SampleStream(pipeline=self,
+                              stages=self.sample_stages(),
+                              workers=self.sampleworkers,
+                              manager=self.resources,
+                              memory=stage_memory)
+        stream.run()
+
+    def sample_stages(self):
+        """
+        List the stages that only use the data of a single sample, and can therefore be streamed
+        :return: List of the names of the stage methods, in order
+        """
+        # Each sample is given its own quality object
+        stages = ['create_quality_object']
+        if not self.debug:
+            stages.append('fastq_validate')
+        stages.extend(['fastqc_raw', 'quality_trim', 'fastqc_trimmed', 'error_correct', 'fastqc_trimmedcorrected'])
+        if not self.preprocess:
+            stages.extend(['assemble_genomes', 'evaluate_assemblies', 'prodigal'])
+        return stages
+
+    def stage_graph(self, complete=None):
+        """
+        Declare the stages of the pipeline, and the sample attributes that each stage reads and writes. Stages are
+        declared in the same order as the serial pipeline; stages that do not share attributes are run concurrently
+        :param complete: Optional list of the names of stages that have already been run
+        :return: StageGraph object populated with the pipeline stages
+        """
+        graph = StageGraph(cpus=self.cpus,
+                           complete=complete,
+                           manager=self.resources)
+        # Cores allotted to each of the analyses that can share the node
+        share = max(1, self.cpus // 4)
+        # The reports of each stage are declared, so that a stage resumed for a subset of the samples only merges its
+        # own reports. Stages with reports that cannot be merged (e.g. .xlsx) are always run on all the samples
+        graph.add(name='helper',
+                  writes=['general', 'run', 'commands'])
+        graph.add(name='create_quality_object',
+                  reads=['general'],
+                  writes=['qualityobject'])
+        if not self.debug:
+            graph.add(name='fastq_validate',
+                      reads=['qualityobject', 'general.fastqfiles'],
+                      writes=['general.fastqfiles'],
+                      cores=self.cpus - share)
+        graph.add(name='fastqc_raw',
+                  reads=['qualityobject', 'general.fastqfiles'],
+                  writes=['fastqc.raw'],
+                  cores=share)
+        graph.add(name='quality_trim',
+                  reads=['qualityobject', 'general.fastqfiles'],
+                  writes=['general.trimmedfastqfiles'],
+                  cores=self.cpus - share)
+        graph.add(name='fastqc_trimmed',
+                  reads=['qualityobject', 'general.trimmedfastqfiles'],
+                  writes=['fastqc.trimmed'],
+                  cores=share)
+        graph.add(name='error_correct',
+                  reads=['qualityobject', 'general.trimmedfastqfiles'],
+                  writes=['general.trimmedcorrectedfastqfiles'],
+                  cores=self.cpus - share)
+        graph.add(name='contamination_detection',
+                  reads=['qualityobject', 'general.trimmedcorrectedfastqfiles'],
+                  writes=['confindr'],
+                  cores=self.cpus - share,
+                  memory=stage_memory['contamination_detection'],
+                  databases=['ConFindr'],
+                  runwide=True)
+        graph.add(name='fastqc_trimmedcorrected',
+                  reads=['qualityobject', 'general.trimmedcorrectedfastqfiles'],
+                  writes=['fastqc.trimmedcorrected'],
+                  cores=share)
+        # The remaining stages are not required for pre-processing
+        if self.preprocess:
+            return graph
+        graph.add(name='assemble_genomes',
+                  reads=['general.trimmedcorrectedfastqfiles'],
+                  writes=['general.assemblyfile', 'general.bestassemblyfile', 'general.assembly_output'],
+                  memory=stage_memory['assemble_genomes'])
+        graph.add(name='evaluate_assemblies',
+                  reads=['general.bestassemblyfile'],
+                  writes=['general.bestassemblyfile', 'general.bestassembliespath', 'quast', 'qualimap'])
+        graph.add(name='prodigal',
+                  reads=['general.bestassemblyfile'],
+                  writes=['prodigal'],
+                  cores=share)
+        graph.add(name='clark',
+                  reads=['general.bestassemblyfile', 'general.trimmedcorrectedfastqfiles', 'run.Description'],
+                  writes=['general.combined', 'general.abundance', 'general.classification', 'clarkfasta',
+                          'clarkfastq'],
+                  cores=share,
+                  databases=['clark'],
+                  runwide=True)
+        graph.add(name='mash',
+                  reads=['general.bestassemblyfile'],
+                  writes=['mash', 'general.referencegenus', 'general.closestrefseqgenus'],
+                  cores=share,
+                  databases=['mash'],
+                  reports=['mash.csv'])
+        graph.add(name='rmlst_assembled',
+                  reads=['general.bestassemblyfile'],
+                  writes=['rmlst'],
+                  cores=share,
+                  parameters={'cutoff': 100},
+                  databases=['rMLST'],
+                  reports=['rmlst.csv'])
+        graph.add(name='quality_report',
+                  reads=['general', 'run', 'confindr', 'quast', 'qualimap', 'prodigal', 'mash', 'rmlst'],
+                  writes=['reports.quality'],
+                  cores=share,
+                  runwide=True)
+        graph.add(name='sixteens',
+                  reads=['general.trimmedcorrectedfastqfiles', 'general.referencegenus'],
+                  writes=['sixteens_full'],
+                  cores=share,
+                  parameters={'cutoff': 0.95},
+                  databases=['sixteens_full'],
+                  reports=['sixteens_full.csv', 'sixteens_full_sequences.fa'])
+        graph.add(name='genesippr',
+                  reads=['general.trimmedcorrectedfastqfiles'],
+                  writes=['genesippr'],
+                  cores=share,
+                  parameters={'cutoff': 0.95},
+                  databases=['genesippr'],
+                  reports=['genesippr.csv', '*_genesippr.csv'])
+        graph.add(name='ressippr',
+                  reads=['general.trimmedcorrectedfastqfiles'],
+                  writes=['resfinder'],
+                  cores=share,
+                  parameters={'cutoff': 0.7},
+                  databases=['resfinder'],
+                  reports=['resfinder.csv'])
+        graph.add(name='resfinder',
+                  reads=['general.bestassemblyfile'],
+                  writes=['resfinder_assembled'],
+                  cores=share,
+                  databases=['resfinder'],
+                  reports=['resfinder_assembled_blastn.xlsx'])
+        graph.add(name='mob_suite',
+                  reads=['general.bestassemblyfile', 'resfinder_assembled'],
+                  writes=['mobrecon'],
+                  cores=share,
+                  memory=stage_memory['mob_suite'],
+                  databases=['mobrecon'],
+                  reports=['mob_recon_summary.csv', 'amr_summary.csv', 'plasmid_borne_summary.csv'])
+        graph.add(name='prophages',
+                  reads=['general.bestassemblyfile'],
+                  writes=['prophages'],
+                  cores=share,
+                  parameters={'cutoff': 90},
+                  databases=['prophages'],
+                  reports=['prophages.csv'])
+        graph.add(name='univec',
+                  reads=['general.bestassemblyfile'],
+                  writes=['univec'],
+                  cores=share,
+                  parameters={'cutoff': 80},
+                  databases=['univec'],
+                  reports=['univec.csv'])
+        graph.add(name='virulence',
+                  reads=['general.trimmedcorrectedfastqfiles'],
+                  writes=['virulence'],
+                  cores=share,
+                  parameters={'cutoff': 0.9},
+                  databases=['virulence'],
+                  reports=['virulence.csv'])
+        graph.add(name='cgmlst',
+                  reads=['general.trimmedcorrectedfastqfiles', 'general.referencegenus'],
+                  writes=['cgmlst'],
+                  cores=share,
+                  parameters={'cutoff': 98},
+                  databases=['cgMLST'],
+                  reports=['cgmlst.csv'])
+        graph.add(name='mlst_assembled',
+                  reads=['general.bestassemblyfile', 'general.referencegenus'],
+                  writes=['mlst'],
+                  cores=share,
+                  parameters={'cutoff': 100},
+                  databases=['MLST'],
+                  reports=['mlst.csv', 'mlst_*.csv'])
+        graph.add(name='ec_typer',
+                  reads=['general.bestassemblyfile', 'general.referencegenus'],
+                  writes=['ectyper'],
+                  cores=share,
+                  reports=['ec_report.tsv'])
+        graph.add(name='serosippr',
+                  reads=['general.trimmedcorrectedfastqfiles', 'general.referencegenus'],
+                  writes=['serosippr'],
+                  cores=share,
+                  parameters={'cutoff': 0.90},
+                  databases=['serosippr'],
+                  reports=['serosippr.csv'])
+        graph.add(name='seqsero',
+                  reads=['general.trimmedcorrectedfastqfiles', 'general.referencegenus'],
+                  writes=['seqsero'],
+                  cores=share,
+                  reports=['seqsero.tsv'])
+        graph.add(name='legacy_vtyper',
+                  reads=['general.bestassemblyfile', 'general.referencegenus'],
+                  writes=['legacy_vtyper'],
+                  cores=share,
+                  parameters={'mismatches': 2},
+                  databases=['vtyper'],
+                  reports=['legacy_vtyper.csv', 'ePCR_report.csv'])
+        graph.add(name='verotoxin',
+                  reads=['general.trimmedcorrectedfastqfiles', 'general.referencegenus'],
+                  writes=['verotoxin'],
+                  cores=share,
+                  parameters={'cutoff': 90},
+                  databases=['verotoxin'],
+                  reports=['verotoxin_summary.csv', 'verotoxin_kma_outputs.csv'])
+        graph.add(name='sistr',
+                  reads=['general.bestassemblyfile', 'general.referencegenus'],
+                  writes=['sistr'],
+                  cores=share,
+                  reports=['sistr.tsv'])
+        graph.add(name='run_gdcs',
+                  reads=['general.bestassemblyfile', 'general.referencegenus', 'mlst', 'rmlst', 'cgmlst'],
+                  writes=['gdcs'],
+                  cores=share,
+                  databases=['GDCS'],
+                  reports=['gdcs.csv'])
+        # The final report uses the outputs of every analysis, so it is run on its own once everything is complete
+        graph.add(name='run_report',
+                  reads=['general', 'run', 'commands', 'confindr', 'quast', 'qualimap', 'prodigal', 'clarkfasta',
+                         'clarkfastq', 'mash', 'rmlst', 'sixteens_full', 'genesippr', 'resfinder',
+                         'resfinder_assembled', 'mobrecon', 'prophages', 'univec', 'virulence', 'cgmlst', 'mlst',
+                         'ectyper', 'serosippr', 'seqsero', 'legacy_vtyper', 'verotoxin', 'sistr', 'gdcs'],
+                  writes=['reports.run'],
+                  runwide=True)
+        return graph
+
+    def print_metadata(self, force=False):
+        """
+        Write the metadata of the samples to their .json files. Files are only written if the metadata have changed, and
+        writes are postponed until the metadata flush interval has elapsed
+        :param force: Boolean of whether to write all outstanding metadata immediately
+        """
+        self.metadata_writer.write(samples=self.runmetadata.samples,
+                                   force=force)
+
+    def report_timing(self):
+        """
+        Write the wall time, CPU time, and peak memory of each stage to the reports folder, and log a summary
+        """
+        self.timer.write(reportpath=self.reportpath)
+        self.timer.summary()
 
     def helper(self):
         """Helper function for file creation (if desired), manipulation, quality assessment,
         and trimming as well as the assembly"""
+        from genemethods.assemblypipeline.basicAssembly import Basic
+        import genemethods.assemblypipeline.runMetadata as runMetadata
+        import genemethods.assemblypipeline.fastqmover as fastqmover
+        import genemethods.assemblypipeline.phix as phix
         # Simple assembly without requiring accessory files (SampleSheet.csv, etc).
         if self.basicassembly:
             self.runmetadata = Basic(inputobject=self)
@@ -81,12 +380,13 @@ class RunAssemble(object):
             # Move/link the FASTQ files to strain-specific working directories
             fastqmover.FastqMover(inputobject=self)
         # Print the metadata to file
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
     def create_quality_object(self):
         """
         Create the quality object
         """
+        import genemethods.assemblypipeline.quality as quality
         self.qualityobject = quality.Quality(inputobject=self)
 
     def quality(self):
@@ -111,60 +411,69 @@ class RunAssemble(object):
         # Run FastQC on the processed fastq files
         self.fastqc_trimmedcorrected()
         # Exit if only pre-processing of data is requested
-        metadataprinter.MetadataPrinter(inputobject=self)
         if self.preprocess:
+            self.print_metadata(force=True)
+            self.report_timing()
             logging.info('Pre-processing complete')
             quit()
+        self.print_metadata()
 
+    @checkpoint
     def fastq_validate(self):
         """
         Attempt to detect and fix issues with the FASTQ files
         """
         self.qualityobject.validate_fastq()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def fastqc_raw(self):
         """
         Run FastQC on the unprocessed FASTQ files
         """
         self.qualityobject.fastqcthreader(level='Raw')
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def quality_trim(self):
         """
         Perform quality trimming and FastQC on the trimmed files
         """
         self.qualityobject.trimquality()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def fastqc_trimmed(self):
         """
         Run FastQC on the quality trimmed FASTQ files
         """
         self.qualityobject.fastqcthreader(level='Trimmed')
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def error_correct(self):
         """
         Perform error correcting on the reads
         """
         self.qualityobject.error_correction()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def contamination_detection(self):
         """
         Calculate the levels of contamination in the reads
         """
         self.qualityobject.contamination_finder(report_path=self.reportpath,
                                                 debug=self.debug)
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def fastqc_trimmedcorrected(self):
         """
         Run FastQC on the processed fastq files
         """
         self.qualityobject.fastqcthreader(level='trimmedcorrected')
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
     def assemble(self):
         """
@@ -179,33 +488,41 @@ class RunAssemble(object):
         # CLARK analyses
         self.clark()
 
+    @checkpoint
     def assemble_genomes(self):
         """
         Use skesa to assemble genomes
         """
+        import genemethods.assemblypipeline.skesa as skesa
         assembly = skesa.Skesa(inputobject=self)
         assembly.main()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def evaluate_assemblies(self):
         """
         Evaluate assemblies with Quast
         """
+        import genemethods.assemblypipeline.assembly_evaluation as evaluate
         qual = evaluate.AssemblyEvaluation(inputobject=self)
         qual.main()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def prodigal(self):
         """
         Use prodigal to detect open reading frames in the assemblies
         """
+        import genemethods.assemblypipeline.prodigal as prodigal
         prodigal.Prodigal(self)
-        metadataprinter.MetadataPrinter(self)
+        self.print_metadata()
 
+    @checkpoint
     def clark(self):
         """
         Run CLARK metagenome analyses on the raw reads and assemblies if the system has adequate resources
         """
+        from cowbat.metagenomefilter import automateCLARK
         # Run CLARK typing on the .fastq and .fasta files
         automateCLARK.PipelineInit(inputobject=self,
                                    extension='fasta',
@@ -244,53 +561,77 @@ class RunAssemble(object):
         # cgMLST
         self.cgmlst()
 
+    @checkpoint
     def mash(self):
         """
         Run mash to determine closest refseq genome
         """
+        import genemethods.MASHsippr.mash as mash
         mash.Mash(inputobject=self,
                   analysistype='mash')
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
+
+    def blast_seekr(self, blast):
+        """
+        Run a BLAST-based analysis, re-using the cached BLAST reports of previously analysed assemblies if a BLAST
+        cache is in use
+        :param blast: BLAST object (or subclass) to run
+        """
+        if self.blastcache:
+            self.blastcache.seekr(blast)
+        else:
+            blast.seekr()
 
+    @checkpoint
     def rmlst_assembled(self):
         """
         Run rMLST analyses on assemblies
         """
-        if not os.path.isfile(os.path.join(self.reportpath, 'rmlst.csv')):
+        from genemethods.geneseekr.blast import BLAST
+        from genemethods.MLSTsippr.mlst import ReportParse
+        # Existing reports cannot be re-used when resuming a subset of the samples, as they do not contain the results
+        # of the samples being re-run
+        if self.subset or not os.path.isfile(os.path.join(self.reportpath, 'rmlst.csv')):
             rmlst = BLAST(args=self,
                           analysistype='rmlst',
                           cutoff=100)
-            rmlst.seekr()
+            self.blast_seekr(rmlst)
         else:
             parse = ReportParse(args=self,
                                 analysistype='rmlst')
             parse.report_parse()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def quality_report(self):
         """
         Create reports summarising the run and sample quality outputs
         """
+        import genemethods.assemblypipeline.reporter as reporter
         qual_report = reporter.Reporter(self)
         qual_report.run_quality_reporter()
         qual_report.sample_quality_report()
 
+    @checkpoint
     def sixteens(self):
         """
         Run the 16S analyses
         """
+        from genemethods.sixteenS.sixteens_full import SixteenS as SixteensFull
         SixteensFull(args=self,
                      pipelinecommit=self.commit,
                      startingtime=self.starttime,
                      scriptpath=self.homepath,
                      analysistype='sixteens_full',
                      cutoff=0.95)
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def genesippr(self):
         """
         Find genes of interest
         """
+        from genemethods.genesippr.genesippr import GeneSippr
         GeneSippr(args=self,
                   pipelinecommit=self.commit,
                   startingtime=self.starttime,
@@ -299,12 +640,14 @@ class RunAssemble(object):
                   cutoff=0.95,
                   pipeline=False,
                   revbait=False)
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def mob_suite(self):
         """
 
         """
+        from genemethods.assemblypipeline.mobrecon import MobRecon
         mob = MobRecon(metadata=self.runmetadata.samples,
                        analysistype='mobrecon',
                        databasepath=self.reffilepath,
@@ -312,12 +655,14 @@ class RunAssemble(object):
                        logfile=self.logfile,
                        reportpath=self.reportpath)
         mob.mob_recon()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def ressippr(self):
         """
         Resistance finding - raw reads
         """
+        from genemethods.typingclasses.typingclasses import Resistance
         res = Resistance(args=self,
                          pipelinecommit=self.commit,
                          startingtime=self.starttime,
@@ -327,46 +672,58 @@ class RunAssemble(object):
                          pipeline=False,
                          revbait=True)
         res.main()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def resfinder(self):
         """
         Resistance finding - assemblies
         """
+        from genemethods.geneseekr.blast import BLAST
         resfinder = BLAST(args=self,
                           analysistype='resfinder_assembled')
-        resfinder.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.blast_seekr(resfinder)
+        self.print_metadata()
 
+    @checkpoint
     def prophages(self, cutoff=90):
         """
         Prophage detection
         :param cutoff: cutoff value to be used in the analyses
         """
+        from genemethods.typingclasses.typingclasses import Prophages
         prophages = Prophages(args=self,
                               analysistype='prophages',
                               cutoff=cutoff,
                               unique=True)
-        if not os.path.isfile(os.path.join(self.reportpath, 'prophages.csv')):
-            prophages.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        # Existing reports cannot be re-used when resuming a subset of the samples, as they do not contain the results
+        # of the samples being re-run
+        if self.subset or not os.path.isfile(os.path.join(self.reportpath, 'prophages.csv')):
+            self.blast_seekr(prophages)
+        self.print_metadata()
 
+    @checkpoint
     def univec(self):
         """
         Univec contamination search
         """
-        if not os.path.isfile(os.path.join(self.reportpath, 'univec.csv')):
+        from genemethods.typingclasses.typingclasses import Univec
+        # Existing reports cannot be re-used when resuming a subset of the samples, as they do not contain the results
+        # of the samples being re-run
+        if self.subset or not os.path.isfile(os.path.join(self.reportpath, 'univec.csv')):
             univec = Univec(args=self,
                             analysistype='univec',
                             cutoff=80,
                             unique=True)
-            univec.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+            self.blast_seekr(univec)
+        self.print_metadata()
 
+    @checkpoint
     def virulence(self):
         """
         Virulence gene detection
         """
+        from genemethods.typingclasses.typingclasses import Virulence
         vir = Virulence(args=self,
                         pipelinecommit=self.commit,
                         startingtime=self.starttime,
@@ -375,15 +732,22 @@ class RunAssemble(object):
                         cutoff=0.9,
                         pipeline=False,
                         revbait=True)
-        if not os.path.isfile(os.path.join(self.reportpath, 'virulence.csv')):
+        # Existing reports cannot be re-used when resuming a subset of the samples, as they do not contain the results
+        # of the samples being re-run
+        if self.subset or not os.path.isfile(os.path.join(self.reportpath, 'virulence.csv')):
             vir.reporter()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def cgmlst(self):
         """
         Run rMLST analyses on raw reads
         """
-        if not os.path.isfile(os.path.join(self.reportpath, 'cgmlst.csv')):
+        from genemethods.MLST.mlst_kma import KMAMLST
+        from genemethods.MLSTsippr.mlst import ReportParse
+        # Existing reports cannot be re-used when resuming a subset of the samples, as they do not contain the results
+        # of the samples being re-run
+        if self.subset or not os.path.isfile(os.path.join(self.reportpath, 'cgmlst.csv')):
             cgmlst = KMAMLST(args=self,
                              pipeline=True,
                              analysistype='cgmlst',
@@ -394,7 +758,7 @@ class RunAssemble(object):
             parse = ReportParse(args=self,
                                 analysistype='cgmlst')
             parse.report_parse()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
     def typing(self):
         """
@@ -420,39 +784,48 @@ class RunAssemble(object):
         # Create a final summary report
         self.run_report()
 
+    @checkpoint
     def mlst_assembled(self):
         """
         Run rMLST analyses on assemblies
         """
-        if not os.path.isfile(os.path.join(self.reportpath, 'mlst.csv')):
+        from genemethods.geneseekr.blast import BLAST
+        from genemethods.MLSTsippr.mlst import ReportParse
+        # Existing reports cannot be re-used when resuming a subset of the samples, as they do not contain the results
+        # of the samples being re-run
+        if self.subset or not os.path.isfile(os.path.join(self.reportpath, 'mlst.csv')):
 
             mlst = BLAST(args=self,
                          analysistype='mlst',
                          cutoff=100,
                          genus_specific=True)
-            mlst.seekr()
+            self.blast_seekr(mlst)
         else:
             parse = ReportParse(args=self,
                                 analysistype='mlst')
             parse.report_parse()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def ec_typer(self):
         """
         Assembly-based serotyping
         """
+        from genemethods.assemblypipeline.ec_typer import ECTyper
         ec = ECTyper(metadata=self.runmetadata,
                      report_path=self.reportpath,
                      assembly_path=os.path.join(self.path, 'raw_assemblies'),
                      threads=self.cpus,
                      logfile=self.logfile)
         ec.main()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def serosippr(self):
         """
         Serotyping analyses
         """
+        from genemethods.typingclasses.typingclasses import Serotype
         Serotype(args=self,
                  pipelinecommit=self.commit,
                  startingtime=self.starttime,
@@ -460,59 +833,71 @@ class RunAssemble(object):
                  analysistype='serosippr',
                  cutoff=0.90,
                  pipeline=True)
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def seqsero(self):
         """
         Run SeqSero2 on Salmonella samples
         """
+        from genemethods.assemblypipeline.seqsero import SeqSero
         seqsero = SeqSero(self)
         seqsero.main()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def legacy_vtyper(self):
         """
         Legacy vtyper - uses ePCR
         """
+        from genemethods.assemblypipeline.legacy_vtyper import Vtyper as LegacyVtyper
         legacy_vtyper = LegacyVtyper(inputobject=self,
                                      analysistype='legacy_vtyper',
                                      mismatches=2)
         legacy_vtyper.vtyper()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def verotoxin(self):
         """
         Raw read verotoxin typing
         """
+        from genemethods.typingclasses.typingclasses import Verotoxin
         vero = Verotoxin(args=self,
                          pipeline=True,
                          analysistype='verotoxin',
                          cutoff=90)
         vero.main()
 
+    @checkpoint
     def sistr(self):
         """
         Sistr
         """
+        import genemethods.assemblypipeline.sistr as sistr
         sistr_obj = sistr.Sistr(inputobject=self,
                                 analysistype='sistr')
         sistr_obj.main()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def run_gdcs(self):
         """
         Determine the presence of genomically-dispersed conserved sequences (genes from MLST, rMLST, and cgMLST
         analyses)
         """
+        from genemethods.typingclasses.typingclasses import GDCS
         # Run the GDCS analysis
         gdcs = GDCS(inputobject=self)
         gdcs.main()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def run_report(self):
         """
         Create the final combinedMetadata report
         """
+        import genemethods.assemblypipeline.reporter as reporter
         run_report = reporter.Reporter(self)
         # Create the standard and legacy reports
         run_report.metadata_reporter()
@@ -559,7 +944,54 @@ class RunAssemble(object):
             self.basicassembly = True
             logging.warning('Could not find a sample sheet. Performing basic assembly (no run metadata captured)')
         # Use the argument for the number of threads to use, or default to the number of cpus in the system
-        self.cpus = args.threads if args.threads else multiprocessing.cpu_count() - 1
+        self.cpus = int(args.threads) if args.threads else multiprocessing.cpu_count() - 1
+        # Admit the stages and external commands against the cores and memory available to the pipeline
+        try:
+            memory = float(args.memory) * 1024 ** 3 if args.memory else None
+        except AttributeError:
+            memory = None
+        self.resources = resources.configure(cores=self.cpus,
+                                             memory=memory)
+        # Optionally run independent stages concurrently
+        try:
+            self.stagegraph = args.stagegraph
+        except AttributeError:
+            self.stagegraph = False
+        # Optionally process each sample independently through pre-processing and assembly
+        try:
+            self.streaming = args.streaming
+        except AttributeError:
+            self.streaming = False
+        try:
+            self.sampleworkers = int(args.sampleworkers) if args.sampleworkers else max(1, self.cpus // 4)
+        except AttributeError:
+            self.sampleworkers = max(1, self.cpus // 4)
+        self.streamed_stages = list()
+        # Optionally send CLARK classifications to the resident classification service
+        try:
+            self.clarkservice = args.clarkservice
+        except AttributeError:
+            self.clarkservice = False
+        # Optionally run several CLARK processes at once, sized from the available threads and memory
+        try:
+            self.adaptiveclark = args.adaptiveclark
+        except AttributeError:
+            self.adaptiveclark = False
+        # Optionally re-use the BLAST reports of assemblies that have been analysed previously
+        try:
+            if args.blastcache:
+                self.blastcache = BlastCache(path=os.path.abspath(os.path.expanduser(args.blastcache)),
+                                             maxsize=float(args.blastcachesize) * 1024 ** 3)
+            else:
+                self.blastcache = None
+        except AttributeError:
+            self.blastcache = None
+        # Writes the metadata files of the samples at most once per flush interval
+        try:
+            interval = args.metadatainterval
+        except AttributeError:
+            interval = 0
+        self.metadata_writer = MetadataWriter(interval=interval)
         # Assertions to ensure that the provided variables are valid
         make_path(self.path)
         assert os.path.isdir(self.path), 'Supplied path location is not a valid directory {0!r:s}'.format(self.path)
@@ -568,6 +1000,26 @@ class RunAssemble(object):
         assert os.path.isdir(self.reffilepath), 'Reference file path is not a valid directory {0!r:s}' \
             .format(self.reffilepath)
         self.commit = __version__
+        # A reference database folder built as a bundle has all of its indexes prepared in advance
+        self.bundle = DatabaseBundle(self.reffilepath)
+        # Record the completed stages, so that an interrupted run can be resumed without repeating them
+        try:
+            fresh = args.fresh
+        except AttributeError:
+            fresh = False
+        # Set on the copies of the pipeline used by the ledger to re-run a stage on the incomplete samples
+        self.subset = False
+        self.ledger = StageLedger(path=os.path.join(self.path, 'ledger'),
+                                  reffilepath=self.reffilepath,
+                                  version=__version__,
+                                  fresh=fresh,
+                                  bundle=self.bundle)
+        # Measure the time, CPU, and memory used by each stage, and optionally trace the external commands
+        try:
+            trace = args.trace
+        except AttributeError:
+            trace = False
+        self.timer = StageTimer(trace=trace)
         self.homepath = args.homepath
         self.logfile = os.path.join(self.path, 'logfile')
         self.runinfo = str()
@@ -614,6 +1066,51 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Enable debug mode for the pipeline (skip FASTQ validation, and file deletion. Enable '
                              'debug-level messages if they exist)')
+    parser.add_argument('-g', '--stagegraph',
+                        action='store_true',
+                        help='Run stages that do not depend on each other concurrently, sharing the available threads. '
+                             'Default is to run all stages serially')
+    parser.add_argument('-S', '--streaming',
+                        action='store_true',
+                        help='Send each sample through quality trimming, error correction, and assembly independently '
+                             'of the other samples, rather than waiting for all samples to complete each stage')
+    parser.add_argument('-w', '--sampleworkers',
+                        type=int,
+                        help='Maximum number of samples to process at once with --streaming. Default is a quarter of '
+                             'the number of threads')
+    parser.add_argument('-f', '--fresh',
+                        action='store_true',
+                        help='Ignore the record of the stages completed by a previous (interrupted) run of the '
+                             'pipeline on this folder, and re-run every stage')
+    parser.add_argument('-k', '--clarkservice',
+                        action='store_true',
+                        help='Send CLARK classifications to a long-lived service that keeps the CLARK database in '
+                             'memory between the FASTA and FASTQ analyses, and between runs on the same node')
+    parser.add_argument('-a', '--adaptiveclark',
+                        action='store_true',
+                        help='Classify shards of the samples with concurrent CLARK processes sized from the available '
+                             'threads and memory, rather than a single CLARK process limited to four threads')
+    parser.add_argument('-B', '--blastcache',
+                        help='Path of a folder in which to cache BLAST reports. Assemblies that have previously been '
+                             'analysed against the same database re-use the cached reports rather than running BLAST')
+    parser.add_argument('-Z', '--blastcachesize',
+                        default=50,
+                        type=float,
+                        help='Maximum size in GB of the BLAST cache. The least recently used reports are removed once '
+                             'the cache is larger than this size. Default is 50')
+    parser.add_argument('-m', '--memory',
+                        type=float,
+                        help='Memory in GB available to the pipeline. Stages and external commands are only started '
+                             'once their expected memory is available. Default is the total memory of the system')
+    parser.add_argument('-T', '--trace',
+                        action='store_true',
+                        help='Write a trace of the stages, samples, and external commands of the run to '
+                             'reports/pipeline_trace.json, which can be opened in Perfetto or chrome://tracing')
+    parser.add_argument('-M', '--metadatainterval',
+                        default=30,
+                        type=float,
+                        help='Minimum number of seconds between writes of the sample metadata .json files. All '
+                             'outstanding metadata are always written at the end of the run. Default is 30')
     # Get the arguments into an object
     arguments = parser.parse_args()
     arguments.startingtime = time()
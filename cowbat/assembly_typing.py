@@ -1,29 +1,24 @@
 #!/usr/bin/env python3
 from olctools.accessoryFunctions.accessoryFunctions import MetadataObject, GenObject, make_path, relative_symlink, SetupLogging
-from genemethods.assemblypipeline.legacy_vtyper import Vtyper as LegacyVtyper
-import olctools.accessoryFunctions.metadataprinter as metadataprinter
-from genemethods.typingclasses.typingclasses import GDCS, Prophages, Univec
-from genemethods.assemblypipeline.createobject import ObjectCreation
-from genemethods.assemblypipeline.mobrecon import MobRecon
-from genemethods.assemblypipeline.ec_typer import ECTyper
-import genemethods.assemblypipeline.compress as compress
-import genemethods.assemblypipeline.prodigal as prodigal
-import genemethods.assemblypipeline.reporter as reporter
-import genemethods.assemblypipeline.quality as quality
-from genemethods.MLSTsippr.mlst import ReportParse
-import genemethods.assemblypipeline.sistr as sistr
-from cowbat.metagenomefilter import automateCLARK
-from genemethods.geneseekr.blast import BLAST
-import genemethods.coreGenome.core as core
-import genemethods.MASHsippr.mash as mash
+from cowbat.pipelinetools.blastcache import BlastCache
+from cowbat.pipelinetools.bundle import DatabaseBundle
+from cowbat.pipelinetools.metadatawriter import MetadataWriter
+from cowbat.pipelinetools.stagetimer import StageTimer
+from cowbat.pipelinetools import resources
+from cowbat.pipelinetools.reportsplitter import split_reports
+from cowbat.pipelinetools.ledger import StageLedger, checkpoint, merge_report
 from argparse import ArgumentParser
 import multiprocessing
+from glob import glob
 from time import time
 import logging
+import hashlib
+import json
 import os
 
 __version__ = '0.0.01'
 __author__ = 'adamkoziol'
+# The genemethods modules are imported by the typing stages that use them, rather than at startup
 
 
 class Typing(object):
@@ -34,6 +29,10 @@ class Typing(object):
         """
         # Create the metadata objects
         self.objects()
+        # Only type the new and modified assemblies in incremental mode
+        if self.incremental and not self.changed_assemblies():
+            logging.info('No new or modified assemblies to type')
+            return
         # Determine assembly stats
         self.assembly_stats()
         # Perform genus-agnostic typing
@@ -44,14 +43,37 @@ class Typing(object):
         self.typing_reports()
         # Compress or remove all large, temporary files created by the pipeline
         if not self.debug:
+            import genemethods.assemblypipeline.compress as compress
             compress.Compress(self)
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata(force=True)
+        if self.incremental:
+            # Add the rows of the samples that were not re-typed back into the reports
+            self.merge_reports()
+            self.record_assemblies()
+        self.report_timing()
+
+    def print_metadata(self, force=False):
+        """
+        Write the metadata of the samples to their .json files. Files are only written if the metadata have changed, and
+        writes are postponed until the metadata flush interval has elapsed
+        :param force: Boolean of whether to write all outstanding metadata immediately
+        """
+        self.metadata_writer.write(samples=self.runmetadata.samples,
+                                   force=force)
+
+    def report_timing(self):
+        """
+        Write the wall time, CPU time, and peak memory of each stage to the reports folder, and log a summary
+        """
+        self.timer.write(reportpath=self.reportpath)
+        self.timer.summary()
 
     def objects(self):
         """
 
         :return:
         """
+        from genemethods.assemblypipeline.createobject import ObjectCreation
         self.runmetadata = ObjectCreation(inputobject=self)
         make_path(os.path.join(self.path, 'BestAssemblies'))
         for sample in self.runmetadata.samples:
@@ -62,6 +84,61 @@ class Typing(object):
             sample.general.trimmedcorrectedfastqfiles = [sample.general.bestassemblyfile]
         # self.metadata = self.metadata.samples
 
+    def changed_assemblies(self):
+        """
+        Restrict the samples to those with assemblies that are new, or that have been modified since they were last
+        typed. The existing reports are stored, so that the rows of the other samples can be merged into the new reports
+        :return: List of the samples to type
+        """
+        try:
+            with open(self.assembly_record, 'r') as record:
+                typed = json.load(record)
+        except (FileNotFoundError, ValueError):
+            typed = dict()
+        changed = list()
+        for sample in self.runmetadata.samples:
+            sample.general.assemblyhash = assembly_hash(sample.general.bestassemblyfile)
+            if typed.get(sample.name) != sample.general.assemblyhash:
+                changed.append(sample)
+        logging.info('Typing {num} new or modified assemblies of {total}'.format(num=len(changed),
+                                                                                total=len(self.runmetadata.samples)))
+        self.runmetadata.samples = changed
+        # Store the contents of the existing reports, as the analyses re-write them with only the changed samples
+        self.previous_reports = dict()
+        for report in StageLedger.text_reports(self.reportpath):
+            with open(report, 'r') as report_file:
+                self.previous_reports[report] = report_file.readlines()
+        return changed
+
+    def merge_reports(self):
+        """
+        Merge the rows of the samples that were not re-typed from the previous reports into the new reports. The
+        additional rows of samples with several results (rows with a blank first column) are kept with their sample
+        """
+        names = set(sample.name for sample in self.runmetadata.samples)
+        for report, lines in self.previous_reports.items():
+            if os.path.isfile(report):
+                merge_report(report, lines, names)
+            else:
+                # Restore reports that were not created for the changed samples
+                with open(report, 'w') as report_file:
+                    report_file.write(''.join(lines))
+
+    def record_assemblies(self):
+        """
+        Record the hashes of the typed assemblies, so that subsequent incremental runs can skip them
+        """
+        try:
+            with open(self.assembly_record, 'r') as record:
+                typed = json.load(record)
+        except (FileNotFoundError, ValueError):
+            typed = dict()
+        for sample in self.runmetadata.samples:
+            typed[sample.name] = sample.general.assemblyhash
+        with open(self.assembly_record + '.tmp', 'w') as record:
+            json.dump(typed, record, sort_keys=True, indent=4, separators=(',', ': '))
+        os.replace(self.assembly_record + '.tmp', self.assembly_record)
+
     def assembly_stats(self):
         """
         Perform some basic quality analyses on the assemblies
@@ -72,28 +149,34 @@ class Typing(object):
         self.prodigal()
         # CLARK analyses
         self.clark()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def quality_features(self, analysis):
         """
         Extract features from assemblies such as total genome size, longest contig, and N50
         """
+        import genemethods.assemblypipeline.quality as quality
         features = quality.QualityFeatures(inputobject=self,
                                            analysis=analysis)
         features.main()
-        metadataprinter.MetadataPrinter(self)
+        self.print_metadata()
 
+    @checkpoint
     def prodigal(self):
         """
         Use prodigal to detect open reading frames in the assemblies
         """
+        import genemethods.assemblypipeline.prodigal as prodigal
         prodigal.Prodigal(self)
-        metadataprinter.MetadataPrinter(self)
+        self.print_metadata()
 
+    @checkpoint
     def clark(self):
         """
         Run CLARK metagenome analyses on the raw reads and assemblies if the system has adequate resources
         """
+        from cowbat.metagenomefilter import automateCLARK
         # Run CLARK typing on the .fastq and .fasta files
         automateCLARK.PipelineInit(inputobject=self,
                                    extension='fasta',
@@ -123,20 +206,37 @@ class Typing(object):
         # Virulence
         self.virulence()
 
+    @checkpoint
     def mash(self):
         """
         Run mash to determine closest refseq genome
         """
+        import genemethods.MASHsippr.mash as mash
         logging.info('Running MASH analyses')
         mash.Mash(inputobject=self,
                   analysistype='mash')
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
+
+    def blast_seekr(self, blast):
+        """
+        Run a BLAST-based analysis, re-using the cached BLAST reports of previously analysed assemblies if a BLAST
+        cache is in use
+        :param blast: BLAST object (or subclass) to run
+        """
+        if self.blastcache:
+            self.blastcache.seekr(blast)
+        else:
+            blast.seekr()
 
+    @checkpoint
     def rmlst_assembled(self):
         """
         Run rMLST analyses on assemblies
         """
-        if os.path.isfile(os.path.join(self.reportpath, 'rmlst.csv')):
+        from genemethods.geneseekr.blast import BLAST
+        from genemethods.MLSTsippr.mlst import ReportParse
+        # Existing reports cannot be re-used in incremental mode, as they do not contain the new samples
+        if not self.incremental and os.path.isfile(os.path.join(self.reportpath, 'rmlst.csv')):
             parse = ReportParse(args=self,
                                 analysistype='rmlst')
             parse.report_parse()
@@ -145,33 +245,39 @@ class Typing(object):
             rmlst = BLAST(args=self,
                           analysistype='rmlst',
                           cutoff=100)
-            rmlst.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+            self.blast_seekr(rmlst)
+        self.print_metadata()
 
+    @checkpoint
     def sixteens(self):
         """
         Run the 16S analyses
         """
+        from genemethods.geneseekr.blast import BLAST
         sixteen_s = BLAST(args=self,
                           analysistype='sixteens_full',
                           cutoff=95)
-        sixteen_s.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.blast_seekr(sixteen_s)
+        self.print_metadata()
 
+    @checkpoint
     def geneseekr(self):
         """
         Find genes of interest
         """
+        from genemethods.geneseekr.blast import BLAST
         geneseekr = BLAST(args=self,
                           analysistype='genesippr',
                           cutoff=95)
-        geneseekr.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.blast_seekr(geneseekr)
+        self.print_metadata()
 
+    @checkpoint
     def mob_suite(self):
         """
 
         """
+        from genemethods.assemblypipeline.mobrecon import MobRecon
         mob = MobRecon(metadata=self.runmetadata.samples,
                        analysistype='mobrecon',
                        databasepath=self.targetpath,
@@ -179,47 +285,55 @@ class Typing(object):
                        logfile=self.logfile,
                        reportpath=self.reportpath)
         mob.mob_recon()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def resfinder(self):
         """
         Resistance finding - assemblies
         """
+        from genemethods.geneseekr.blast import BLAST
         resfinder = BLAST(args=self,
                           analysistype='resfinder_assembled')
-        resfinder.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.blast_seekr(resfinder)
+        self.print_metadata()
 
+    @checkpoint
     def prophages(self):
         """
         Prophage detection
         """
+        from genemethods.typingclasses.typingclasses import Prophages
         prophages = Prophages(args=self,
                               analysistype='prophages',
                               cutoff=90,
                               unique=True)
-        prophages.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.blast_seekr(prophages)
+        self.print_metadata()
 
+    @checkpoint
     def univec(self):
         """
         Univec contamination search
         """
+        from genemethods.typingclasses.typingclasses import Univec
         univec = Univec(args=self,
                         analysistype='univec',
                         cutoff=80,
                         unique=True)
-        univec.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.blast_seekr(univec)
+        self.print_metadata()
 
+    @checkpoint
     def virulence(self):
         """
         Virulence gene detection
         """
+        from genemethods.geneseekr.blast import BLAST
         virulence = BLAST(args=self,
                           analysistype='virulence')
-        virulence.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.blast_seekr(virulence)
+        self.print_metadata()
 
     def typing(self):
         """
@@ -243,11 +357,15 @@ class Typing(object):
         # Calculate the presence/absence of GDCS
         self.run_gdcs()
 
+    @checkpoint
     def mlst_assembled(self):
         """
         Run rMLST analyses on assemblies
         """
-        if os.path.isfile(os.path.join(self.reportpath, 'mlst.csv')):
+        from genemethods.geneseekr.blast import BLAST
+        from genemethods.MLSTsippr.mlst import ReportParse
+        # Existing reports cannot be re-used in incremental mode, as they do not contain the new samples
+        if not self.incremental and os.path.isfile(os.path.join(self.reportpath, 'mlst.csv')):
             parse = ReportParse(args=self,
                                 analysistype='mlst')
             parse.report_parse()
@@ -257,25 +375,29 @@ class Typing(object):
                          analysistype='mlst',
                          cutoff=100,
                          genus_specific=True)
-            mlst.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+            self.blast_seekr(mlst)
+        self.print_metadata()
 
+    @checkpoint
     def ec_typer(self):
         """
         Assembly-based serotyping
         """
+        from genemethods.assemblypipeline.ec_typer import ECTyper
         ec = ECTyper(metadata=self.runmetadata,
                      report_path=self.reportpath,
                      assembly_path=os.path.join(self.path, 'BestAssemblies'),
                      threads=self.cpus,
                      logfile=self.logfile)
         ec.main()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def serosippr(self):
         """
         Serotyping analyses
         """
+        from genemethods.geneseekr.blast import BLAST
         #          pipeline=True)
         sero = BLAST(args=self,
                      analysistype='serosippr',
@@ -283,42 +405,52 @@ class Typing(object):
                      genus_specific=True,
                      unique=True)
         sero.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def legacy_vtyper(self):
         """
         Legacy vtyper - uses ePCR
         """
+        from genemethods.assemblypipeline.legacy_vtyper import Vtyper as LegacyVtyper
         legacy_vtyper = LegacyVtyper(inputobject=self,
                                      analysistype='legacy_vtyper',
                                      mismatches=2)
         legacy_vtyper.vtyper()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def coregenome(self):
         """
         Core genome calculation
         """
+        import genemethods.coreGenome.core as core
         coregen = core.CoreGenome(args=self,
                                   analysistype='coregenome',
                                   genus_specific=True)
         coregen.seekr()
         core.AnnotatedCore(inputobject=self)
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def sistr(self):
         """
         Sistr
         """
+        import genemethods.assemblypipeline.sistr as sistr
         sistr.Sistr(inputobject=self,
                     analysistype='sistr')
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def cgmlst_assembled(self):
         """
         Run rMLST analyses on assemblies
         """
-        if os.path.isfile(os.path.join(self.reportpath, 'cgmlst.csv')):
+        from genemethods.geneseekr.blast import BLAST
+        from genemethods.MLSTsippr.mlst import ReportParse
+        # Existing reports cannot be re-used in incremental mode, as they do not contain the new samples
+        if not self.incremental and os.path.isfile(os.path.join(self.reportpath, 'cgmlst.csv')):
             parse = ReportParse(args=self,
                                 analysistype='cgmlst')
             parse.report_parse()
@@ -327,24 +459,28 @@ class Typing(object):
                            analysistype='cgMLST',
                            cutoff=100,
                            genus_specific=True)
-            cgmlst.seekr()
-        metadataprinter.MetadataPrinter(inputobject=self)
+            self.blast_seekr(cgmlst)
+        self.print_metadata()
 
+    @checkpoint
     def run_gdcs(self):
         """
         Determine the presence of genomically-dispersed conserved sequences (genes from MLST, rMLST, and cgMLST
         analyses)
         """
+        from genemethods.typingclasses.typingclasses import GDCS
         # Run the GDCS analysis
         gdcs = GDCS(inputobject=self)
         gdcs.main()
-        metadataprinter.MetadataPrinter(inputobject=self)
+        self.print_metadata()
 
+    @checkpoint
     def typing_reports(self):
         """
         Create empty attributes for analyses that were not performed, so that the metadata report can be created
         :return:
         """
+        import genemethods.assemblypipeline.reporter as reporter
         for sample in self.runmetadata.samples:
             sample.confindr = GenObject()
             sample.mapping = GenObject()
@@ -371,13 +507,20 @@ class Typing(object):
         run_report.metadata_reporter()
         run_report.legacy_reporter()
 
-    def __init__(self, start, sequencepath, referencefilepath, scriptpath, debug):
+    def __init__(self, start, sequencepath, referencefilepath, scriptpath, debug, metadatainterval=0, blastcache=None,
+                 blastcachesize=0, incremental=False, trace=False):
         """
         
         :param start: 
         :param sequencepath: 
         :param referencefilepath: 
         :param scriptpath:
+        :param metadatainterval: Minimum number of seconds between writes of the sample metadata files
+        :param blastcache: Optional path of a folder in which to cache BLAST reports
+        :param blastcachesize: Maximum size in GB of the BLAST cache. 0 does not limit the size of the cache
+        :param incremental: Boolean of whether to only type the assemblies that are new or modified since the previous
+        run, and merge their results into the existing reports
+        :param trace: Boolean of whether to write a trace-event file of the stages and external commands
         """
         self.debug = debug
         SetupLogging(self.debug)
@@ -393,6 +536,8 @@ class Typing(object):
         self.start = self.starttime
         # Use the argument for the number of threads to use, or default to the number of cpus in the system
         self.cpus = multiprocessing.cpu_count() - 1
+        # Admit the external commands against the cores and memory of the system
+        self.resources = resources.configure(cores=self.cpus)
         # Assertions to ensure that the provided variables are valid
         assert os.path.isdir(self.sequencepath), 'Supplied path location is not a valid directory {0!r:s}'\
             .format(self.sequencepath)
@@ -400,6 +545,8 @@ class Typing(object):
         assert os.path.isdir(self.targetpath), 'Reference file path is not a valid directory {0!r:s}'\
             .format(self.targetpath)
         self.commit = __version__
+        # A reference database folder built as a bundle has all of its indexes prepared in advance
+        self.bundle = DatabaseBundle(self.reffilepath)
         self.homepath = scriptpath
         self.analysistype = 'assembly_typing'
         self.genus_specific = False
@@ -408,6 +555,154 @@ class Typing(object):
         # Initialise the metadata object
         self.metadata = list()
         self.runmetadata = MetadataObject()
+        # Writes the metadata files of the samples at most once per flush interval
+        self.metadata_writer = MetadataWriter(interval=metadatainterval)
+        # Optionally re-use the BLAST reports of assemblies that have been analysed previously
+        self.blastcache = BlastCache(path=os.path.abspath(os.path.expanduser(blastcache)),
+                                     maxsize=float(blastcachesize) * 1024 ** 3) if blastcache else None
+        # Measure the time, CPU, and memory used by each stage, and optionally trace the external commands
+        self.timer = StageTimer(trace=trace)
+        # Record of the hashes of the assemblies that have been typed, used by incremental runs
+        self.incremental = incremental
+        self.assembly_record = os.path.join(self.sequencepath, 'typed_assemblies.json')
+        self.previous_reports = dict()
+
+
+def assembly_hash(path):
+    """
+    Hash the contents of an assembly
+    :param path: Name and path of the assembly
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as assembly:
+        for block in iter(lambda: assembly.read(1048576), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(manifest):
+    """
+    Read the run folders listed in a manifest file. Each line contains the path of one run folder. Blank lines and lines
+    starting with # are ignored
+    :param manifest: Name and path of the manifest file
+    :return: List of the paths of the run folders
+    """
+    folders = list()
+    with open(manifest, 'r') as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                folders.append(line)
+    return folders
+
+
+def batches(runs):
+    """
+    Group run folders into batches that can be pooled into a single sample set. A batch may not contain two samples
+    with the same name, as the pooled reports are split back into runs by sample name
+    :param runs: Dictionary of run folder: list of the names of the samples in the run
+    :return: List of batches. Each batch is a list of run folders
+    """
+    groups = list()
+    for folder, names in runs.items():
+        for group, samplenames in groups:
+            # Add the run to the first batch that does not already have a sample with the same name
+            if not samplenames.intersection(names):
+                group.append(folder)
+                samplenames.update(names)
+                break
+        else:
+            groups.append(([folder], set(names)))
+    return [group for group, samplenames in groups]
+
+
+def run_samples(folder):
+    """
+    Find the names of the assemblies in a run folder. Uses the same naming as ObjectCreation
+    :param folder: Path of the run folder
+    :return: List of the sample names
+    """
+    return sorted(set(os.path.split(fasta)[1].split('.')[0] for fasta in glob(os.path.join(folder, '*.fa*'))))
+
+
+class BatchTyping(Typing):
+    """
+    Type the assemblies of many run folders as a single pooled sample set, so that the expensive analyses (BLAST,
+    mash, CLARK, MOB-suite, etc.) are run once for every sample rather than once per run. The outputs of each sample
+    remain in its run folder, and the pooled reports are split back into the reports folder of each run
+    """
+
+    def main(self):
+        """
+        Type the pooled samples, and split the reports into the runs
+        """
+        Typing.main(self)
+        self.split_reports()
+
+    def objects(self):
+        """
+        Create the metadata objects of the samples in every run folder, and pool them into a single sample set
+        """
+        from genemethods.assemblypipeline.createobject import ObjectCreation
+        self.runmetadata = MetadataObject()
+        self.runmetadata.samples = list()
+        for folder in self.runfolders:
+            # ObjectCreation only requires the sequence path and start time of the run
+            run = GenObject()
+            run.sequencepath = folder
+            run.start = self.start
+            for sample in ObjectCreation(inputobject=run).samples:
+                self.samplereports[sample.name] = os.path.join(folder, 'reports')
+                self.runmetadata.samples.append(sample)
+        logging.info('Pooled {samples} samples from {runs} runs'.format(samples=len(self.runmetadata.samples),
+                                                                        runs=len(self.runfolders)))
+        make_path(os.path.join(self.path, 'BestAssemblies'))
+        for sample in self.runmetadata.samples:
+            # Link the assemblies to the BestAssemblies folder - necessary for GenomeQAML
+            relative_symlink(sample.general.bestassemblyfile,
+                             os.path.join(self.path, 'BestAssemblies'))
+            # Create attributes required for downstream analyses
+            sample.general.trimmedcorrectedfastqfiles = [sample.general.bestassemblyfile]
+
+    def split_reports(self):
+        """
+        Split the pooled reports into the reports folder of each run
+        """
+        logging.info('Splitting reports into {num} runs'.format(num=len(self.runfolders)))
+        split_reports(reportpath=self.reportpath,
+                      samplereports=self.samplereports)
+
+    def __init__(self, start, runfolders, batchpath, referencefilepath, scriptpath, debug, metadatainterval=0,
+                 blastcache=None, blastcachesize=0, trace=False):
+        """
+        :param start: Start time of the analyses
+        :param runfolders: List of the paths of the run folders to pool
+        :param batchpath: Path of the folder in which to store the pooled reports and intermediate files
+        :param referencefilepath: Path of the folder containing the pipeline accessory files
+        :param scriptpath: Path of the folder containing this script
+        :param debug: Boolean of whether to enable debug mode
+        :param metadatainterval: Minimum number of seconds between writes of the sample metadata files
+        :param blastcache: Optional path of a folder in which to cache BLAST reports
+        :param blastcachesize: Maximum size in GB of the BLAST cache. 0 does not limit the size of the cache
+        :param trace: Boolean of whether to write a trace-event file of the stages and external commands
+        """
+        self.runfolders = [os.path.abspath(os.path.expanduser(folder)) for folder in runfolders]
+        for folder in self.runfolders:
+            assert os.path.isdir(folder), 'Supplied run folder is not a valid directory {0!r:s}'.format(folder)
+        make_path(batchpath)
+        # Dictionary of sample name: reports folder of the run of the sample
+        self.samplereports = dict()
+        Typing.__init__(self,
+                        start=start,
+                        sequencepath=os.path.abspath(os.path.expanduser(batchpath)),
+                        referencefilepath=referencefilepath,
+                        scriptpath=scriptpath,
+                        debug=debug,
+                        metadatainterval=metadatainterval,
+                        blastcache=blastcache,
+                        blastcachesize=blastcachesize,
+                        trace=trace)
 
 
 # If the script is called from the command line, then call the argument parser
@@ -419,8 +714,17 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--version',
                         action='version', version=__version__)
     parser.add_argument('-s', '--sequencepath',
-                        required=True,
                         help='Path to folder containing sequencing reads')
+    parser.add_argument('-R', '--runfolders',
+                        nargs='+',
+                        default=list(),
+                        help='Paths of run folders of assemblies to type as a single pooled batch. The reports of each '
+                             'run are written to the reports folder within the run folder')
+    parser.add_argument('-m', '--manifest',
+                        help='Name and path of a file listing the run folders to type as a pooled batch, one per line')
+    parser.add_argument('-o', '--batchpath',
+                        help='Path of the folder in which to store the pooled reports and intermediate files of the '
+                             'batch. Required with --runfolders or --manifest')
     parser.add_argument('-r', '--referencefilepath',
                         required=True,
                         help='Provide the location of the folder containing the pipeline accessory files (reference '
@@ -429,12 +733,58 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Enable debug mode for the pipeline (skip file deletion, and enable '
                              'debug-level messages if they exist)')
+    parser.add_argument('-M', '--metadatainterval',
+                        default=30,
+                        type=float,
+                        help='Minimum number of seconds between writes of the sample metadata .json files. All '
+                             'outstanding metadata are always written at the end of the run. Default is 30')
+    parser.add_argument('-B', '--blastcache',
+                        help='Path of a folder in which to cache BLAST reports. Assemblies that have previously been '
+                             'analysed against the same database re-use the cached reports rather than running BLAST')
+    parser.add_argument('-Z', '--blastcachesize',
+                        default=50,
+                        type=float,
+                        help='Maximum size in GB of the BLAST cache. The least recently used reports are removed once '
+                             'the cache is larger than this size. Default is 50')
+    parser.add_argument('-i', '--incremental',
+                        action='store_true',
+                        help='Only type the assemblies that are new or modified since the previous run on the sequence '
+                             'path, and merge their results into the existing reports')
+    parser.add_argument('-T', '--trace',
+                        action='store_true',
+                        help='Write a trace of the stages and external commands of the run to pipeline_trace.json in '
+                             'the reports folder, which can be opened in Perfetto or chrome://tracing')
     arguments = parser.parse_args()
-    # Run the pipeline
-    pipeline = Typing(start=time(),
-                      sequencepath=arguments.sequencepath,
-                      referencefilepath=arguments.referencefilepath,
-                      scriptpath=homepath,
-                      debug=arguments.debug)
-    pipeline.main()
+    runfolders = arguments.runfolders + (read_manifest(arguments.manifest) if arguments.manifest else list())
+    if runfolders:
+        if not arguments.batchpath:
+            parser.error('--batchpath is required with --runfolders or --manifest')
+        # Runs with samples of the same name cannot share a batch, so they are typed in separate batches
+        for num, batch in enumerate(batches({folder: run_samples(folder) for folder in runfolders})):
+            pipeline = BatchTyping(start=time(),
+                                   runfolders=batch,
+                                   batchpath=os.path.join(arguments.batchpath, 'batch_{num}'.format(num=num)),
+                                   referencefilepath=arguments.referencefilepath,
+                                   scriptpath=homepath,
+                                   debug=arguments.debug,
+                                   metadatainterval=arguments.metadatainterval,
+                                   blastcache=arguments.blastcache,
+                                   blastcachesize=arguments.blastcachesize,
+                                   trace=arguments.trace)
+            pipeline.main()
+    elif arguments.sequencepath:
+        # Run the pipeline
+        pipeline = Typing(start=time(),
+                          sequencepath=arguments.sequencepath,
+                          referencefilepath=arguments.referencefilepath,
+                          scriptpath=homepath,
+                          debug=arguments.debug,
+                          metadatainterval=arguments.metadatainterval,
+                          blastcache=arguments.blastcache,
+                          blastcachesize=arguments.blastcachesize,
+                          incremental=arguments.incremental,
+                          trace=arguments.trace)
+        pipeline.main()
+    else:
+        parser.error('One of --sequencepath, --runfolders, or --manifest is required')
     logging.info('Characterisation complete')
@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+from olctools.accessoryFunctions.accessoryFunctions import GenObject, MetadataObject, SetupLogging, make_path
+from cowbat.validation.validate_cowbat import ValidateCowbat
+from cowbat.metagenomefilter.filtermetagenome import FilterGenome
+from cowbat.pipelinetools.metadatawriter import MetadataWriter
+from cowbat.pipelinetools.stagetimer import StageTimer
+from cowbat.metagenomefilter.automateCLARK import CLARK
+from cowbat.get.get_rmlst import Get
+from argparse import ArgumentParser
+import multiprocessing
+import logging
+import random
+import subprocess
+import shutil
+import json
+import time
+import sys
+import os
+__author__ = 'adamkoziol'
+
+
+class SyntheticData(object):
+    """
+    Create reproducible synthetic inputs for the benchmarks: FASTQ reads with CLARK-style assignment and abundance files,
+    assemblies with contig classifications, allele files, and typing reports
+    """
+
+    def reads(self):
+        """
+        Create a .fastq file of reads for each sample, with the CLARK assignment and abundance .csv files of the reads
+        :return: List of the metadata objects of the samples
+        """
+        samples = list()
+        for num in range(self.samples):
+            sample = self.sample('reads', num)
+            sample.general.combined = os.path.join(sample.general.outputdirectory,
+                                                   '{sn}.fastq'.format(sn=sample.name))
+            sample.general.classification = os.path.join(sample.general.outputdirectory,
+                                                         '{sn}.csv'.format(sn=sample.name))
+            sample.general.abundance = os.path.join(sample.general.outputdirectory,
+                                                    '{sn}_abundance.csv'.format(sn=sample.name))
+            counts = [0] * self.taxa
+            with open(sample.general.combined, 'w') as fastq, open(sample.general.classification, 'w') as assignment:
+                assignment.write('Object_ID, Length, Assignment\n')
+                for read in range(self.readcount):
+                    name = '{sn}_read{num}'.format(sn=sample.name,
+                                                   num=read)
+                    fastq.write('@{name} 1:N:0\n{seq}\n+\n{qual}\n'.format(name=name,
+                                                                            seq=self.sequence(self.readlength),
+                                                                            qual='I' * self.readlength))
+                    taxon = self.taxon()
+                    counts[taxon] += 1
+                    assignment.write('{name},{length},{taxid}\n'.format(name=name,
+                                                                        length=self.readlength,
+                                                                        taxid=self.taxid(taxon)))
+            self.abundance(sample.general.abundance, counts)
+            samples.append(sample)
+        return samples
+
+    def assemblies(self):
+        """
+        Create the CLARK classification and abundance .csv files of the contigs of an assembly for each sample
+        :return: List of the metadata objects of the samples
+        """
+        samples = list()
+        for num in range(self.samples):
+            sample = self.sample('assemblies', num)
+            sample.general.classification = os.path.join(sample.general.outputdirectory,
+                                                         '{sn}.csv'.format(sn=sample.name))
+            sample.general.abundance = os.path.join(sample.general.outputdirectory,
+                                                    '{sn}_abundance.csv'.format(sn=sample.name))
+            counts = [0] * self.taxa
+            with open(sample.general.classification, 'w') as classification:
+                classification.write('Object_ID, Length, Assignment\n')
+                for contig in range(self.contigs):
+                    taxon = self.taxon()
+                    counts[taxon] += 1
+                    classification.write('contig{num},{length},{taxid}\n'.format(num=contig,
+                                                                                 length=self.random.randint(200,
+                                                                                                            200000),
+                                                                                 taxid=self.taxid(taxon)))
+            self.abundance(sample.general.abundance, counts)
+            samples.append(sample)
+        return samples
+
+    def alleles(self):
+        """
+        Create allele files in the format of the rMLST database, with gaps and Ns in the sequences
+        :return: Path of the folder of allele files, and a list of the allele files
+        """
+        allelepath = os.path.join(self.path, 'alleles')
+        make_path(allelepath)
+        alleles = list()
+        for locus in range(self.loci):
+            allele = os.path.join(allelepath, 'BACT{num:06d}.tfa'.format(num=locus + 1))
+            with open(allele, 'w') as tfa:
+                for num in range(self.allelecount):
+                    sequence = list(self.sequence(600))
+                    for position in self.random.sample(range(600), 6):
+                        sequence[position] = self.random.choice('-N')
+                    tfa.write('>BACT{locus:06d}-{num}\n{seq}\n'.format(locus=locus + 1,
+                                                                       num=num + 1,
+                                                                       seq=''.join(sequence)))
+            alleles.append(allele)
+        return allelepath, alleles
+
+    def reports(self):
+        """
+        Create a reference and a test version of a typing report with a row for each sample
+        :return: Names and paths of the reference and test reports
+        """
+        reportpath = os.path.join(self.path, 'reports')
+        make_path(reportpath)
+        rows = ['Strain,Genus,SequenceType,Matches,Gene1,Gene2,Gene3\n']
+        for num in range(self.reportrows):
+            rows.append('sample{num},Escherichia,{st},53,{a},{b},{c}\n'.format(num=num,
+                                                                                 st=self.random.randint(1, 10000),
+                                                                                 a=self.random.randint(1, 500),
+                                                                                 b=self.random.randint(1, 500),
+                                                                                 c=self.random.randint(1, 500)))
+        reports = list()
+        for name in ['reference.csv', 'test.csv']:
+            reports.append(os.path.join(reportpath, name))
+            with open(reports[-1], 'w') as report:
+                report.write(''.join(rows))
+        return reports
+
+    def sample(self, dataset, num):
+        """
+        Create the metadata object and output directory of a synthetic sample
+        :param dataset: Name of the dataset e.g. reads
+        :param num: Number of the sample
+        :return: Metadata object of the sample
+        """
+        sample = MetadataObject()
+        sample.name = 'sample{num}'.format(num=num)
+        sample.general = GenObject()
+        sample.general.outputdirectory = os.path.join(self.path, dataset, sample.name)
+        make_path(sample.general.outputdirectory)
+        return sample
+
+    def abundance(self, abundancefile, counts):
+        """
+        Write a CLARK abundance .csv file
+        :param abundancefile: Name and path of the file to create
+        :param counts: List of the number of reads or contigs assigned to each taxon
+        """
+        total = sum(counts)
+        with open(abundancefile, 'w') as abundance:
+            abundance.write('Name,TaxID,Lineage,Count,Proportion_All(%),Proportion_Classified(%)\n')
+            for taxon, count in enumerate(counts):
+                proportion = 100 * count / total if total else 0
+                abundance.write('Species {num},{taxid},Bacteria;Proteobacteria;Genus {num},{count},{prop:.2f},'
+                                '{prop:.2f}\n'.format(num=taxon,
+                                                      taxid=self.taxid(taxon),
+                                                      count=count,
+                                                      prop=proportion))
+            abundance.write('UNKNOWN,UNKNOWN,0,0,0\n')
+
+    def taxon(self):
+        # The first taxa are much more abundant than the others, as in a contaminated isolate
+        return min(int(self.random.expovariate(1)), self.taxa - 1)
+
+    @staticmethod
+    def taxid(taxon):
+        return str(1000 + taxon)
+
+    def sequence(self, length):
+        return ''.join(self.random.choices('ACGT', k=length))
+
+    def __init__(self, path, samples, reads, contigs, taxa, loci=50, alleles=20, reportrows=2000, readlength=100,
+                 seed=1):
+        """
+        :param path: Path of the folder in which to create the data
+        :param samples: Number of samples
+        :param reads: Number of reads per sample
+        :param contigs: Number of contigs per assembly
+        :param taxa: Number of taxa to which reads and contigs are assigned
+        :param loci: Number of allele files
+        :param alleles: Number of alleles per allele file
+        :param reportrows: Number of rows in the typing reports
+        :param readlength: Length of the reads
+        :param seed: Seed of the random number generator, so that the same data are created every time
+        """
+        self.path = path
+        make_path(self.path)
+        self.samples = samples
+        self.readcount = reads
+        self.contigs = contigs
+        self.taxa = taxa
+        self.loci = loci
+        self.allelecount = alleles
+        self.reportrows = reportrows
+        self.readlength = readlength
+        self.random = random.Random(seed)
+
+
+class Benchmark(object):
+    """
+    Measure the throughput and memory of the Python-side hot paths of the pipeline on synthetic data, and compare the
+    results against stored baselines
+    """
+
+    def main(self):
+        """
+        Run the benchmarks, and compare them to the baselines
+        :return: True if no benchmark regressed
+        """
+        for name in self.benchmarks:
+            logging.info('Running {name} benchmark'.format(name=name))
+            try:
+                getattr(self, name)()
+            except Exception as error:
+                # A benchmark that cannot run is a failure, but the remaining benchmarks are still run
+                logging.error('{name} benchmark failed: {error!r}'.format(name=name,
+                                                                         error=error))
+                self.failures.append(name)
+        self.report()
+        # Budgets are absolute limits, so they apply whether or not there is a comparable baseline
+        for message in self.over_budget:
+            logging.error(message)
+        if self.update:
+            self.write_baseline()
+            return not self.failures and not self.over_budget
+        return self.compare() and not self.failures and not self.over_budget
+
+    def filter_genome(self):
+        """
+        Index the read assignments and demultiplex the reads with FilterGenome
+        """
+        samples = self.data.reads()
+        pipeline = GenObject()
+        pipeline.start = time.time()
+        pipeline.path = self.path
+        pipeline.sequencepath = self.path
+        pipeline.datapath = None
+        pipeline.reportpath = os.path.join(self.path, 'reports')
+        pipeline.cpus = self.cpus
+        pipeline.cutoff = 0.01
+        pipeline.runmetadata = MetadataObject()
+        pipeline.runmetadata.samples = samples
+        with self.measure('filter_genome', items=self.data.samples * self.data.readcount, unit='reads'):
+            FilterGenome(pipeline).objectprep()
+
+    def clark_reports(self):
+        """
+        Create the CLARK report of the classified contigs of the assemblies
+        """
+        samples = self.data.assemblies()
+        clark = CLARK.__new__(CLARK)
+        clark.extension = 'fasta'
+        clark.cutoff = 0.01
+        clark.reportpath = os.path.join(self.path, 'reports')
+        clark.report = os.path.join(clark.reportpath, 'abundance_fasta.xlsx')
+        clark.runmetadata = MetadataObject()
+        clark.runmetadata.samples = samples
+        with self.measure('clark_reports', items=self.data.samples * self.data.contigs, unit='contigs'):
+            clark.reports()
+
+    def combine_alleles(self):
+        """
+        Combine the allele files into the combined rMLST allele file
+        """
+        allelepath, alleles = self.data.alleles()
+        get = Get.__new__(Get)
+        get.start = time.time()
+        with self.measure('combine_alleles', items=self.data.loci * self.data.allelecount, unit='alleles'):
+            get.combinealleles(allelepath, alleles)
+
+    def metadata_printing(self):
+        """
+        Write the metadata of the samples to file, and then write them again without changes
+        """
+        samples = [self.data.sample('metadata', num) for num in range(self.metadatasamples)]
+        for sample in samples:
+            # Populate attributes resembling the output of the typing stages
+            for analysis in ['rmlst', 'mlst', 'resfinder_assembled', 'mash', 'quality_features_polished']:
+                setattr(sample, analysis, GenObject())
+                sample[analysis].results = {'gene{num}'.format(num=num): 100.0 for num in range(50)}
+                sample[analysis].reportdir = os.path.join(sample.general.outputdirectory, analysis)
+        writer = MetadataWriter()
+        with self.measure('metadata_printing', items=2 * len(samples), unit='samples'):
+            writer.write(samples=samples,
+                         force=True)
+            writer.write(samples=samples,
+                         force=True)
+
+    def report_validation(self):
+        """
+        Validate a test report against a reference report
+        """
+        reference, test = self.data.reports()
+        with self.measure('report_validation', items=self.data.reportrows, unit='rows'):
+            ValidateCowbat.validate_report(reference_report=reference,
+                                           test_report=test,
+                                           columns_to_exclude=['Strain'],
+                                           identifying_column='Strain')
+
+    def startup(self):
+        """
+        Launch the command line scripts of the pipeline with --help, which imports their modules and parses the
+        arguments, and check that the median launch of each script is within the startup budget
+        """
+        cowbatpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        scripts = [os.path.join(cowbatpath, script) for script in ['assembly_pipeline.py', 'assembly_typing.py']]
+        # Import the cowbat package of this tree, whether or not the package is installed
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join([os.path.dirname(cowbatpath)] +
+                                                    ([environment['PYTHONPATH']] if 'PYTHONPATH' in environment
+                                                     else list()))
+        launches = dict()
+        with self.measure('startup', items=len(scripts) * self.launches, unit='launches'):
+            for script in scripts:
+                for launch in range(self.launches):
+                    started = time.perf_counter()
+                    subprocess.run([sys.executable, script, '--help'],
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL,
+                                   env=environment,
+                                   check=True)
+                    launches.setdefault(script, list()).append(time.perf_counter() - started)
+        for script, times in launches.items():
+            median = sorted(times)[len(times) // 2]
+            logging.info('{script:<20}{median:>8.2f} s startup'.format(script=os.path.basename(script),
+                                                                       median=median))
+            if median > self.startup_budget:
+                self.over_budget.append('{script} startup time {median:.2f} s is above the budget of {budget:.2f} s'
+                                        .format(script=os.path.basename(script),
+                                                median=median,
+                                                budget=self.startup_budget))
+
+    def measure(self, name, items, unit):
+        """
+        Measure a benchmark, and record its throughput once it completes
+        :param name: Name of the benchmark
+        :param items: Number of items processed by the benchmark
+        :param unit: Name of the items e.g. reads
+        :return: Context manager of the measurement
+        """
+        self.items[name] = (items, unit)
+        return self.timer.measure(name=name)
+
+    def report(self):
+        """
+        Calculate the throughput of each benchmark, write the results to benchmark.json, and log them
+        """
+        for measurement in self.timer.measurements:
+            # Failed benchmarks do not have meaningful results
+            if measurement['stage'] in self.failures:
+                continue
+            items, unit = self.items[measurement['stage']]
+            self.results[measurement['stage']] = {
+                'throughput': items / measurement['wall'] if measurement['wall'] else 0,
+                'unit': '{unit}/s'.format(unit=unit),
+                'wall': measurement['wall'],
+                'cpu': measurement['user_cpu'] + measurement['system_cpu'],
+                'peak_rss_mb': measurement['peak_rss'] / 1024 ** 2}
+        for name, result in self.results.items():
+            logging.info('{name:<20}{throughput:>14.1f} {unit:<12}{wall:>8.2f} s{rss:>10.1f} MB'
+                         .format(name=name,
+                                 throughput=result['throughput'],
+                                 unit=result['unit'],
+                                 wall=result['wall'],
+                                 rss=result['peak_rss_mb']))
+        with open(os.path.join(self.path, 'benchmark.json'), 'w') as results:
+            json.dump({'scale': self.scale, 'results': self.results}, results, sort_keys=True, indent=4,
+                      separators=(',', ': '))
+
+    def compare(self):
+        """
+        Compare the results to the baselines. A benchmark regresses if its throughput is lower, or its peak memory is
+        higher, than its baseline by more than the tolerance
+        :return: True if no benchmark regressed
+        """
+        try:
+            with open(self.baseline, 'r') as baseline_file:
+                baseline = json.load(baseline_file)
+        except FileNotFoundError:
+            logging.warning('No baseline found at {baseline}; run with --update to create it'
+                            .format(baseline=self.baseline))
+            return True
+        if baseline['scale'] != self.scale:
+            logging.warning('The baseline was created with a different scale; the results cannot be compared')
+            return True
+        regressions = list()
+        for name, result in self.results.items():
+            try:
+                expected = baseline['results'][name]
+            except KeyError:
+                continue
+            if result['throughput'] < expected['throughput'] * (1 - self.tolerance):
+                regressions.append('{name} throughput {found:.1f} {unit} is below the baseline of {expected:.1f}'
+                                   .format(name=name,
+                                           found=result['throughput'],
+                                           unit=result['unit'],
+                                           expected=expected['throughput']))
+            if result['peak_rss_mb'] > expected['peak_rss_mb'] * (1 + self.tolerance):
+                regressions.append('{name} peak memory {found:.1f} MB is above the baseline of {expected:.1f} MB'
+                                   .format(name=name,
+                                           found=result['peak_rss_mb'],
+                                           expected=expected['peak_rss_mb']))
+        for regression in regressions:
+            logging.error(regression)
+        return not regressions
+
+    def write_baseline(self):
+        """
+        Store the results as the new baseline. The baselines of benchmarks that were not run are kept if the existing
+        baseline was created at the same scale
+        """
+        results = dict()
+        try:
+            with open(self.baseline, 'r') as baseline_file:
+                baseline = json.load(baseline_file)
+            if baseline['scale'] == self.scale:
+                results = baseline['results']
+        except FileNotFoundError:
+            pass
+        results.update(self.results)
+        with open(self.baseline, 'w') as baseline_file:
+            json.dump({'scale': self.scale, 'results': results}, baseline_file, sort_keys=True, indent=4,
+                      separators=(',', ': '))
+        logging.info('Updated baseline {baseline}'.format(baseline=self.baseline))
+
+    def __init__(self, path, baseline, samples=4, reads=50000, contigs=50000, taxa=20, loci=100, alleles=100,
+                 metadatasamples=2000, reportrows=20000, cpus=None, tolerance=0.3, update=False, benchmarks=None,
+                 launches=5, startup_budget=1.0):
+        """
+        :param path: Path of the folder in which to create the synthetic data and the results
+        :param baseline: Name and path of the .json file of the baseline results
+        :param samples: Number of samples of reads and assemblies
+        :param reads: Number of reads per sample
+        :param contigs: Number of contigs per assembly
+        :param taxa: Number of taxa to which reads and contigs are assigned
+        :param loci: Number of allele files to combine
+        :param alleles: Number of alleles per allele file
+        :param metadatasamples: Number of samples of which to write the metadata
+        :param reportrows: Number of rows in the validated reports
+        :param cpus: Number of processes to use. Default is the number of cpus in the system
+        :param tolerance: Fraction by which results may be worse than the baseline before they are regressions
+        :param update: Boolean of whether to store the results as the new baseline
+        :param benchmarks: Optional list of the names of the benchmarks to run. Default is all benchmarks
+        :param launches: Number of times each script is launched by the startup benchmark
+        :param startup_budget: Maximum median number of seconds for a script to import its modules and parse its
+        arguments
+        """
+        self.path = os.path.abspath(path)
+        self.baseline = os.path.abspath(baseline)
+        self.cpus = cpus if cpus else multiprocessing.cpu_count()
+        self.tolerance = tolerance
+        self.update = update
+        self.launches = launches
+        self.startup_budget = startup_budget
+        self.metadatasamples = metadatasamples
+        # The parameters that determine the results; baselines can only be compared at the same scale
+        self.scale = {'samples': samples, 'reads': reads, 'contigs': contigs, 'taxa': taxa, 'loci': loci,
+                      'alleles': alleles, 'metadatasamples': metadatasamples, 'reportrows': reportrows}
+        self.benchmarks = benchmarks if benchmarks else ['filter_genome', 'clark_reports', 'combine_alleles',
+                                                         'metadata_printing', 'report_validation', 'startup']
+        self.data = SyntheticData(path=os.path.join(self.path, 'data'),
+                                  samples=samples,
+                                  reads=reads,
+                                  contigs=contigs,
+                                  taxa=taxa,
+                                  loci=loci,
+                                  alleles=alleles,
+                                  reportrows=reportrows)
+        self.timer = StageTimer(interval=0.1)
+        # Dictionary of benchmark name: (number of items, unit)
+        self.items = dict()
+        self.results = dict()
+        self.failures = list()
+        # Messages of the results that exceed their budgets
+        self.over_budget = list()
+
+
+if __name__ == '__main__':
+    # Extract the path of the current script from the full path + file name
+    homepath = os.path.split(os.path.abspath(__file__))[0]
+    # Parser for arguments
+    parser = ArgumentParser(description='Benchmark the Python components of the COWBAT pipeline on synthetic data')
+    parser.add_argument('-p', '--path',
+                        required=True,
+                        help='Path of the folder in which to create the synthetic data and the results')
+    parser.add_argument('-b', '--baseline',
+                        default=os.path.join(homepath, 'baseline.json'),
+                        help='Name and path of the baseline results. Default is baseline.json in the folder of this '
+                             'script')
+    parser.add_argument('-u', '--update',
+                        action='store_true',
+                        help='Store the results as the new baseline rather than comparing them to the baseline')
+    parser.add_argument('-n', '--samples',
+                        default=4,
+                        type=int,
+                        help='Number of samples. Default is 4')
+    parser.add_argument('-r', '--reads',
+                        default=50000,
+                        type=int,
+                        help='Number of reads per sample. Default is 50000')
+    parser.add_argument('-c', '--contigs',
+                        default=50000,
+                        type=int,
+                        help='Number of contigs per assembly. Default is 50000')
+    parser.add_argument('-x', '--taxa',
+                        default=20,
+                        type=int,
+                        help='Number of taxa to which reads and contigs are assigned. Default is 20')
+    parser.add_argument('-t', '--threads',
+                        type=int,
+                        help='Number of processes. Default is the number of cpus in the system')
+    parser.add_argument('-l', '--tolerance',
+                        default=0.3,
+                        type=float,
+                        help='Fraction by which a result may be worse than the baseline before it fails. Default is '
+                             '0.3')
+    parser.add_argument('-s', '--startupbudget',
+                        default=1.0,
+                        type=float,
+                        help='Maximum median number of seconds for the pipeline scripts to start (import their modules '
+                             'and parse their arguments). Default is 1.0')
+    parser.add_argument('-k', '--keep',
+                        action='store_true',
+                        help='Keep the synthetic data once the benchmarks are complete')
+    parser.add_argument('benchmarks',
+                        nargs='*',
+                        help='Names of the benchmarks to run. Default is all: filter_genome, clark_reports, '
+                             'combine_alleles, metadata_printing, report_validation, startup')
+    arguments = parser.parse_args()
+    SetupLogging()
+    benchmark = Benchmark(path=arguments.path,
+                          baseline=arguments.baseline,
+                          samples=arguments.samples,
+                          reads=arguments.reads,
+                          contigs=arguments.contigs,
+                          taxa=arguments.taxa,
+                          cpus=arguments.threads,
+                          tolerance=arguments.tolerance,
+                          update=arguments.update,
+                          benchmarks=arguments.benchmarks,
+                          startup_budget=arguments.startupbudget)
+    passed = benchmark.main()
+    if not arguments.keep:
+        shutil.rmtree(benchmark.data.path)
+    if not passed:
+        logging.error('Benchmark failures or regressions detected')
+        sys.exit(1)
+    logging.info('Benchmarks complete')
@@ -9,10 +9,16 @@ All rights reserved.
 """
 
 from argparse import ArgumentParser
-import xml.dom.minidom as xml
-import urllib.request as url
+from xml.etree import ElementTree
 from urllib.parse import urlparse
 from olctools.accessoryFunctions.accessoryFunctions import make_path
+from cowbat.get.manifest import Manifest
+from threading import Event, Lock, Thread
+from queue import Queue
+import requests
+import calendar
+import shutil
+import time
 import os
 
 '''
@@ -30,6 +36,15 @@ xml file, the script simply reports the possible matches so the user can
 try again.
 '''
 
+# As there are multiple profiles for certain organisms, this dictionary has the schemes I use as values
+organismdictionary = {'Escherichia': 'Escherichia coli#1',
+                      'Vibrio': 'Vibrio parahaemolyticus',
+                      'Campylobacter': 'Campylobacter jejuni',
+                      'Listeria': 'Listeria monocytogenes',
+                      'Bacillus': 'Bacillus cereus',
+                      'Staphylococcus': "Staphylococcus aureus",
+                      'Salmonella': 'Salmonella enterica'}
+
 
 def parse_args():
     parser = ArgumentParser(description='Download MLST datasets by species'
@@ -42,9 +57,32 @@ def parse_args():
 
     parser.add_argument('--genus',
                         metavar='NAME',
-                        required=True,
                         help='The name of the species that you want to download (e.g. "Escherichia")')
 
+    parser.add_argument('--sync',
+                        action='store_true',
+                        help='Update the schemes of several genera in one run. Each scheme is stored in a folder named '
+                             'after its genus within --path')
+
+    parser.add_argument('--genera',
+                        metavar='NAME',
+                        nargs='+',
+                        help='Genera to update with --sync. Default is all the genera with a preferred scheme: {genera}'
+                        .format(genera=', '.join(sorted(organismdictionary))))
+
+    parser.add_argument('--schemes',
+                        metavar='NUM',
+                        default=2,
+                        type=int,
+                        help='Number of schemes to update concurrently with --sync. Default is 2')
+
+    parser.add_argument('--index_age',
+                        metavar='HOURS',
+                        default=24,
+                        type=float,
+                        help='Re-use the cached repository index without checking the server if it was checked within '
+                             'this many hours. Default is 24')
+
     parser.add_argument('--force_scheme_name',
                         action="store_true",
                         default=False,
@@ -55,21 +93,28 @@ def parse_args():
                         default=os.getcwd(),
                         help='Path in which to store the downloaded alleles and profiles')
 
-    return parser.parse_args()
+    parser.add_argument('--threads',
+                        metavar='NUM',
+                        default=4,
+                        type=int,
+                        help='Number of loci to download concurrently. Default is 4')
 
+    parser.add_argument('--retries',
+                        metavar='NUM',
+                        default=3,
+                        type=int,
+                        help='Number of times to retry a failed download. Default is 3')
 
-# test if a node is an Element and that it has a specific tag name
-def testelementtag(node, name):
-    return node.nodeType == node.ELEMENT_NODE and node.localName == name
+    parser.add_argument('--timeout',
+                        metavar='SECONDS',
+                        default=300,
+                        type=float,
+                        help='Number of seconds to wait for the server to respond to a download. Default is 300')
 
-
-# Get the text from an element node with a text node child
-def gettext(element):
-    result = ''
-    for node in element.childNodes:
-        if node.nodeType == node.TEXT_NODE:
-            result += node.data
-    return normalisetext(result)
+    args = parser.parse_args()
+    if not args.genus and not args.sync:
+        parser.error('Either --genus or --sync is required')
+    return args
 
 
 # remove unwanted whitespace including linebreaks etc.
@@ -94,41 +139,239 @@ class LocusInfo(object):
         self.name = None
 
 
-# retrieve the interesting information for a given sample element
-def getspeciesinfo(species_node, species, exact):
-    this_name = gettext(species_node)
-    store = False
-    if exact:
-        if this_name == species:
-            store = True
-    else:
-        if this_name.startswith(species):
-            store = True
-    if store:
-        info = SpeciesInfo()
-        info.name = this_name
-        for mlst_node in species_node.getElementsByTagName('mlst'):
-            for database_node in mlst_node.getElementsByTagName('database'):
-                for database_child_node in database_node.childNodes:
-                    if testelementtag(database_child_node, 'url'):
-                        info.database_url = gettext(database_child_node)
-                    elif testelementtag(database_child_node, 'retrieved'):
-                        info.retrieved = gettext(database_child_node)
-                    elif testelementtag(database_child_node, 'profiles'):
-                        for profile_count in database_child_node.getElementsByTagName('count'):
-                            info.profiles_count = gettext(profile_count)
-                        for profile_url in database_child_node.getElementsByTagName('url'):
-                            info.profiles_url = gettext(profile_url)
-                    elif testelementtag(database_child_node, 'loci'):
-                        for locus_node in database_child_node.getElementsByTagName('locus'):
-                            locus_info = LocusInfo()
-                            locus_info.name = gettext(locus_node)
-                            for locus_url in locus_node.getElementsByTagName('url'):
-                                locus_info.url = gettext(locus_url)
-                            info.loci.append(locus_info)
-        return info
-    else:
-        return None
+class LocusFetcher(object):
+    """
+    Download the loci of a scheme with a bounded number of threads, each with its own persistent session. Each locus is
+    streamed to its file, and the locus files are streamed into the combined allele file in the order of the scheme as
+    soon as they (and the loci preceding them) are complete, so the memory used does not depend on the size of the
+    scheme
+    """
+
+    def main(self):
+        """
+        Download the loci and create the combined allele file
+        :return: True if any locus was new or changed
+        """
+        for _ in range(min(self.threads, len(self.loci))):
+            # Send the threads to the appropriate destination function
+            threads = Thread(target=self.fetch, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
+        for index in range(len(self.loci)):
+            self.queue.put(index)
+        self.combine()
+        self.queue.join()
+        if self.failed:
+            raise IOError('Failed to download {loci}'.format(loci=', '.join(self.failed)))
+        return self.changed
+
+    def fetch(self):
+        with requests.Session() as session:
+            while True:
+                index = self.queue.get()
+                url, path = self.loci[index]
+                try:
+                    if self.download(session, url, path):
+                        with self.lock:
+                            self.changed = True
+                except Exception as error:
+                    print('Failed to download {url}: {error!r}'.format(url=url,
+                                                                      error=error))
+                    with self.lock:
+                        self.failed.append(os.path.basename(path))
+                finally:
+                    self.complete[index].set()
+                    self.queue.task_done()
+
+    def download(self, session, url, path):
+        """
+        Download a locus, retrying failed downloads. A retried download resumes from the data already received
+        :param session: requests session of the thread
+        :param url: URL of the locus
+        :param path: Name and path of the locus file
+        :return: True if the locus was new or changed
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return self.manifest.download(session, url, path, timeout=self.timeout)
+            except (requests.RequestException, IOError):
+                if attempt == self.retries:
+                    raise
+                # Wait a little longer after each failed attempt
+                time.sleep(2 ** attempt)
+
+    def combine(self):
+        """
+        Stream the locus files into a temporary combined file in the order of the scheme as they are completed, and
+        replace the combined file if any locus changed
+        """
+        temporary = self.combined + '.tmp'
+        with open(temporary, 'wb') as combined:
+            for index, (url, path) in enumerate(self.loci):
+                self.complete[index].wait()
+                if self.failed:
+                    continue
+                with open(path, 'rb') as locus:
+                    shutil.copyfileobj(locus, combined, 1024 * 1024)
+        if not self.failed and (self.changed or not os.path.isfile(self.combined)):
+            os.replace(temporary, self.combined)
+        else:
+            os.remove(temporary)
+
+    def __init__(self, loci, combined, manifest, threads=4, retries=3, timeout=300):
+        """
+        :param loci: List of (URL, name and path of the locus file) of the loci in the order of the scheme
+        :param combined: Name and path of the combined allele file
+        :param manifest: Manifest object of the scheme folder
+        :param threads: Maximum number of concurrent downloads
+        :param retries: Number of times to retry a failed download
+        :param timeout: Number of seconds to wait for the server to respond to a download
+        """
+        self.loci = loci
+        self.combined = combined
+        self.manifest = manifest
+        self.threads = max(1, threads)
+        self.retries = retries
+        self.timeout = timeout
+        self.queue = Queue()
+        self.lock = Lock()
+        # Set once the download of each locus has finished (successfully or not)
+        self.complete = [Event() for _ in loci]
+        self.changed = False
+        self.failed = list()
+
+
+def fetch_index(repository_url, path, max_age=24, timeout=300):
+    """
+    Cache the repository index in the folder. The server is only asked for the index if the cached copy was checked
+    more than max_age hours ago, and the index is only downloaded again if it has changed
+    :param repository_url: URL of the repository index (dbases.xml)
+    :param path: Path of the folder in which to cache the index
+    :param max_age: Number of hours for which the cached index is used without checking the server
+    :param timeout: Number of seconds to wait for the server to respond
+    :return: Name and path of the cached index, and the date on which it was retrieved
+    """
+    make_path(path)
+    indexfile = os.path.join(path, 'dbases.xml')
+    manifest = Manifest(path)
+    entry = manifest.entries.get('dbases.xml', dict())
+    try:
+        age = time.time() - calendar.timegm(time.strptime(entry['checked'], '%Y-%m-%dT%H:%M:%SZ'))
+    except KeyError:
+        age = None
+    if not os.path.isfile(indexfile) or entry.get('url') != repository_url or age is None or age > max_age * 3600:
+        with requests.Session() as session:
+            manifest.download(session, repository_url, indexfile, timeout=timeout)
+        manifest.write()
+        entry = manifest.entries['dbases.xml']
+    return indexfile, entry['retrieved']
+
+
+def parse_index(indexfile, queries):
+    """
+    Find the species matching each query in the repository index. The index is parsed once with a streaming parser,
+    and each species is discarded once it has been checked
+    :param indexfile: Name and path of the repository index
+    :param queries: Dictionary of query name: (species name, boolean of whether the species name must match exactly
+    rather than being the start of the name)
+    :return: Dictionary of query name: list of SpeciesInfo objects of the matching species
+    """
+    found = {query: list() for query in queries}
+    for event, element in ElementTree.iterparse(indexfile, events=('end',)):
+        if element.tag != 'species':
+            continue
+        name = normalisetext(element.text or str())
+        for query, (species, exact) in queries.items():
+            if (exact and name == species) or (not exact and name.startswith(species)):
+                found[query].append(getspeciesinfo(element, name))
+        element.clear()
+    return found
+
+
+def elementtext(element):
+    # Get the normalised text of an element, or None if the element is missing
+    return normalisetext(element.text or str()) if element is not None else None
+
+
+# retrieve the interesting information for a given species element
+def getspeciesinfo(species_element, name):
+    info = SpeciesInfo()
+    info.name = name
+    for database in species_element.iterfind('mlst/database'):
+        info.database_url = elementtext(database.find('url'))
+        info.retrieved = elementtext(database.find('retrieved'))
+        info.profiles_count = elementtext(database.find('profiles/count'))
+        info.profiles_url = elementtext(database.find('profiles/url'))
+        for locus_element in database.iterfind('loci/locus'):
+            locus_info = LocusInfo()
+            locus_info.name = elementtext(locus_element)
+            locus_info.url = elementtext(locus_element.find('url'))
+            info.loci.append(locus_info)
+    return info
+
+
+def scheme_query(genus, exact):
+    """
+    Determine the species name with which to find the scheme of a genus
+    :param genus: Name of the genus (or species)
+    :param exact: Boolean of whether the name must match a species exactly
+    :return: Tuple of species name, and whether it must match exactly
+    """
+    # Allow for Shigella to use the Escherichia MLST profile/alleles
+    genus = genus if genus != 'Shigella' else 'Escherichia'
+    if genus in organismdictionary:
+        return organismdictionary[genus], True
+    return genus, exact
+
+
+def download_scheme(species_info, path, threads=4, retries=3, timeout=300):
+    """
+    Download (or update) the profile and the loci of a scheme, and create the combined allele file
+    :param species_info: SpeciesInfo object of the scheme
+    :param path: Path of the folder in which to store the scheme
+    :param threads: Maximum number of concurrent downloads
+    :param retries: Number of times to retry a failed download
+    :param timeout: Number of seconds to wait for the server to respond to a download
+    """
+    make_path(path)
+    species_name_underscores = species_info.name.replace(' ', '_')
+    species_name_underscores = species_name_underscores.replace('/', '_')
+    species_all_fasta_filename = species_name_underscores + '.fasta'
+    species_all_fasta_file = os.path.join(path, species_all_fasta_filename)
+    log_filename = "mlst_data_download_{}_{}.log".format(species_name_underscores, species_info.retrieved)
+    with open(os.path.join(path, log_filename), 'w') as log_file:
+        log_file.write(species_info.retrieved + '\n')
+        profile_path = urlparse(species_info.profiles_url).path
+        profile_filename = profile_path.split('/')[-1]
+        log_file.write("definitions: {}\n".format(profile_filename))
+        log_file.write("{} profiles\n".format(species_info.profiles_count))
+        log_file.write("sourced from: {}\n\n".format(species_info.profiles_url))
+        # Only download the profile and the loci that have changed since the previous download
+        manifest = Manifest(path)
+        with requests.Session() as session:
+            manifest.download(session, species_info.profiles_url, os.path.join(path, profile_filename),
+                              timeout=timeout)
+        loci = list()
+        for locus in species_info.loci:
+            locus_path = urlparse(locus.url).path
+            locus_filename = locus_path.split('/')[-1]
+            log_file.write("locus {}\n".format(locus.name))
+            log_file.write(locus_filename + '\n')
+            log_file.write("Sourced from {}\n\n".format(locus.url))
+            loci.append((locus.url, os.path.join(path, locus_filename)))
+        fetcher = LocusFetcher(loci=loci,
+                               combined=species_all_fasta_file,
+                               manifest=manifest,
+                               threads=threads,
+                               retries=retries,
+                               timeout=timeout)
+        try:
+            fetcher.main()
+        finally:
+            manifest.write()
+        log_file.write("all loci: {}\n".format(species_all_fasta_filename))
 
 
 def main(args):
@@ -136,81 +379,84 @@ def main(args):
     make_path(args.path)
     # Allow for Shigella to use the Escherichia MLST profile/alleles
     args.genus = args.genus if args.genus != 'Shigella' else 'Escherichia'
-    # As there are multiple profiles for certain organisms, this dictionary has the schemes I use as values
-    organismdictionary = {'Escherichia': 'Escherichia coli#1',
-                          'Vibrio': 'Vibrio parahaemolyticus',
-                          'Campylobacter': 'Campylobacter jejuni',
-                          'Listeria': 'Listeria monocytogenes',
-                          'Bacillus': 'Bacillus cereus',
-                          'Staphylococcus': "Staphylococcus aureus",
-                          'Salmonella': 'Salmonella enterica'}
     # Set the appropriate profile based on the dictionary key:value pairs
     try:
         args.genus = organismdictionary[args.species]
     except (KeyError, AttributeError):
         pass
-    with url.urlopen(args.repository_url) as docfile:
-        doc = xml.parse(docfile)
-        root = doc.childNodes[0]
-        found_species = []
-        for species_node in root.getElementsByTagName('species'):
-            info = getspeciesinfo(species_node, args.genus, args.force_scheme_name)
-            if info is not None:
-                found_species.append(info)
-        if len(found_species) == 0:
-            print("No species matched your query.")
-            return
-        if len(found_species) > 1:
-            print("The following {} species match your query, please be more specific:".format(len(found_species)))
-            for info in found_species:
-                print(info.name)
-                return
-        # exit(2)
-
+    indexfile, retrieved = fetch_index(args.repository_url, args.path,
+                                       max_age=getattr(args, 'index_age', 24),
+                                       timeout=getattr(args, 'timeout', 300))
+    found_species = parse_index(indexfile, {args.genus: (args.genus, args.force_scheme_name)})[args.genus]
+    if len(found_species) == 0:
+        print("No species matched your query.")
+        return
+    if len(found_species) > 1:
+        print("The following {} species match your query, please be more specific:".format(len(found_species)))
+        for info in found_species:
+            print(info.name)
+        return
     # output information for the single matching species
-    assert len(found_species) == 1
-    species_info = found_species[0]
-    species_name_underscores = species_info.name.replace(' ', '_')
-    species_name_underscores = species_name_underscores.replace('/', '_')
-    species_all_fasta_filename = species_name_underscores + '.fasta'
-    species_all_fasta_file = open('{}/{}'.format(args.path, species_all_fasta_filename), 'w')
-    log_filename = "mlst_data_download_{}_{}.log".format(species_name_underscores, species_info.retrieved)
-    log_file = open('{}/{}'.format(args.path, log_filename), "w")
-    log_file.write(species_info.retrieved + '\n')
-    profile_path = urlparse(species_info.profiles_url).path
-    profile_filename = profile_path.split('/')[-1]
-    log_file.write("definitions: {}\n".format(profile_filename))
-    log_file.write("{} profiles\n".format(species_info.profiles_count))
-    log_file.write("sourced from: {}\n\n".format(species_info.profiles_url))
-    #
-    # with url.urlopen(species_info.profiles_url) as profile_doc:
-    #     with open(os.path.join(args.path, profile_filename), 'w') as profile_file:
-    localfile, headers = url.urlretrieve(species_info.profiles_url)
-    with open(localfile, 'r') as profile_doc:
-        with open(os.path.join(args.path, profile_filename), 'w') as profile_file:
-            profile_file.write(profile_doc.read())
-    for locus in species_info.loci:
-        locus_path = urlparse(locus.url).path
-        locus_filename = locus_path.split('/')[-1]
-        log_file.write("locus {}\n".format(locus.name))
-        log_file.write(locus_filename + '\n')
-        log_file.write("Sourced from {}\n\n".format(locus.url))
-        #
-        local_locus_doc, headers = url.urlretrieve(locus.url)
-        with open(local_locus_doc, 'r') as locus_doc:
-            with open(os.path.join(args.path, locus_filename), 'w') as locus_file:
-                # locus_doc = url.urlopen(locus.url)
-                # locus_file = open('{}/{}'.format(args.path, locus_filename), 'w')
-                locus_fasta_content = locus_doc.read()
-                locus_file.write(locus_fasta_content)
-                species_all_fasta_file.write(locus_fasta_content)
-                # locus_file.close()
-                # locus_doc.close()
-    log_file.write("all loci: {}\n".format(species_all_fasta_filename))
-    log_file.close()
-    species_all_fasta_file.close()
+    download_scheme(found_species[0], args.path,
+                    threads=getattr(args, 'threads', 4),
+                    retries=getattr(args, 'retries', 3),
+                    timeout=getattr(args, 'timeout', 300))
+
+
+def sync(args):
+    """
+    Update the schemes of several genera in one run. The repository index is fetched and parsed once for all the
+    genera, and several schemes are updated concurrently
+    :param args: Arguments from parse_args
+    :return: List of the genera that could not be updated
+    """
+    genera = args.genera if args.genera else sorted(organismdictionary)
+    indexfile, retrieved = fetch_index(args.repository_url, args.path,
+                                       max_age=args.index_age,
+                                       timeout=args.timeout)
+    print('Updating the schemes of {genera} from the index retrieved {retrieved}'.format(genera=', '.join(genera),
+                                                                                        retrieved=retrieved))
+    found = parse_index(indexfile, {genus: scheme_query(genus, args.force_scheme_name) for genus in genera})
+    failed = list()
+    lock = Lock()
+    queue = Queue()
+
+    def update():
+        while True:
+            genus = queue.get()
+            try:
+                if len(found[genus]) != 1:
+                    raise ValueError('{num} species match {query}: {names}'
+                                     .format(num=len(found[genus]),
+                                             query=scheme_query(genus, args.force_scheme_name)[0],
+                                             names=', '.join(info.name for info in found[genus])))
+                download_scheme(found[genus][0], os.path.join(args.path, genus),
+                                threads=args.threads,
+                                retries=args.retries,
+                                timeout=args.timeout)
+                print('Updated {genus} ({name})'.format(genus=genus,
+                                                        name=found[genus][0].name))
+            except Exception as error:
+                print('Failed to update {genus}: {error}'.format(genus=genus,
+                                                                 error=error))
+                with lock:
+                    failed.append(genus)
+            finally:
+                queue.task_done()
+    for _ in range(min(max(1, args.schemes), len(genera))):
+        threads = Thread(target=update, args=())
+        threads.setDaemon(True)
+        threads.start()
+    for genus in genera:
+        queue.put(genus)
+    queue.join()
+    return sorted(failed)
 
 
 if __name__ == '__main__':
     arguments = parse_args()
-    main(arguments)
+    if arguments.sync:
+        if sync(arguments):
+            quit(1)
+    else:
+        main(arguments)
@@ -1,14 +1,61 @@
 #!/usr/bin/env python 3
 from olctools.accessoryFunctions.accessoryFunctions import printtime, make_path
 from cowbat.get import rest_auth_class
-from Bio import SeqIO
 from argparse import ArgumentParser
 from glob import glob
+import multiprocessing
 import time
 import os
 
 
 __author__ = 'adamkoziol'
+# Characters removed from the allele sequences: makeblastdb can't handle sequences with gaps, and Ns are removed as well.
+# Spaces and carriage returns are not part of the sequence
+removed = str.maketrans('', '', '-N \r')
+
+
+def normalise_alleles(allele, wrap=60):
+    """
+    Rewrite an allele file in the format of the combined allele file: dashes in the allele names are replaced with
+    underscores, the descriptions are removed, gaps and Ns are removed from the sequences, and the sequences are wrapped
+    at 60 characters. Produces the same output as parsing and writing the records with SeqIO
+    :param allele: Name and path of the allele file
+    :param wrap: Number of characters per line of sequence
+    :return: String of the rewritten allele file
+    """
+    output = list()
+    header = None
+    lines = list()
+    # Read the file in large buffered chunks
+    with open(allele, 'r', buffering=1024 * 1024) as fasta:
+        for line in fasta:
+            if line.startswith('>'):
+                if header is not None:
+                    write_record(output, header, lines, wrap)
+                header = line[1:].rstrip()
+                lines = list()
+            # Lines before the first header are ignored
+            elif header is not None:
+                lines.append(line.rstrip())
+    if header is not None:
+        write_record(output, header, lines, wrap)
+    return ''.join(output)
+
+
+def write_record(output, header, lines, wrap):
+    """
+    Add a normalised record to the output
+    :param output: List of strings of the rewritten file
+    :param header: Header line of the record, without the >
+    :param lines: List of the sequence lines of the record
+    :param wrap: Number of characters per line of sequence
+    """
+    # Only the first word of the header is kept, with any dashes replaced with underscores
+    words = header.split(None, 1)
+    output.append('>{name}\n'.format(name=words[0].replace('-', '_') if words else str()))
+    sequence = ''.join(lines).translate(removed)
+    for position in range(0, len(sequence), wrap):
+        output.append(sequence[position:position + wrap] + '\n')
 
 
 class Get(object):
@@ -33,37 +80,53 @@ class Get(object):
         args.file_path = homepath
         args.output_path = newfolder
         args.start = self.start
+        args.threads = self.threads
+        args.rate = self.rate
         rmlst = rest_auth_class.REST(args)
         # Download the profile and alleles
         rmlst.main()
 
-        # Get the new alleles into a list, and create the combinedAlleles file
+        # Get the new alleles into a list, and create the combinedAlleles file if any allele file has changed
         alleles = glob(os.path.join(newfolder, '*.tfa'))
-        self.combinealleles(newfolder, alleles)
+        if rmlst.changed or not os.path.isfile(os.path.join(newfolder, 'rMLST_combined.fasta')):
+            self.combinealleles(newfolder, alleles, processes=self.cpus)
 
-    def combinealleles(self, allelepath, alleles):
+    def combinealleles(self, allelepath, alleles, processes=1):
+        """
+        Create the combined allele file from the allele files. The allele files are rewritten in the order of their
+        names, optionally by several processes at once
+        :param allelepath: Path of the folder in which to create the combined allele file
+        :param alleles: List of the allele files
+        :param processes: Number of processes with which to rewrite the allele files
+        """
         printtime('Creating combined rMLST allele file', self.start)
-        with open(os.path.join(allelepath, 'rMLST_combined.fasta'), 'w') as combinedfile:
-            # Open each allele file
-            for allele in sorted(alleles):
-                # with open(allele, 'rU') as fasta:
-                for record in SeqIO.parse(open(allele, "rU"), "fasta"):
-                    # Extract the sequence record from each entry in the multifasta
-                    # Replace and dashes in the record.id with underscores
-                    record.id = record.id.replace('-', '_')
-                    # Remove and dashes or 'N's from the sequence data - makeblastdb can't handle sequences
-                    # with gaps
-                    # noinspection PyProtectedMember
-                    record.seq._data = record.seq._data.replace('-', '').replace('N', '')
-                    # Clear the name and description attributes of the record
-                    record.name = ''
-                    record.description = ''
-                    # Write each record to the combined file
-                    SeqIO.write(record, combinedfile, 'fasta')
+        combined = os.path.join(allelepath, 'rMLST_combined.fasta')
+        # Write to a temporary file, so that an interrupted run does not leave a truncated combined file
+        with open(combined + '.tmp', 'w', buffering=1024 * 1024) as combinedfile:
+            if processes > 1:
+                with multiprocessing.Pool(processes=processes) as pool:
+                    # imap returns the rewritten files in the order of the allele files
+                    for records in pool.imap(normalise_alleles, sorted(alleles), chunksize=16):
+                        combinedfile.write(records)
+            else:
+                for allele in sorted(alleles):
+                    combinedfile.write(normalise_alleles(allele))
+        os.replace(combined + '.tmp', combined)
 
     def __init__(self, args):
         self.path = os.path.join(args.path)
         self.start = args.start
+        # Number of concurrent downloads, and the maximum number of requests per second
+        try:
+            self.threads = args.threads
+            self.rate = args.rate
+        except AttributeError:
+            self.threads = 8
+            self.rate = 10
+        try:
+            self.cpus = args.cpus if args.cpus else multiprocessing.cpu_count()
+        except AttributeError:
+            self.cpus = multiprocessing.cpu_count()
         self.analysistype = 'rMLST'
         self.getrmlsthelper()
 
@@ -74,6 +137,18 @@ if __name__ == '__main__':
     parser = ArgumentParser(description='')
     parser.add_argument('path',
                         help='Specify input directory')
+    parser.add_argument('-t', '--threads',
+                        default=8,
+                        type=int,
+                        help='Number of allele files to download concurrently. Default is 8')
+    parser.add_argument('-r', '--rate',
+                        default=10,
+                        type=float,
+                        help='Maximum number of download requests per second. Default is 10')
+    parser.add_argument('-c', '--cpus',
+                        type=int,
+                        help='Number of processes used to create the combined allele file. Default is the number of '
+                             'cpus in the system')
 
     # Get the arguments into an object
     arguments = parser.parse_args()
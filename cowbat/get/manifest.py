@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+from threading import Lock
+import hashlib
+import logging
+import time
+import json
+import os
+__author__ = 'adamkoziol'
+
+
+def file_hash(path):
+    """
+    Calculate the SHA-256 checksum of a file
+    :param path: Name and path of the file
+    :return: Hex digest of the checksum
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as downloaded:
+        for chunk in iter(lambda: downloaded.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def timestamp():
+    """
+    :return: The current UTC time as an ISO 8601 string
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+class Manifest(object):
+    """
+    Record the URL, validators (ETag and Last-Modified), size, checksum, and retrieval date of each file downloaded
+    into a database folder in manifest.json, so that refreshes only fetch the files that have changed on the server.
+    Downloads are written to a .part file that is renamed into place once it is complete; an interrupted download is
+    resumed from the .part file with a range request if the server still has the same version of the file
+    """
+
+    def download(self, session, url, path, timeout=300):
+        """
+        Download a file, unless the local copy is complete and the server reports that it has not changed
+        :param session: requests (or rauth) session with which to make the request
+        :param url: URL of the file
+        :param path: Name and path of the local file
+        :param timeout: Number of seconds to wait for the server to respond
+        :return: True if the local file was created or its contents changed, False if it is unchanged
+        """
+        name = os.path.basename(path)
+        with self.lock:
+            entry = dict(self.entries.get(name, dict()))
+        headers = dict()
+        # Only ask whether the file has changed if the local copy is the complete file that was recorded
+        if entry.get('url') == url and os.path.isfile(path) and os.path.getsize(path) == entry.get('size'):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        partial = path + '.part'
+        validator = self.partial_validator(partial, url)
+        if validator and not headers:
+            # Resume the interrupted download, as long as the file on the server has not changed in the meantime
+            headers['Range'] = 'bytes={start}-'.format(start=os.path.getsize(partial))
+            headers['If-Range'] = validator
+        response = session.get(url, headers=headers, params=dict(), stream=True, timeout=timeout)
+        try:
+            if response.status_code == 304:
+                entry['checked'] = timestamp()
+                self.record(name, entry)
+                return False
+            if response.status_code == 206 and 'Range' in headers:
+                mode = 'ab'
+            elif response.status_code in (200, 201):
+                mode = 'wb'
+            else:
+                raise IOError('Download of {url} failed with status {status}'.format(url=url,
+                                                                                      status=response.status_code))
+            # Store the validator of the partial file, so that the download can be resumed if it is interrupted
+            validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+            if validator:
+                with open(partial + '.json', 'w') as partial_info:
+                    json.dump({'url': url, 'validator': validator}, partial_info)
+            with open(partial, mode) as downloaded:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    downloaded.write(chunk)
+        finally:
+            response.close()
+        checksum = file_hash(partial)
+        changed = checksum != entry.get('sha256') or not os.path.isfile(path)
+        if changed:
+            os.replace(partial, path)
+        else:
+            # The server re-sent an identical file; keep the existing file (and its modification time)
+            os.remove(partial)
+        self.remove_partial_validator(partial)
+        entry.update({'url': url,
+                      'etag': response.headers.get('ETag'),
+                      'last_modified': response.headers.get('Last-Modified'),
+                      'size': os.path.getsize(path),
+                      'sha256': checksum,
+                      'checked': timestamp()})
+        if changed:
+            entry['retrieved'] = entry['checked']
+        self.record(name, entry)
+        return changed
+
+    @staticmethod
+    def partial_validator(partial, url):
+        """
+        Find the validator of an interrupted download of the URL
+        :param partial: Name and path of the .part file
+        :param url: URL of the file
+        :return: ETag or Last-Modified value of the partial file, or None if it cannot be resumed
+        """
+        try:
+            with open(partial + '.json', 'r') as partial_info:
+                info = json.load(partial_info)
+        except (FileNotFoundError, ValueError):
+            return None
+        if info.get('url') != url or not os.path.isfile(partial):
+            return None
+        return info.get('validator')
+
+    @staticmethod
+    def remove_partial_validator(partial):
+        try:
+            os.remove(partial + '.json')
+        except FileNotFoundError:
+            pass
+
+    def record(self, name, entry):
+        """
+        Store the entry of a file, and periodically write the manifest so that an interrupted refresh keeps the entries
+        of the files it has already downloaded
+        :param name: Name of the file
+        :param entry: Dictionary of the URL, validators, size, checksum, and dates of the file
+        """
+        with self.lock:
+            self.entries[name] = entry
+            self.pending += 1
+            write = self.pending >= self.interval
+        if write:
+            self.write()
+
+    def write(self):
+        """
+        Atomically write the manifest to file
+        """
+        with self.lock:
+            self.pending = 0
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as manifest:
+                json.dump(self.entries, manifest, sort_keys=True, indent=4, separators=(',', ': '))
+            os.replace(temporary, self.path)
+
+    def __init__(self, path, interval=500):
+        """
+        :param path: Path of the database folder. The manifest is stored in manifest.json in this folder
+        :param interval: Number of downloaded files between writes of the manifest
+        """
+        self.path = os.path.join(path, 'manifest.json')
+        self.interval = interval
+        self.lock = Lock()
+        self.pending = 0
+        try:
+            with open(self.path, 'r') as manifest:
+                self.entries = json.load(manifest)
+        except FileNotFoundError:
+            self.entries = dict()
+        except ValueError:
+            logging.warning('Could not parse {manifest}; all the files will be downloaded'.format(manifest=self.path))
+            self.entries = dict()
@@ -1,7 +1,11 @@
 #!/usr/bin/env python 3
 from olctools.accessoryFunctions.accessoryFunctions import printtime
+from requests.adapters import HTTPAdapter
+from cowbat.get.manifest import Manifest
 from rauth import OAuth1Session
-import multiprocessing
+from threading import Lock, Thread
+from queue import Queue
+import time
 import os
 import re
 
@@ -33,6 +37,32 @@ databases (https://pubmlst.org/site_accounts.shtml#registering_with_databases)
 'modified by adamkoziol'
 
 
+class RateLimit(object):
+    """
+    Space out the requests made by several threads, so that no more than the specified number of requests are started
+    per second
+    """
+
+    def wait(self):
+        """
+        Block until the next request may be started
+        """
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request)
+            self.next_request = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def __init__(self, rate):
+        """
+        :param rate: Maximum number of requests per second. 0 or None disables the limit
+        """
+        self.interval = 1 / rate if rate else 0
+        self.next_request = 0
+        self.lock = Lock()
+
+
 class REST(object):
 
     def main(self):
@@ -105,7 +135,7 @@ class REST(object):
         # Set the URL appropriately
         url = self.test_rest_url + '/oauth/get_session_token'
         # Perform a GET request with the appropriate keys and tokens
-        r = session_request.get(url)
+        r = session_request.get(url, params=dict())
         # If the status code is '200' (OK), proceed
         if r.status_code == 200:
             # Save the JSON-decoded token secret and token
@@ -153,13 +183,10 @@ class REST(object):
         """
         Creates a session to find the URL for the loci and schemes
         """
-        # Create a new session
-        session = OAuth1Session(self.consumer_key,
-                                self.consumer_secret,
-                                access_token=self.session_token,
-                                access_token_secret=self.session_secret)
+        # Create the session used by the requests made from the main thread
+        self.session = self.create_session()
         # Use the test URL in the GET request
-        r = session.get(self.test_rest_url)
+        r = self.session.get(self.test_rest_url, params=dict())
         if r.status_code == 200 or r.status_code == 201:
             if re.search('json', r.headers['content-type'], flags=0):
                 decoded = r.json()
@@ -176,43 +203,19 @@ class REST(object):
         printtime('Downloading profile', self.start)
         # Set the name of the profile file
         profile_file = os.path.join(self.output_path, 'profile.txt')
-        size = 0
-        # Ensure that the file exists, and that it is not too small; likely indicating a failed download
-        try:
-            stats = os.stat(profile_file)
-            size = stats.st_size
-        except FileNotFoundError:
-            pass
-        # Only download the profile if the file doesn't exist, or is likely truncated
-        if not os.path.isfile(profile_file) or size <= 100:
-            # Create a new session
-            session = OAuth1Session(self.consumer_key,
-                                    self.consumer_secret,
-                                    access_token=self.session_token,
-                                    access_token_secret=self.session_secret)
-            # The profile file is called profiles_csv on the server. Updated the URL appropriately
-            r = session.get(self.profile + '/1/profiles_csv')
-            # On a successful GET request, parse the returned data appropriately
-            if r.status_code == 200 or r.status_code == 201:
-                if re.search('json', r.headers['content-type'], flags=0):
-                    decoded = r.json()
-                else:
-                    decoded = r.text
-                # Write the profile file to disk
-                with open(profile_file, 'w') as profile:
-                    profile.write(decoded)
+        # The profile file is called profiles_csv on the server. Updated the URL appropriately. The profile is only
+        # downloaded if it has changed since the previous download
+        if self.manifest.download(self.session, self.profile + '/1/profiles_csv', profile_file):
+            self.changed.append(os.path.basename(profile_file))
+        self.manifest.write()
 
     def find_loci(self):
         """
         Finds the URLs for all allele files
         """
         printtime('Downloading alleles', self.start)
-        session = OAuth1Session(self.consumer_key,
-                                self.consumer_secret,
-                                access_token=self.session_token,
-                                access_token_secret=self.session_secret)
         # Use the URL for all loci determined above
-        r = session.get(self.loci)
+        r = self.session.get(self.loci, params=dict())
         if r.status_code == 200 or r.status_code == 201:
             if re.search('json', r.headers['content-type'], flags=0):
                 decoded = r.json()
@@ -223,47 +226,79 @@ class REST(object):
                 # Add each URL to the list
                 self.loci_url.append(locus)
 
+    def create_session(self):
+        """
+        Create an authenticated session with the session token. The session keeps its connection to the server open, so
+        the requests made with it do not repeat the connection setup. Requests must supply params (even if empty), as
+        rauth cannot sign the params=None that requests passes by default
+        :return: OAuth1Session object
+        """
+        session = OAuth1Session(self.consumer_key,
+                                self.consumer_secret,
+                                access_token=self.session_token,
+                                access_token_secret=self.session_secret)
+        # Retry requests on connections that the server has closed
+        adapter = HTTPAdapter(max_retries=3)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
     def download_loci(self):
         """
-        Uses a multi-threaded approach to download allele files
+        Uses a multi-threaded approach to download allele files. Each thread uses its own persistent session
         """
-        # Setup the multiprocessing pool.
-        pool = multiprocessing.Pool(processes=self.threads)
-        # Map the list of loci URLs to the download method
-        pool.map(self.download_threads, self.loci_url)
-        pool.close()
-        pool.join()
+        printtime('Downloading {num} allele files with {threads} threads'.format(num=len(self.loci_url),
+                                                                               threads=self.threads), self.start)
+        for _ in range(self.threads):
+            # Send the threads to the appropriate destination function
+            threads = Thread(target=self.download_threads, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
+        for url in self.loci_url:
+            self.queue.put(url)
+        # Wait for all the allele files to be downloaded
+        self.queue.join()
+        self.manifest.write()
+        printtime('{num} allele files were new or changed'.format(num=len(self.changed)), self.start)
+        if self.failed:
+            print('Failed to download {num} allele files: {loci}'.format(num=len(self.failed),
+                                                                         loci=', '.join(sorted(self.failed))))
 
-    def download_threads(self, url):
+    def download_threads(self):
         """
-        Download the allele files
+        Download the allele files from the queue, re-using a single session for all the files downloaded by this thread
+        """
+        session = self.create_session()
+        while True:
+            url = self.queue.get()
+            try:
+                self.download_allele(session, url)
+            except Exception as error:
+                # A failed download must not stop the thread, otherwise the queue would never be joined
+                print('Failed to download {url}: {error!r}'.format(url=url,
+                                                                  error=error))
+                with self.lock:
+                    self.failed.append(os.path.split(url)[-1])
+            finally:
+                self.queue.task_done()
+
+    def download_allele(self, session, url):
+        """
+        Download an allele file
+        :param session: OAuth1Session object of the thread
+        :param url: URL of the locus
         """
         # Set the name of the allele file - split the gene name from the URL
         output_file = os.path.join(self.output_path, '{}.tfa'.format(os.path.split(url)[-1]))
-        # Check to see whether the file already exists, and if it is unusually small
-        size = 0
-        try:
-            stats = os.stat(output_file)
-            size = stats.st_size
-        except FileNotFoundError:
-            pass
-        # If the file doesn't exist, or is truncated, proceed with the download
-        if not os.path.isfile(output_file) or size <= 100:
-            # Create a new session
-            session = OAuth1Session(self.consumer_key,
-                                    self.consumer_secret,
-                                    access_token=self.session_token,
-                                    access_token_secret=self.session_secret)
-            # The allele file on the server is called alleles_fasta. Update the URL appropriately
-            r = session.get(url + '/alleles_fasta')
-            if r.status_code == 200 or r.status_code == 201:
-                if re.search('json', r.headers['content-type'], flags=0):
-                    decoded = r.json()
-                else:
-                    decoded = r.text
-                # Write the allele to disk
-                with open(output_file, 'w') as allele:
-                    allele.write(decoded)
+        # Stay within the number of requests per second allowed by the server
+        self.rate_limit.wait()
+        # The allele file on the server is called alleles_fasta. Update the URL appropriately. Unchanged files are not
+        # downloaded again, and interrupted downloads are resumed
+        if self.manifest.download(session, url + '/alleles_fasta', output_file):
+            with self.lock:
+                self.changed.append(os.path.basename(output_file))
 
     def __init__(self, args):
         self.test_rest_url = 'http://rest.pubmlst.org/db/pubmlst_rmlst_seqdef'
@@ -284,4 +319,22 @@ class REST(object):
         self.loci = str()
         self.profile = str()
         self.loci_url = list()
-        self.threads = multiprocessing.cpu_count()
+        self.session = None
+        # The downloads are limited by the network rather than the CPU, so use a number of threads that suits the server
+        try:
+            self.threads = int(args.threads) if args.threads else 8
+        except AttributeError:
+            self.threads = 8
+        # Maximum number of allele file requests per second
+        try:
+            rate = args.rate
+        except AttributeError:
+            rate = 10
+        self.rate_limit = RateLimit(rate)
+        self.queue = Queue()
+        self.lock = Lock()
+        self.failed = list()
+        # Record the validators and checksums of the downloaded files, so that refreshes only fetch changed files
+        self.manifest = Manifest(self.output_path)
+        # Names of the files that were new or changed
+        self.changed = list()
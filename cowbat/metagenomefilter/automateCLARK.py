@@ -2,13 +2,15 @@
 from olctools.accessoryFunctions.accessoryFunctions import GenObject, MetadataObject, make_path, SetupLogging
 import olctools.accessoryFunctions.metadataprinter as metadataprinter
 from genemethods.assemblypipeline import fileprep, createobject
-from cowbat.metagenomefilter import filtermetagenome
+from cowbat.metagenomefilter import filtermetagenome, clarkservice, clarktargets
+from cowbat.pipelinetools import resources
 from argparse import ArgumentParser
 from shutil import move, which
 from click import progressbar
 from threading import Thread
 from csv import DictReader
 from queue import Queue
+import multiprocessing
 import subprocess
 import xlsxwriter
 import logging
@@ -56,8 +58,40 @@ class CLARK(object):
         logging.info('Setting up database')
         self.targetcall = 'cd {} && ./set_targets.sh {} {} --{}'.format(self.clarkpath, self.databasepath,
                                                                         self.database, self.rank)
-        #
-        subprocess.call(self.targetcall, shell=True, stdout=self.devnull, stderr=self.devnull)
+        # The classification service sets the targets itself, and only when they change
+        if self.service:
+            return
+        # The targets of a valid database bundle were set when the bundle was built
+        if self.bundletargets():
+            logging.info('Using the CLARK targets of the database bundle')
+            return
+        # Only run set_targets.sh if the targets differ from the targets already set on this node
+        clarktargets.set_targets(clarkpath=self.clarkpath,
+                                 databasepath=self.databasepath,
+                                 database=self.database,
+                                 rank=self.rank)
+
+    def bundletargets(self):
+        """
+        Determine whether the CLARK targets set when the database bundle was built are still in place
+        :return: True if the targets of the bundle can be used
+        """
+        return self.bundle is not None and self.bundle.clark_ready(clarkpath=self.clarkpath,
+                                                                    databasepath=self.databasepath,
+                                                                    database=self.database,
+                                                                    rank=self.rank)
+
+    def classification(self):
+        """
+        Hold a shared lock on the CLARK targets while classifying, so that other pipelines on the node cannot change the
+        targets until the classification finishes. The targets are set again if they changed after settargets
+        :return: Context manager holding the lock
+        """
+        return clarktargets.classification(clarkpath=self.clarkpath,
+                                           databasepath=self.databasepath,
+                                           database=self.database,
+                                           rank=self.rank,
+                                           ready=self.bundletargets)
 
     def clean_sequences(self):
         """Removes reads/contigs that contain plasmids, and masks phage sequences."""
@@ -68,11 +102,13 @@ class CLARK(object):
             for sample in bar:
                 plasmid_removal = 'bbduk.sh ref={} in={} out={} overwrite'\
                     .format(plasmid_db, sample.general.combined, sample.general.combined.replace('.f', '_noplasmid.f'))
-                subprocess.call(plasmid_removal, shell=True, stdout=self.devnull, stderr=self.devnull)
+                resources.call(plasmid_removal, cores=1, name='bbduk.sh', shell=True, stdout=self.devnull,
+                               stderr=self.devnull)
                 phage_masking = 'bbduk.sh ref={} in={} out={} kmask=N overwrite'\
                     .format(phage_db, sample.general.combined.replace('.f', '_noplasmid.f'),
                             sample.general.combined.replace('.f', '_clean.f'))
-                subprocess.call(phage_masking, shell=True, stdout=self.devnull, stderr=self.devnull)
+                resources.call(phage_masking, cores=1, name='bbduk.sh', shell=True, stdout=self.devnull,
+                               stderr=self.devnull)
                 os.remove(sample.general.combined)
                 os.rename(sample.general.combined.replace('.f', '_clean.f'), sample.general.combined)
                 os.remove(sample.general.combined.replace('.f', '_noplasmid.f'))
@@ -99,8 +135,121 @@ class CLARK(object):
                 pass
         # Run the system call if the samples have not been classified
         if classify:
-            # Run the call
-            subprocess.call(self.classifycall, shell=True, stdout=self.devnull, stderr=self.devnull)
+            if self.service:
+                self.serviceclassify()
+            elif self.adaptive:
+                self.shardclassify()
+            else:
+                # Run the call once the memory required to load the database is available
+                with self.classification():
+                    resources.call(self.classifycall, memory=self.memory(), name='classify_metagenome.sh', shell=True,
+                                   stdout=self.devnull, stderr=self.devnull)
+
+    def shards(self, files):
+        """
+        Determine the number of CLARK processes to run at once, and the number of threads for each process. Each process
+        is limited to self.cpus threads, and the number of processes is limited by the available cores, the memory
+        required to load the database in light or full mode, and the number of files
+        :param files: Number of files to classify
+        :return: Tuple of the number of processes, and the number of threads per process
+        """
+        required = self.memory()
+        available = resources.available_memory()
+        processes = max(1, min(self.threads // self.cpus, available // required, files))
+        threads = max(1, self.threads // processes)
+        return processes, min(threads, self.cpus)
+
+    def memory(self):
+        """
+        Approximate memory required by each CLARK process: CLARK-l (light mode) uses ~4 GB, while full mode loads the
+        complete database
+        :return: Memory in bytes
+        """
+        return clarkservice.classification_memory(self.light)
+
+    def shardclassify(self):
+        """
+        Split the list of files into shards, and classify the shards with concurrent CLARK processes
+        """
+        with open(self.filelist, 'r') as filelist:
+            files = filelist.read().splitlines()
+        with open(self.reportlist, 'r') as reportlist:
+            reports = reportlist.read().splitlines()
+        processes, threads = self.shards(len(files))
+        logging.info('Classifying {num} files with {processes} CLARK processes of {threads} threads'
+                     .format(num=len(files),
+                             processes=processes,
+                             threads=threads))
+        for i in range(processes):
+            # Send the threads to the appropriate destination function
+            shardthreads = Thread(target=self.classifyshard, args=())
+            # Set the daemon to true - something to do with thread management
+            shardthreads.setDaemon(True)
+            # Start the threading
+            shardthreads.start()
+        classifycalls = list()
+        for shard in range(processes):
+            # Distribute the files between the shards in turn
+            filelist = '{base}_{shard}.txt'.format(base=os.path.splitext(self.filelist)[0],
+                                                   shard=shard)
+            reportlist = '{base}_{shard}.txt'.format(base=os.path.splitext(self.reportlist)[0],
+                                                     shard=shard)
+            with open(filelist, 'w') as shardfiles:
+                shardfiles.write(''.join(fastq + '\n' for fastq in files[shard::processes]))
+            with open(reportlist, 'w') as shardreports:
+                shardreports.write(''.join(report + '\n' for report in reports[shard::processes]))
+            classifycall = 'cd {cp} && ./classify_metagenome.sh -O {fl} -R {rl} -n {threads}{light}' \
+                .format(cp=self.clarkpath,
+                        fl=filelist,
+                        rl=reportlist,
+                        threads=threads,
+                        light=' --light' if self.light else '')
+            classifycalls.append(classifycall)
+        # The targets must not change until every shard is classified
+        with self.classification():
+            for classifycall in classifycalls:
+                self.shardqueue.put(classifycall)
+            self.shardqueue.join()
+
+    def classifyshard(self):
+        while True:
+            classifycall = self.shardqueue.get()
+            # Concurrent shards are only started once the memory to load another copy of the database is available
+            resources.call(classifycall, memory=self.memory(), name='classify_metagenome.sh', shell=True,
+                           stdout=self.devnull, stderr=self.devnull)
+            self.shardqueue.task_done()
+
+    def serviceclassify(self):
+        """
+        Send the files to the resident classification service rather than running classify_metagenome.sh, so that
+        the CLARK database is loaded from memory, and shared with other requests on this node
+        """
+        with open(self.filelist, 'r') as filelist:
+            files = filelist.read().splitlines()
+        with open(self.reportlist, 'r') as reportlist:
+            reports = reportlist.read().splitlines()
+        request = {'clarkpath': self.clarkpath,
+                   'databasepath': self.databasepath,
+                   'database': self.database,
+                   'rank': self.rank,
+                   'light': self.light,
+                   'cpus': self.cpus,
+                   'files': files,
+                   'reports': reports}
+        try:
+            address = clarkservice.start_service(clarkpath=self.clarkpath,
+                                                 databasepath=self.databasepath)
+            returncode = clarkservice.classify(request=request,
+                                               address=address)
+            if returncode:
+                raise RuntimeError('classify_metagenome.sh exited with status {code}'.format(code=returncode))
+        except (OSError, EOFError, RuntimeError, multiprocessing.AuthenticationError) as error:
+            # Fall back to running the classification directly
+            logging.warning('CLARK classification service failed ({error}); classifying directly'
+                            .format(error=error))
+            with self.classification():
+                resources.call(self.classifycall, memory=self.memory(), name='classify_metagenome.sh', shell=True,
+                               stdout=self.devnull, stderr=self.devnull)
 
     def lists(self):
         """
@@ -128,8 +277,10 @@ class CLARK(object):
         Estimate the abundance of taxonomic groups
         """
         logging.info('Estimating abundance of taxonomic groups')
+        # Each estimate_abundance.sh call is single-threaded, so adaptive mode uses all the available threads
+        workers = self.threads if self.adaptive else self.cpus
         # Create and start threads
-        for i in range(self.cpus):
+        for i in range(workers):
             # Send the threads to the appropriate destination function
             threads = Thread(target=self.estimate, args=())
             # Set the daemon to true - something to do with thread management
@@ -166,7 +317,8 @@ class CLARK(object):
             # Run the system call (if necessary)
             if not os.path.isfile(sample.general.abundance):
                 #
-                subprocess.call(sample.commands.abundancecall, shell=True, stdout=self.devnull, stderr=self.devnull)
+                resources.call(sample.commands.abundancecall, cores=1, name='estimate_abundance.sh', shell=True,
+                               stdout=self.devnull, stderr=self.devnull)
             self.abundancequeue.task_done()
 
     def reports(self):
@@ -240,6 +392,9 @@ class CLARK(object):
                 # times in the classification file. As far as I can tell, these multiple representations are always
                 # classified the same, and, therefore, should be treated as duplicates, and ignored
                 contigset = set()
+                # Parse the classification file once into an index of the contigs assigned to each TaxID
+                if self.extension == 'fasta' and sortedabundance:
+                    contigindex = self.contigindex(sample.general.classification)
                 for result in sortedabundance:
                     # Add the total number of base pairs classified for each TaxID. As only the total number of contigs
                     # classified as a particular TaxID are in the report, it can be misleading if a large number
@@ -250,17 +405,14 @@ class CLARK(object):
                     if self.extension == 'fasta':
                         # Initialise a variable to store the total bp mapped to the TaxID
                         result['TotalBP'] = int()
-                        # Read the classification file into a dictionary
-                        classificationdict = DictReader(open(sample.general.classification))
-                        # Read through each contig classification in the dictionary
-                        for contig in classificationdict:
-                            # Pull out each contig with a TaxID that matches the TaxID of the result of interest, and
-                            # is not present in a set of contigs that have already been added to the dictionary
-                            if result['TaxID'] == contig[' Assignment'] and contig['Object_ID'] not in contigset:
-                                # Increment the total bp mapping to the TaxID by the integer of each contig
-                                result['TotalBP'] += int(contig[' Length'])
+                        # Read through each contig classified as the TaxID of the result of interest
+                        for object_id, length in contigindex.get(result['TaxID'], list()):
+                            # Ignore contigs that are present in the set of contigs that have already been added
+                            if object_id not in contigset:
+                                # Increment the total bp mapping to the TaxID by the length of each contig
+                                result['TotalBP'] += length
                                 # Avoid duplicates by adding the contig name to the set of contigs
-                                contigset.add(contig['Object_ID'])
+                                contigset.add(object_id)
                     # Print the results to file
                     # Ignore the first header, as it is the strain name, which has already been added to the report
                     dictionaryheaders = headers[1:]
@@ -286,6 +438,21 @@ class CLARK(object):
         # Close the workbook
         workbook.close()
 
+    @staticmethod
+    def contigindex(classification):
+        """
+        Parse a CLARK classification file into a dictionary of the contigs assigned to each TaxID
+        :param classification: Name and path of the .csv classification file
+        :return: Dictionary of TaxID: list of (Object_ID, length) tuples in the order in which they appear in the file
+        """
+        contigindex = dict()
+        with open(classification, 'r') as classificationfile:
+            # Read through each contig classification in the file
+            for contig in DictReader(classificationfile):
+                contigindex.setdefault(contig[' Assignment'], list()).append((contig['Object_ID'],
+                                                                              int(contig[' Length'])))
+        return contigindex
+
     def __init__(self, args, pipelinecommit, startingtime, scriptpath):
         # Initialise variables
         self.commit = str(pipelinecommit)
@@ -301,8 +468,18 @@ class CLARK(object):
         self.databasepath = os.path.join(args.databasepath, '')
         assert os.path.isdir(self.databasepath), u'Supplied database path is not a valid directory {0!r:s}' \
             .format(self.databasepath)
-        # There seems to be an issue with CLARK when running with a very high number of cores. Limit self.cpus to 1
+        # There seems to be an issue with CLARK when running with a very high number of cores. Limit self.cpus to 4
         self.cpus = 4
+        # The total number of threads available. In adaptive mode, several CLARK processes of at most self.cpus threads
+        # are run at once to use the available threads
+        try:
+            self.threads = int(args.threads) if args.threads else multiprocessing.cpu_count()
+        except AttributeError:
+            self.threads = multiprocessing.cpu_count()
+        try:
+            self.adaptive = args.adaptive
+        except AttributeError:
+            self.adaptive = False
         # Set variables from the arguments
         self.database = args.database
         self.rank = args.rank
@@ -315,11 +492,22 @@ class CLARK(object):
         self.filelist = os.path.join(self.path, 'sampleList.txt')
         self.reportlist = os.path.join(self.path, 'reportList.txt')
         self.abundancequeue = Queue()
+        self.shardqueue = Queue()
         self.datapath = str()
         self.reportpath = os.path.join(self.path, 'reports')
         self.clean_seqs = args.clean_seqs
         self.light = args.light
         self.extension = args.extension
+        # Optionally send classifications to the resident classification service
+        try:
+            self.service = args.service
+        except AttributeError:
+            self.service = False
+        # Optional database bundle of the reference database folder
+        try:
+            self.bundle = args.bundle
+        except AttributeError:
+            self.bundle = None
         if self.clean_seqs:
             try:
                 self.reffilepath = args.reffilepath
@@ -463,6 +651,14 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--light',
                         default=True,
                         help='Run CLARK in light mode for systems with lower RAM')
+    parser.add_argument('-S', '--service',
+                        action='store_true',
+                        help='Send the files to a long-lived classification service that keeps the database in memory '
+                             'between CLARK calls and runs. The service is started if it is not already running')
+    parser.add_argument('-a', '--adaptive',
+                        action='store_true',
+                        help='Split the files into shards, and classify the shards with concurrent CLARK processes '
+                             'sized from the available threads and memory')
     parser.add_argument('-e', '--extension',
                         default='fastq',
                         help='Extension of file type to process. Must be either "fasta" or "fastq". Default is "fastq"')
@@ -502,5 +698,17 @@ class PipelineInit(object):
         args.reffilepath = inputobject.reffilepath
         args.extension = extension
         args.light = light
+        try:
+            args.service = inputobject.clarkservice
+        except AttributeError:
+            args.service = False
+        try:
+            args.adaptive = inputobject.adaptiveclark
+        except AttributeError:
+            args.adaptive = False
+        try:
+            args.bundle = inputobject.bundle
+        except AttributeError:
+            args.bundle = None
         # Run CLARK
         CLARK(args, inputobject.commit, inputobject.starttime, inputobject.homepath)
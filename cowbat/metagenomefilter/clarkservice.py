@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+from olctools.accessoryFunctions.accessoryFunctions import SetupLogging
+from cowbat.metagenomefilter import clarktargets
+from cowbat.pipelinetools import resources
+from multiprocessing.connection import Client, Listener
+from multiprocessing import AuthenticationError
+from threading import Thread
+from argparse import ArgumentParser
+from queue import Empty, Queue
+import subprocess
+import tempfile
+import logging
+import mmap
+import stat
+import time
+import sys
+import os
+__author__ = 'adamkoziol'
+
+
+def service_directory():
+    """
+    Find (or create) the private directory of the current user in which the socket and the authentication key of the
+    service are stored. Only the current user may enter the directory, so other users can neither connect to the
+    socket nor create a socket of their own in its place
+    :return: Path of the directory
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        directory = os.path.join(runtime, 'cowbat_clark')
+    else:
+        directory = os.path.join(tempfile.gettempdir(), 'cowbat_clark_{uid}'.format(uid=os.getuid()))
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    # The directory may have been created in advance by another user
+    stats = os.lstat(directory)
+    if not stat.S_ISDIR(stats.st_mode) or stats.st_uid != os.getuid() or stats.st_mode & 0o077:
+        raise OSError('{directory} is not a private directory of the current user'.format(directory=directory))
+    return directory
+
+
+def service_address():
+    """
+    Determine the address of the classification service for the current user on this node
+    :return: Path of the Unix socket
+    """
+    return os.path.join(service_directory(), 'clark.sock')
+
+
+def service_authkey():
+    """
+    Read the key with which the clients and the service authenticate each other, creating it if necessary. The key is
+    written to a temporary file that is then linked into place, so concurrent callers always read a complete key
+    :return: Bytes of the key
+    """
+    keyfile = os.path.join(service_directory(), 'authkey')
+    if not os.path.isfile(keyfile):
+        temporary = '{keyfile}.{pid}'.format(keyfile=keyfile,
+                                             pid=os.getpid())
+        with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as key:
+            key.write(os.urandom(32))
+        try:
+            os.link(temporary, keyfile)
+        except FileExistsError:
+            pass
+        os.remove(temporary)
+    with open(keyfile, 'rb') as key:
+        return key.read()
+
+
+def classification_memory(light):
+    """
+    Approximate memory required by each CLARK process: CLARK-l (light mode) uses ~4 GB, while full mode loads the
+    complete database
+    :param light: Boolean of whether CLARK is run in light mode
+    :return: Memory in bytes
+    """
+    return 4 * 1024 ** 3 if light else 64 * 1024 ** 3
+
+
+def classify(request, address=None):
+    """
+    Send a classification request to the service, and wait for the result
+    :param request: Dictionary with the clarkpath, databasepath, database, rank, light, cpus, and the lists of files
+    to classify and report prefixes
+    :param address: Path of the Unix socket of the service. Defaults to the address for the current user
+    :return: Return code of the classification
+    """
+    address = address if address else service_address()
+    # Only connect to a socket created by the current user. The authentication key ensures that the process listening
+    # on the socket is the service of the current user before any request or result is exchanged
+    if os.stat(address).st_uid != os.getuid():
+        raise OSError('{address} is not owned by the current user'.format(address=address))
+    connection = Client(address, family='AF_UNIX', authkey=service_authkey())
+    try:
+        connection.send(request)
+        return connection.recv()
+    finally:
+        connection.close()
+
+
+def start_service(clarkpath, databasepath, address=None, idle=3600, timeout=60):
+    """
+    Start the classification service in the background, unless it is already running
+    :param clarkpath: Path to the CLARK scripts
+    :param databasepath: Path of the CLARK database files to keep in memory
+    :param address: Path of the Unix socket of the service
+    :param idle: Number of seconds without requests after which the service exits
+    :param timeout: Number of seconds to wait for the service to start
+    :return: Address of the service
+    """
+    address = address if address else service_address()
+    if running(address):
+        return address
+    logging.info('Starting CLARK classification service')
+    subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                      '-C', clarkpath,
+                      '-d', databasepath,
+                      '-a', address,
+                      '-i', str(idle)],
+                     stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+    start = time.time()
+    while time.time() - start < timeout:
+        if running(address):
+            return address
+        time.sleep(0.5)
+    raise RuntimeError('CLARK classification service did not start at {address}'.format(address=address))
+
+
+def running(address):
+    """
+    Determine whether the service is accepting connections
+    :param address: Path of the Unix socket of the service
+    :return: True if a request can be sent to the service
+    """
+    try:
+        return classify(request={'ping': True}, address=address) == 0
+    except (OSError, EOFError, AuthenticationError):
+        return False
+
+
+class ClassificationService(object):
+    """
+    Long-lived classification worker. CLARK does not have a server mode: every classify_metagenome.sh call loads the
+    database itself. The service therefore keeps the database files mapped into memory so that each load is served
+    from RAM rather than disk, only runs set_targets.sh when the targets change, and combines the requests received
+    while a classification is running into a single classify_metagenome.sh call, so the database is loaded once for
+    all of them
+    """
+
+    def main(self):
+        """
+        Load the database, and serve requests until the service has been idle for the idle timeout
+        """
+        self.load()
+        listener = Listener(self.address, family='AF_UNIX', authkey=service_authkey())
+        # Only the current user may send requests
+        os.chmod(self.address, 0o600)
+        logging.info('CLARK classification service listening on {address}'.format(address=self.address))
+        # Send the threads to the appropriate destination functions
+        for target in [self.classifier, self.watchdog]:
+            threads = Thread(target=target, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
+        try:
+            while not self.finished:
+                try:
+                    connection = listener.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    # Clients that cannot authenticate are disconnected
+                    continue
+                threads = Thread(target=self.handle, args=(connection,))
+                threads.setDaemon(True)
+                threads.start()
+        finally:
+            listener.close()
+
+    def load(self):
+        """
+        Map the database files into memory, and read every page once so that they are resident
+        """
+        for root, dirs, files in os.walk(self.databasepath):
+            for name in sorted(files):
+                filepath = os.path.join(root, name)
+                try:
+                    with open(filepath, 'rb') as database:
+                        mapped = mmap.mmap(database.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    # Empty files cannot be mapped
+                    continue
+                self.mapped.append(mapped)
+        self.touch()
+        logging.info('Loaded {num} CLARK database files'.format(num=len(self.mapped)))
+
+    def touch(self):
+        """
+        Read one byte from every page of the mapped database files, so that pages that have been evicted from the page
+        cache are loaded again
+        """
+        for mapped in self.mapped:
+            for offset in range(0, len(mapped), mmap.PAGESIZE):
+                mapped[offset]
+
+    def handle(self, connection):
+        """
+        Receive a request, queue it for classification, and send the result back to the client
+        :param connection: Connection object of the client
+        """
+        try:
+            request = connection.recv()
+            self.lastrequest = time.time()
+            if request.get('ping'):
+                connection.send(0)
+                return
+            result = Queue()
+            self.requestqueue.put((request, result))
+            connection.send(result.get())
+        except (OSError, EOFError):
+            pass
+        finally:
+            connection.close()
+
+    def classifier(self):
+        while True:
+            request, result = self.requestqueue.get()
+            # The service must not exit while a classification is running, however long it takes
+            self.busy = True
+            batch = [(request, result)]
+            # Combine every other queued request that uses the same targets into the same CLARK call
+            key = self.targets(request)
+            deferred = list()
+            while True:
+                try:
+                    other = self.requestqueue.get_nowait()
+                except Empty:
+                    break
+                if self.targets(other[0]) == key:
+                    batch.append(other)
+                else:
+                    deferred.append(other)
+            for other in deferred:
+                self.requestqueue.put(other)
+            returncode = self.run(batch)
+            for request, result in batch:
+                result.put(returncode)
+            self.lastrequest = time.time()
+            self.busy = False
+
+    @staticmethod
+    def targets(request):
+        """
+        Extract the settings of a request that require a separate set_targets.sh or classify_metagenome.sh call
+        :param request: Dictionary of the request
+        :return: Tuple of the settings
+        """
+        return (request['clarkpath'], request['databasepath'], request['database'], request['rank'],
+                bool(request['light']))
+
+    def run(self, batch):
+        """
+        Classify the files of a batch of requests with a single call to classify_metagenome.sh
+        :param batch: List of (request, result queue) tuples with the same targets
+        :return: Return code of the classification call
+        """
+        request = batch[0][0]
+        clarkpath, databasepath, database, rank, light = self.targets(request)
+        filelist = tempfile.NamedTemporaryFile(mode='w', suffix='_sampleList.txt', delete=False)
+        reportlist = tempfile.NamedTemporaryFile(mode='w', suffix='_reportList.txt', delete=False)
+        with filelist, reportlist:
+            for other, result in batch:
+                for fastq, report in zip(other['files'], other['reports']):
+                    filelist.write(fastq + '\n')
+                    reportlist.write(report + '\n')
+        classifycall = 'cd {cp} && ./classify_metagenome.sh -O {fl} -R {rl} -n {cpus}{light}' \
+            .format(cp=clarkpath,
+                    fl=filelist.name,
+                    rl=reportlist.name,
+                    cpus=max(other['cpus'] for other, result in batch),
+                    light=' --light' if light else '')
+        logging.info('Classifying {num} files from {requests} requests'
+                     .format(num=sum(len(other['files']) for other, result in batch),
+                             requests=len(batch)))
+        # Hold a shared lock on the targets while classifying, so that other pipelines using the installation cannot
+        # change them until the batch is classified. The targets are only set if they differ from the current targets
+        with clarktargets.classification(clarkpath=clarkpath,
+                                         databasepath=databasepath,
+                                         database=database,
+                                         rank=rank):
+            returncode = resources.call(classifycall, memory=classification_memory(light),
+                                        name='classify_metagenome.sh', shell=True, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        for listfile in [filelist.name, reportlist.name]:
+            os.remove(listfile)
+        return returncode
+
+    def watchdog(self):
+        """
+        Keep the database resident, and stop the service once it has been idle for the idle timeout
+        """
+        while True:
+            time.sleep(min(60, self.idle))
+            if self.expired():
+                logging.info('CLARK classification service idle; exiting')
+                self.finished = True
+                try:
+                    os.remove(self.address)
+                except FileNotFoundError:
+                    pass
+                os._exit(0)
+            self.touch()
+
+    def expired(self):
+        """
+        Determine whether the service has been idle for the idle timeout: no classification is running or queued, and
+        no request has been received since the idle timeout
+        :return: True if the service can exit
+        """
+        return not self.busy and self.requestqueue.empty() and time.time() - self.lastrequest > self.idle
+
+    def __init__(self, clarkpath, databasepath, address=None, idle=3600):
+        """
+        :param clarkpath: Path to the CLARK scripts
+        :param databasepath: Path of the CLARK database files
+        :param address: Path of the Unix socket on which to listen
+        :param idle: Number of seconds without requests after which the service exits
+        """
+        self.clarkpath = clarkpath
+        self.databasepath = databasepath
+        self.address = address if address else service_address()
+        self.idle = float(idle)
+        self.mapped = list()
+        self.requestqueue = Queue()
+        self.lastrequest = time.time()
+        self.busy = False
+        self.finished = False
+        # Remove the socket left behind by a service that did not exit cleanly
+        if os.path.exists(self.address) and not running(self.address):
+            os.remove(self.address)
+
+
+if __name__ == '__main__':
+    # Parser for arguments
+    parser = ArgumentParser(description='Long-lived CLARK classification service')
+    parser.add_argument('-C', '--clarkpath',
+                        required=True,
+                        help='Path to the CLARK scripts')
+    parser.add_argument('-d', '--databasepath',
+                        required=True,
+                        help='Path of CLARK database files to keep in memory')
+    parser.add_argument('-a', '--address',
+                        help='Path of the Unix socket on which to listen. Default is a socket in a private per-user '
+                             'directory')
+    parser.add_argument('-i', '--idle',
+                        default=3600,
+                        type=float,
+                        help='Number of seconds without requests after which the service exits. Default is 3600')
+    arguments = parser.parse_args()
+    SetupLogging()
+    service = ClassificationService(clarkpath=arguments.clarkpath,
+                                    databasepath=arguments.databasepath,
+                                    address=arguments.address,
+                                    idle=arguments.idle)
+    service.main()
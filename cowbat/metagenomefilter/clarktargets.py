@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+from cowbat.pipelinetools import resources
+from contextlib import contextmanager
+import subprocess
+import hashlib
+import logging
+import fcntl
+import json
+import os
+__author__ = 'adamkoziol'
+
+# Files in the CLARK installation folder storing the fingerprint of the current targets, and serialising changes to them.
+# Classifications hold a shared lock on the lock file, and changes to the targets require an exclusive lock
+state_file = '.cowbat_targets.json'
+lock_file = '.cowbat_targets.lock'
+
+
+def fingerprint(clarkpath, databasepath, database, rank):
+    """
+    Fingerprint the target configuration of a CLARK installation. set_targets.sh records its settings in the .settings
+    file of the installation, so the fingerprint includes the checksum of that file as well as the database path, name,
+    and rank, and the modification times of the genome folders of the database (which change when genomes are added or
+    removed). The modification time of the database folder itself is not used, as CLARK writes the files of its
+    database there during the first classification with new targets
+    :param clarkpath: Path of the CLARK installation
+    :param databasepath: Path of the CLARK database
+    :param database: Name of the CLARK database
+    :param rank: Taxonomic rank of the classifications
+    :return: Hex digest, or None if the targets have not been set
+    """
+    try:
+        with open(os.path.join(clarkpath, '.settings'), 'rb') as settings:
+            contents = settings.read()
+        modified = sorted((entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(databasepath)
+                          if entry.is_dir())
+    except OSError:
+        return None
+    configuration = json.dumps([os.path.abspath(databasepath), database, rank, modified,
+                                hashlib.sha256(contents).hexdigest()])
+    return hashlib.sha256(configuration.encode()).hexdigest()
+
+
+def recorded(clarkpath):
+    """
+    Read the fingerprint stored after the previous set_targets.sh call
+    :param clarkpath: Path of the CLARK installation
+    :return: Hex digest, or None if no fingerprint has been stored
+    """
+    try:
+        with open(os.path.join(clarkpath, state_file), 'r') as state:
+            return json.load(state).get('fingerprint')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def unchanged(clarkpath, databasepath, database, rank):
+    """
+    Determine whether the CLARK installation already uses the requested targets
+    :param clarkpath: Path of the CLARK installation
+    :param databasepath: Path of the CLARK database
+    :param database: Name of the CLARK database
+    :param rank: Taxonomic rank of the classifications
+    :return: True if the stored fingerprint matches the fingerprint of the requested targets
+    """
+    current = fingerprint(clarkpath, databasepath, database, rank)
+    return bool(current) and current == recorded(clarkpath)
+
+
+def update_targets(clarkpath, databasepath, database, rank):
+    """
+    Run set_targets.sh, and store the fingerprint of the new targets. The exclusive lock must be held, and the
+    fingerprint is checked again, as another pipeline may have set the same targets while waiting on the lock
+    :param clarkpath: Path of the CLARK installation
+    :param databasepath: Path of the CLARK database
+    :param database: Name of the CLARK database
+    :param rank: Taxonomic rank of the classifications
+    :return: True if set_targets.sh was run
+    """
+    if unchanged(clarkpath, databasepath, database, rank):
+        logging.info('CLARK targets are unchanged')
+        return False
+    logging.info('Setting CLARK targets')
+    targetcall = 'cd {cp} && ./set_targets.sh {dp} {db} --{rank}'.format(cp=clarkpath,
+                                                                         dp=databasepath,
+                                                                         db=database,
+                                                                         rank=rank)
+    resources.call(targetcall, cores=1, name='set_targets.sh', shell=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    # Store the fingerprint of the new targets. The state file is replaced atomically, so other pipelines never read a
+    # partial fingerprint
+    current = fingerprint(clarkpath, databasepath, database, rank)
+    if current:
+        temporary = os.path.join(clarkpath, state_file + '.tmp')
+        with open(temporary, 'w') as state:
+            json.dump({'fingerprint': current,
+                       'databasepath': os.path.abspath(databasepath),
+                       'database': database,
+                       'rank': rank}, state, sort_keys=True, indent=4, separators=(',', ': '))
+        os.replace(temporary, os.path.join(clarkpath, state_file))
+    return True
+
+
+def set_targets(clarkpath, databasepath, database, rank):
+    """
+    Set the CLARK targets, unless the stored fingerprint shows that the installation already uses the same targets.
+    The targets are shared by every pipeline on the node that uses the installation, so changes are made under an
+    exclusive lock: a pipeline waiting on the lock re-checks the fingerprint once it acquires it, and does not set the
+    targets again if another pipeline has just set the same targets. The exclusive lock also waits for the
+    classifications of other pipelines (see classification) to finish
+    :param clarkpath: Path of the CLARK installation
+    :param databasepath: Path of the CLARK database
+    :param database: Name of the CLARK database
+    :param rank: Taxonomic rank of the classifications
+    :return: True if set_targets.sh was run
+    """
+    if unchanged(clarkpath, databasepath, database, rank):
+        logging.info('CLARK targets are unchanged')
+        return False
+    with open(os.path.join(clarkpath, lock_file), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return update_targets(clarkpath, databasepath, database, rank)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+@contextmanager
+def classification(clarkpath, databasepath, database, rank, ready=None):
+    """
+    Hold a shared lock on the CLARK targets for the duration of a classification, so that no other pipeline can change
+    the targets until the classification finishes. Any number of pipelines can classify with the same targets at once.
+    If the targets differ, the shared lock is exchanged for an exclusive lock to set them. flock does not convert
+    locks atomically, so the targets are checked again once the shared lock is re-acquired
+    :param clarkpath: Path of the CLARK installation
+    :param databasepath: Path of the CLARK database
+    :param database: Name of the CLARK database
+    :param rank: Taxonomic rank of the classifications
+    :param ready: Optional function returning True if the targets are already set e.g. by a database bundle
+    """
+    with open(os.path.join(clarkpath, lock_file), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        try:
+            while not ((ready is not None and ready()) or unchanged(clarkpath, databasepath, database, rank)):
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                update_targets(clarkpath, databasepath, database, rank)
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                # Without a fingerprint (e.g. set_targets.sh failed), the targets cannot be confirmed, so classify
+                # with the targets as they are rather than setting them indefinitely
+                if not fingerprint(clarkpath, databasepath, database, rank):
+                    logging.warning('Could not confirm the CLARK targets')
+                    break
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
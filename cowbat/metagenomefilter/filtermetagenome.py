@@ -2,15 +2,16 @@
 from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path, MetadataObject
 import olctools.accessoryFunctions.metadataprinter as metadataprinter
 from genemethods.assemblypipeline import createobject
+from cowbat.metagenomefilter.readindex import build_index
 from argparse import ArgumentParser
 from threading import Thread
-from subprocess import call
 from csv import DictReader
 from queue import Queue
 import multiprocessing
 from time import time
 import subprocess
 import logging
+import gzip
 import os
 __author__ = 'adamkoziol'
 
@@ -50,7 +51,6 @@ class FilterGenome(object):
             for taxid in sample.general.taxids:
                 # Create the an attribute for each taxID
                 setattr(sample, taxid, GenObject())
-                sample[taxid].readlist = list()
         # Print the metadata to file
         metadataprinter.MetadataPrinter(self)
         # Load the assignment file to memory
@@ -58,40 +58,33 @@ class FilterGenome(object):
 
     def loadassignment(self):
         """
-        Load the taxonomic assignment for each read
+        Load the taxonomic assignment for each read. Parsing the assignment files is CPU-bound, so the samples are
+        indexed in a pool of processes rather than threads
         """
         logging.info('Finding taxonomic assignments')
-        # Create and start threads
-        for i in range(self.cpus):
-            # Send the threads to the appropriate destination function
-            threads = Thread(target=self.assignmentload, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
+        # Set and create the path of the sorted fastq files
         for sample in self.runmetadata.samples:
-            self.loadqueue.put(sample)
-        self.loadqueue.join()
+            sample.general.sortedfastqpath = os.path.join(sample.general.outputdirectory, 'sortedFastq')
+            make_path(sample.general.sortedfastqpath)
+        # Only plain values are sent to the worker processes; the ReadIndex objects that are returned only contain the
+        # names of the index files and the number of reads assigned to each taxID
+        arguments = [(sample.general.taxids, os.path.join(sample.general.sortedfastqpath, 'readindex'),
+                      sample.general.assignmentfile) for sample in self.runmetadata.samples]
+        with multiprocessing.Pool(processes=self.processes()) as pool:
+            readindexes = pool.starmap(build_index, arguments)
+        for sample, readindex in zip(self.runmetadata.samples, readindexes):
+            for taxid, count in zip(sample.general.taxids, readindex.counts):
+                sample[taxid].readcount = count
+            self.readindex[sample.name] = readindex
         # Filter the .fastq files
         self.readlist()
 
-    def assignmentload(self):
-        while True:
-            sample = self.loadqueue.get()
-            # Initialise dictionaries to store results
-            sample.general.fastqassignment = dict()
-            sample.general.reads = dict()
-            # Read the assignment file into a dictionary
-            with open(sample.general.assignmentfile, 'r') as assignmentcsv:
-                for row in assignmentcsv:
-                    # Split on ','
-                    data = row.split(',')
-                    # Each row contains: Object_ID, Length, Assignment
-                    # If the Assignment is one of the taxIDs of interest
-                    if data[2].rstrip() in sample.general.taxids:
-                        # Add the read name to the list of reads associated with that taxID
-                        sample[data[2].rstrip()].readlist.append(data[0])
-            self.loadqueue.task_done()
+    def processes(self):
+        """
+        Determine the number of worker processes to use
+        :return: The smaller of the number of cpus and the number of samples
+        """
+        return max(1, min(int(self.cpus), len(self.runmetadata.samples)))
 
     def readlist(self):
         """
@@ -115,9 +108,6 @@ class FilterGenome(object):
     def listread(self):
         while True:
             sample = self.listqueue.get()
-            # Set and create the path of the sorted fastq files
-            sample.general.sortedfastqpath = os.path.join(sample.general.outputdirectory, 'sortedFastq')
-            make_path(sample.general.sortedfastqpath)
             # Initialise dictionaries to hold data
             sample.general.fastqlist = dict()
             sample.general.filteredfastq = dict()
@@ -131,46 +121,90 @@ class FilterGenome(object):
                 sample.general.filteredfastq[taxid] = os.path.join(sample.general.sortedfastqpath,
                                                                    '{sn}_{taxid}.fastq.gz'.format(sn=sample.name,
                                                                                                   taxid=taxid))
-                # Open the list, and write the list of all reads, one per line
-                with open(sample.general.fastqlist[taxid], 'w') as binned:
-                    binned.write('\n'.join(set(sample[taxid].readlist)))
+            # Optionally write the lists of all reads, one per line
+            if self.readlists:
+                self.writelists(sample)
             self.listqueue.task_done()
 
+    @staticmethod
+    def writelists(sample):
+        """
+        Write the names of the reads assigned to each taxID of interest to the taxID-specific list
+        :param sample: Metadata object of the sample
+        """
+        binned = {taxid: open(sample.general.fastqlist[taxid], 'w') for taxid in sample.general.taxids}
+        try:
+            # Stream the assignment file rather than storing the read names
+            with open(sample.general.assignmentfile, 'r') as assignmentcsv:
+                for row in assignmentcsv:
+                    # Each row contains: Object_ID, Length, Assignment
+                    data = row.split(',')
+                    try:
+                        binned[data[2].rstrip()].write(data[0] + '\n')
+                    except (IndexError, KeyError):
+                        pass
+        finally:
+            for listfile in binned.values():
+                listfile.close()
+
     def fastqfilter(self):
         """
-        Filter the reads into separate files based on taxonomic assignment
+        Filter the reads into separate files based on taxonomic assignment. Demultiplexing is CPU-bound, so the samples
+        are filtered in a pool of processes
         """
         logging.info('Creating filtered .fastqfiles')
-        # Create and start threads
-        for i in range(self.cpus):
-            # Send the threads to the appropriate destination function
-            threads = Thread(target=self.filterfastq, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
+        arguments = list()
         for sample in self.runmetadata.samples:
-            self.filterqueue.put(sample)
-        self.filterqueue.join()
+            # Only create the filtered files that do not already exist
+            outputs = {taxid: sample.general.filteredfastq[taxid] for taxid in sample.general.taxids
+                       if not os.path.isfile(sample.general.filteredfastq[taxid])}
+            if outputs:
+                arguments.append((sample.general.fastqfiles[0], outputs, self.readindex[sample.name]))
+        with multiprocessing.Pool(processes=self.processes()) as pool:
+            pool.starmap(self.demultiplex, arguments)
+        # Delete the index files
+        for readindex in self.readindex.values():
+            readindex.remove()
         # Print the metadata to file
         metadataprinter.MetadataPrinter(self)
 
-    def filterfastq(self):
-        while True:
-            sample = self.filterqueue.get()
-            # Iterate through the taxIDs
-            for taxid in sample.general.taxids:
-                # Set the system call to seqtk to subsequence the fastq file
-                sample.general.seqtkcall = 'seqtk subseq {fastq} {list} | gzip > {filtered}' \
-                    .format(fastq=sample.general.fastqfiles[0],
-                            list=sample.general.fastqlist[taxid],
-                            filtered=sample.general.filteredfastq[taxid])
-                # Run the system call only if the filtered file does not exist
-                if not os.path.isfile(sample.general.filteredfastq[taxid]):
-                    call(sample.general.seqtkcall, shell=True, stdout=self.devnull, stderr=self.devnull)
-                # Delete the large list stored in the object
-                delattr(sample[taxid], "readlist")
-            self.filterqueue.task_done()
+    @staticmethod
+    def demultiplex(fastq, filteredfastq, readindex, batchsize=100000):
+        """
+        Read a .fastq file once, and write each read to the filtered .fastq file of the taxID to which it was assigned
+        :param fastq: Name and path of the .fastq(.gz) file to filter
+        :param filteredfastq: Dictionary of taxID: name and path of the filtered .fastq.gz file to create
+        :param readindex: ReadIndex object of the reads assigned to the taxIDs of interest
+        :param batchsize: Number of reads to look up in the index at once
+        """
+        # Write to temporary files, so that an interrupted filter does not leave truncated files that would be skipped
+        # on subsequent runs
+        outputs = {taxid: gzip.open(filtered + '.tmp', 'wt', compresslevel=6)
+                   for taxid, filtered in filteredfastq.items()}
+        try:
+            with gzip.open(fastq, 'rt') if fastq.endswith('.gz') else open(fastq, 'r') as fastqfile:
+                finished = False
+                while not finished:
+                    records = list()
+                    while len(records) < batchsize:
+                        # Each .fastq record is four lines: header, sequence, separator, and quality
+                        record = [fastqfile.readline() for i in range(4)]
+                        if not record[0]:
+                            finished = True
+                            break
+                        records.append(record)
+                    # The read name is the header up to the first whitespace, without the leading '@'
+                    names = [record[0][1:].split(maxsplit=1)[0] for record in records]
+                    for record, assigned in zip(records, readindex.lookup(names)):
+                        for taxid in assigned:
+                            # Reads may also be assigned to taxIDs with filtered files that already exist
+                            if taxid in outputs:
+                                outputs[taxid].write(''.join(record))
+        finally:
+            for output in outputs.values():
+                output.close()
+        for filtered in filteredfastq.values():
+            os.replace(filtered + '.tmp', filtered)
 
     def __init__(self, inputobject):
         # Define variables based on supplied arguments
@@ -185,10 +219,15 @@ class FilterGenome(object):
         self.cutoff = inputobject.cutoff
         # Initialise a variable to hold the sample objects
         self.runmetadata = inputobject.runmetadata if inputobject.runmetadata else MetadataObject()
+        # Optionally write the names of the reads assigned to each taxID to file
+        try:
+            self.readlists = inputobject.readlists
+        except AttributeError:
+            self.readlists = False
+        # Dictionary of sample name: ReadIndex object
+        self.readindex = dict()
         # Initialise queues
-        self.loadqueue = Queue()
         self.listqueue = Queue()
-        self.filterqueue = Queue()
         self.devnull = open(os.devnull, 'wb')
 
 
@@ -224,6 +263,9 @@ if __name__ == '__main__':
                                 help='Cutoff value for deciding which taxIDs to use when sorting .fastq files. '
                                      'Defaults to 1 percent. Please note that you must use a decimal format: enter 0.05'
                                      ' to get a 5 percent cutoff value')
+            parser.add_argument('-l', '--readlists',
+                                action='store_true',
+                                help='Write the names of the reads assigned to each taxID to a .txt file')
             parser.add_argument('-x', '--taxids',
                                 help='NOT IMPLEMENTED: CSV of desired taxIDs from each sample. ')
             # Get the arguments into an object
@@ -241,6 +283,7 @@ if __name__ == '__main__':
             self.cpus = args.threads if args.threads else multiprocessing.cpu_count()
             # Set the cutoff to be a percent
             self.cutoff = args.cutoff * 100
+            self.readlists = args.readlists
             # Run the pipeline
             self.runmetadata = MetadataObject()
             genome = FilterGenome(self)
@@ -266,9 +309,7 @@ class PipelineInit(object):
         # Initialise a variable to hold the sample objects
         self.runmetadata = inputobject.runmetadata
         # Initialise queues
-        self.loadqueue = Queue()
         self.listqueue = Queue()
-        self.filterqueue = Queue()
         self.devnull = open(os.devnull, 'wb')
         # Run the pipeline
         genome = FilterGenome(self)
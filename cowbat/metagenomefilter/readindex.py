@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+from array import array
+import numpy as np
+import hashlib
+import os
+__author__ = 'adamkoziol'
+
+
+def read_hash(name):
+    """
+    Hash a read name to a 64-bit integer. The built-in hash function is randomised for each process, so a stable hash
+    is used instead; indexes created in other processes remain valid
+    :param name: Read name
+    :return: Integer hash of the read name
+    """
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'little')
+
+
+def build_index(taxids, path, assignmentfile):
+    """
+    Create the index of the reads in an assignment file. Used as the target of worker processes
+    :param taxids: List of the taxIDs of interest
+    :param path: Path of the folder in which to store the index files
+    :param assignmentfile: Name and path of the CLARK assignment .csv file
+    :return: ReadIndex object
+    """
+    readindex = ReadIndex(taxids=taxids,
+                          path=path)
+    readindex.build(assignmentfile)
+    return readindex
+
+
+class ReadIndex(object):
+    """
+    Compact, on-disk index of the taxID assigned to each read. Each read is stored as a 64-bit hash of its name and a
+    16-bit position in the list of taxIDs: 10 bytes per read instead of a Python string in a list. Reads are added in
+    chunks; each full chunk is sorted and written to a .npy file that is memory-mapped when searched, so the memory
+    used does not depend on the number of reads
+    """
+
+    def build(self, assignmentfile):
+        """
+        Stream a CLARK assignment file, and index the reads assigned to the taxIDs of interest
+        :param assignmentfile: Name and path of the .csv file with rows of Object_ID, Length, Assignment
+        """
+        taxids = {taxid: position for position, taxid in enumerate(self.taxids)}
+        with open(assignmentfile, 'r') as assignmentcsv:
+            for row in assignmentcsv:
+                # Split on ','
+                data = row.split(',')
+                try:
+                    # Each row contains: Object_ID, Length, Assignment
+                    position = taxids[data[2].rstrip()]
+                except (IndexError, KeyError):
+                    continue
+                self.hashes.append(read_hash(data[0]))
+                self.positions.append(position)
+                self.counts[position] += 1
+                if len(self.hashes) >= self.chunksize:
+                    self.spill()
+        self.spill()
+
+    def spill(self):
+        """
+        Sort the current chunk of reads, and write it to file
+        """
+        if not self.hashes:
+            return
+        hashes = np.frombuffer(self.hashes, dtype=np.uint64)
+        positions = np.frombuffer(self.positions, dtype=np.uint16)
+        order = np.argsort(hashes, kind='stable')
+        chunk = os.path.join(self.path, 'chunk_{num}.npy'.format(num=len(self.chunks)))
+        np.save(chunk, np.rec.fromarrays([hashes[order], positions[order]], names='hash,position'))
+        self.chunks.append(chunk)
+        self.hashes = array('Q')
+        self.positions = array('H')
+
+    def lookup(self, names):
+        """
+        Find the taxIDs assigned to a batch of reads
+        :param names: List of read names
+        :return: List of the same length as names. Each entry is a list of the taxIDs assigned to the read
+        """
+        found = [list() for i in range(len(names))]
+        if not names:
+            return found
+        hashes = np.fromiter((read_hash(name) for name in names), dtype=np.uint64, count=len(names))
+        for chunk in self.chunks:
+            index = np.load(chunk, mmap_mode='r')
+            # The range of positions in the sorted chunk that have the hash of each read
+            left = np.searchsorted(index['hash'], hashes, side='left')
+            right = np.searchsorted(index['hash'], hashes, side='right')
+            for i in np.nonzero(right > left)[0]:
+                for position in index['position'][left[i]:right[i]]:
+                    taxid = self.taxids[position]
+                    if taxid not in found[i]:
+                        found[i].append(taxid)
+        return found
+
+    def remove(self):
+        """
+        Delete the index files
+        """
+        for chunk in self.chunks:
+            try:
+                os.remove(chunk)
+            except FileNotFoundError:
+                pass
+        self.chunks = list()
+
+    def __init__(self, taxids, path, chunksize=1000000):
+        """
+        :param taxids: List of the taxIDs of interest
+        :param path: Path of the folder in which to store the index files
+        :param chunksize: Number of reads to hold in memory before writing them to file
+        """
+        self.taxids = list(taxids)
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.chunksize = chunksize
+        self.chunks = list()
+        self.hashes = array('Q')
+        self.positions = array('H')
+        # Number of reads assigned to each taxID
+        self.counts = [0] * len(self.taxids)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+from threading import Lock
+import hashlib
+import logging
+import shutil
+import json
+import os
+__author__ = 'adamkoziol'
+
+
+class BlastCache(object):
+    """
+    Content-addressed cache of the BLAST reports of assemblies. Reports are keyed on the hash of the assembly, the hash
+    of the target database, the analysis type, the BLAST program, and the cutoff, so a report is re-used for any sample
+    (in any run) with the same assembly and database. The least recently used reports are evicted once the cache
+    exceeds its maximum size
+    """
+
+    def seekr(self, blast):
+        """
+        Run a BLAST-based analysis, re-using the cached BLAST reports of previously analysed assemblies, and storing
+        the new reports in the cache
+        :param blast: BLAST object (or subclass e.g. Prophages) that has not yet been run
+        """
+        keys = self.restore(blast)
+        blast.seekr()
+        self.store(blast, keys)
+
+    def restore(self, blast):
+        """
+        Copy the cached BLAST reports of the samples to the locations at which the BLAST step expects them. BLAST is
+        skipped for samples with an existing report
+        :param blast: BLAST object
+        :return: Dictionary of sample name: cache key
+        """
+        keys = dict()
+        restored = 0
+        for sample in blast.metadata:
+            key = self.key(blast, sample)
+            if key is None:
+                continue
+            keys[sample.name] = key
+            report = self.report(blast, sample)
+            if os.path.isfile(report) and os.path.getsize(report):
+                continue
+            cached = self.cached_report(key)
+            if os.path.isfile(cached):
+                os.makedirs(os.path.dirname(report), exist_ok=True)
+                shutil.copyfile(cached, report)
+                # Update the modification time of the cached report to mark it as recently used
+                os.utime(cached)
+                restored += 1
+        if restored:
+            logging.info('Re-using cached {at} BLAST reports for {num} samples'.format(at=blast.analysistype,
+                                                                                      num=restored))
+        return keys
+
+    def store(self, blast, keys):
+        """
+        Add the new BLAST reports of the samples to the cache, and evict the least recently used reports as required
+        :param blast: BLAST object that has been run
+        :param keys: Dictionary of sample name: cache key created before the analysis was run
+        """
+        for sample in blast.metadata:
+            try:
+                key = keys[sample.name]
+            except KeyError:
+                continue
+            cached = self.cached_report(key)
+            report = self.report(blast, sample)
+            if os.path.isfile(cached) or not os.path.isfile(report) or not os.path.getsize(report):
+                continue
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            # Copy to a temporary file first, so that an interrupted copy is never used
+            shutil.copyfile(report, cached + '.tmp')
+            os.replace(cached + '.tmp', cached)
+        self.evict()
+
+    def key(self, blast, sample):
+        """
+        Create the cache key of the analysis of a sample
+        :param blast: BLAST object
+        :param sample: Metadata object of the sample
+        :return: Hex digest, or None if the sample does not have an assembly or a target database
+        """
+        try:
+            assembly = sample.general.bestassemblyfile
+            database = sample[blast.analysistype].combinedtargets
+        except (AttributeError, KeyError):
+            return None
+        if not os.path.isfile(assembly) or not os.path.isfile(database):
+            return None
+        identity = json.dumps({'assembly': self.file_hash(assembly),
+                               'database': self.file_hash(database),
+                               'analysistype': blast.analysistype,
+                               'program': blast.program,
+                               'cutoff': str(blast.cutoff)}, sort_keys=True)
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    @staticmethod
+    def report(blast, sample):
+        """
+        Determine the name of the BLAST report of a sample. Matches the name used by GeneSeekr.run_blast
+        :param blast: BLAST object
+        :param sample: Metadata object of the sample
+        :return: Name and path of the report
+        """
+        return os.path.join(sample[blast.analysistype].reportdir,
+                            '{name}_{program}_{at}.tsv'.format(name=sample.name,
+                                                               program=blast.program,
+                                                               at=blast.analysistype))
+
+    def cached_report(self, key):
+        # Reports are spread between subfolders named after the first two characters of their keys
+        return os.path.join(self.path, key[:2], '{key}.tsv'.format(key=key))
+
+    def file_hash(self, path):
+        """
+        Hash the contents of a file. Hashes are stored for the duration of the run, and recalculated if the size or
+        modification time of the file changes
+        :param path: Name and path of the file
+        :return: Hex digest
+        """
+        stats = os.stat(path)
+        identity = (path, stats.st_size, stats.st_mtime_ns)
+        with self.lock:
+            if identity in self.hashes:
+                return self.hashes[identity]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as hashed:
+            for block in iter(lambda: hashed.read(1048576), b''):
+                digest.update(block)
+        with self.lock:
+            self.hashes[identity] = digest.hexdigest()
+        return self.hashes[identity]
+
+    def evict(self):
+        """
+        Remove the least recently used reports until the cache is no larger than its maximum size
+        """
+        if not self.maxsize:
+            return
+        reports = list()
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                if name.endswith('.tsv'):
+                    stats = os.stat(os.path.join(root, name))
+                    reports.append((stats.st_mtime, stats.st_size, os.path.join(root, name)))
+        total = sum(size for mtime, size, report in reports)
+        for mtime, size, report in sorted(reports):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(report)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def __init__(self, path, maxsize=0):
+        """
+        :param path: Path of the folder in which to store the cached reports
+        :param maxsize: Maximum size of the cache in bytes. 0 does not limit the size of the cache
+        """
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.maxsize = int(maxsize) if maxsize else 0
+        self.hashes = dict()
+        self.lock = Lock()
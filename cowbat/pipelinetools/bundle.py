@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+from olctools.accessoryFunctions.accessoryFunctions import combinetargets, SetupLogging
+from cowbat.metagenomefilter import clarkservice, clarktargets
+from cowbat.get.manifest import file_hash
+from cowbat.pipelinetools import resources
+from argparse import ArgumentParser
+from threading import Lock
+from shutil import rmtree, which
+from glob import glob
+import tempfile
+import hashlib
+import logging
+import time
+import json
+import os
+__author__ = 'adamkoziol'
+
+# Name of the file describing the bundle, stored in the reference database folder
+bundle_file = 'bundle.json'
+# Extensions of the files of the BLAST databases and KMA indexes that the typing methods create when they are missing
+index_extensions = ('.nhr', '.nin', '.nsq', '.nog', '.nsd', '.nsi', '.ndb', '.not', '.ntf', '.nto', '.njs', '.nos',
+                    '.nal', '.length.b', '.comp.b', '.seq.b', '.index.b', '.name', '.fai')
+
+
+def runtime_artefact(relative):
+    """
+    Determine whether a file that is not part of a bundle was created by the pipeline while using the databases: the
+    combined targets, BLAST databases, and KMA indexes created by the typing methods, and the files that CLARK creates
+    in its database folder when it classifies or sets targets. These files do not change the databases, so they do not
+    invalidate the bundle
+    :param relative: Path of the file relative to the reference database folder
+    :return: True if the file is a runtime artefact
+    """
+    parts = relative.split(os.sep)
+    if parts[0] == 'clark' and (len(parts) == 2 or '.tsk' in parts[-1]):
+        return True
+    return parts[-1] == 'combinedtargets.fasta' or parts[-1].endswith(index_extensions)
+
+
+class DatabaseBundle(object):
+    """
+    A versioned reference database folder with all of its indexes (combined targets, BLAST databases, KMA indexes, and
+    CLARK targets) built in advance, and the size, modification time, and checksum of every file recorded in
+    bundle.json. At runtime, a bundle whose files match the record is used as is, so the stages do not need to check or
+    build any indexes, and the ledger uses the bundle version rather than scanning the database folders
+    """
+
+    def build(self):
+        """
+        Build all the indexes, and record the bundle
+        """
+        logging.info('Building database bundle {version} in {path}'.format(version=self.version,
+                                                                          path=self.reffilepath))
+        for fasta in self.combined_targets():
+            self.makeblastdb(fasta)
+            if os.path.relpath(fasta, self.reffilepath).split(os.sep)[0] in self.kma_databases:
+                self.kma_index(fasta)
+        self.clark_targets()
+        self.write()
+
+    def combined_targets(self):
+        """
+        Find the combined targets file of each target folder (a folder containing .tfa files), creating it as the
+        typing methods would if it does not exist
+        :return: Sorted list of the combined targets files
+        """
+        combined = list()
+        for root, dirs, files in os.walk(self.reffilepath):
+            dirs.sort()
+            if not any(name.endswith('.tfa') for name in files):
+                continue
+            fasta = sorted(glob(os.path.join(root, '*.fasta')))
+            if not fasta:
+                # Genus-specific target folders (below the folder of the analysis) are combined with the headers
+                # cleared of NCBI-like formatting, while the targets of genus-agnostic analyses are combined as is
+                depth = len(os.path.relpath(root, self.reffilepath).split(os.sep))
+                combinetargets(targets=sorted(glob(os.path.join(root, '*.tfa'))),
+                               targetpath=root,
+                               clear_format=depth > 1)
+                fasta = sorted(glob(os.path.join(root, '*.fasta')))
+            combined.append(fasta[0])
+        return combined
+
+    def makeblastdb(self, fasta):
+        """
+        Create the BLAST database of a combined targets file with the same command and name as the typing methods
+        :param fasta: Name and path of the combined targets file
+        """
+        output = os.path.splitext(fasta)[0]
+        if os.path.isfile(output + '.nhr'):
+            self.indexes['blast'].append(os.path.relpath(fasta, self.reffilepath))
+            return
+        if not which('makeblastdb'):
+            logging.warning('makeblastdb is not installed; BLAST databases will be created at runtime')
+            return
+        resources.call('makeblastdb -in {fasta} -parse_seqids -max_file_sz 2GB -dbtype nucl -out {output}'
+                       .format(fasta=fasta,
+                               output=output),
+                       cores=1, shell=True, stdout=self.devnull, stderr=self.devnull)
+        if os.path.isfile(output + '.nhr'):
+            self.indexes['blast'].append(os.path.relpath(fasta, self.reffilepath))
+
+    def kma_index(self, fasta, kmer=16):
+        """
+        Create the KMA index of a combined targets file with the same command and name as the KMA typing methods
+        :param fasta: Name and path of the combined targets file
+        :param kmer: k-mer size of the index
+        """
+        output = os.path.splitext(fasta)[0]
+        if os.path.isfile(output + '.length.b'):
+            self.indexes['kma'].append(os.path.relpath(fasta, self.reffilepath))
+            return
+        if not which('kma'):
+            logging.warning('kma is not installed; KMA indexes will be created at runtime')
+            return
+        resources.call('kma index -i {fasta} -o {output} -k {kmer} -k_t {kmer} -k_i {kmer}'
+                       .format(fasta=fasta,
+                               output=output,
+                               kmer=kmer),
+                       cores=1, shell=True, stdout=self.devnull, stderr=self.devnull)
+        if os.path.isfile(output + '.length.b'):
+            self.indexes['kma'].append(os.path.relpath(fasta, self.reffilepath))
+
+    def clark_targets(self, database='bacteria', rank='species'):
+        """
+        Set the CLARK targets of the CLARK database in the bundle
+        :param database: Name of the CLARK database
+        :param rank: Taxonomic rank of the classifications
+        """
+        databasepath = os.path.join(self.reffilepath, 'clark', '')
+        if not os.path.isdir(databasepath):
+            return
+        if not self.clarkpath or not os.path.isfile(os.path.join(self.clarkpath, 'set_targets.sh')):
+            logging.warning('Could not find the CLARK installation; CLARK targets will be set at runtime')
+            return
+        clarktargets.set_targets(clarkpath=self.clarkpath,
+                                 databasepath=databasepath,
+                                 database=database,
+                                 rank=rank)
+        self.prime_clark()
+        self.indexes['clark'] = {'database': database,
+                                 'rank': rank}
+
+    def prime_clark(self):
+        """
+        Classify a single short sequence in light mode (as the pipeline does), so that CLARK creates the files of its
+        database, which it otherwise creates during the first classification of a run, before the bundle is recorded
+        """
+        logging.info('Creating the CLARK database files')
+        primepath = tempfile.mkdtemp(prefix='cowbat_bundle_')
+        try:
+            fasta = os.path.join(primepath, 'prime.fasta')
+            with open(fasta, 'w') as prime:
+                prime.write('>prime\n{sequence}\n'.format(sequence='ACGT' * 50))
+            filelist = os.path.join(primepath, 'sampleList.txt')
+            reportlist = os.path.join(primepath, 'reportList.txt')
+            with open(filelist, 'w') as files:
+                files.write(fasta + '\n')
+            with open(reportlist, 'w') as reports:
+                reports.write(os.path.join(primepath, 'prime') + '\n')
+            resources.call('cd {cp} && ./classify_metagenome.sh -O {fl} -R {rl} -n 1 --light'
+                           .format(cp=self.clarkpath,
+                                   fl=filelist,
+                                   rl=reportlist),
+                           memory=clarkservice.classification_memory(True), name='classify_metagenome.sh',
+                           shell=True, stdout=self.devnull, stderr=self.devnull)
+        finally:
+            rmtree(primepath)
+
+    def clark_ready(self, clarkpath, databasepath, database, rank):
+        """
+        Determine whether the CLARK targets of the bundle can be used without running set_targets.sh again. The targets
+        are set in the CLARK installation, so the installation must still refer to the bundled database
+        :param clarkpath: Path of the CLARK installation
+        :param databasepath: Path of the CLARK database
+        :param database: Name of the CLARK database
+        :param rank: Taxonomic rank of the classifications
+        :return: True if the targets are set
+        """
+        if not self.valid() or self.indexes.get('clark') != {'database': database, 'rank': rank}:
+            return False
+        try:
+            with open(os.path.join(clarkpath, '.settings'), 'r') as settings:
+                return os.path.abspath(databasepath) in settings.read()
+        except OSError:
+            return False
+
+    def files(self):
+        """
+        Find all the files of the reference database folder, other than the bundle record itself
+        :return: Sorted list of the paths of the files relative to the reference database folder
+        """
+        found = list()
+        for root, dirs, files in os.walk(self.reffilepath):
+            dirs.sort()
+            for name in sorted(files):
+                relative = os.path.relpath(os.path.join(root, name), self.reffilepath)
+                if relative != bundle_file:
+                    found.append(relative)
+        return found
+
+    def write(self):
+        """
+        Record the version, indexes, and the size, modification time, and checksum of every file of the bundle
+        """
+        logging.info('Calculating the checksums of the database files')
+        record = dict()
+        for relative in self.files():
+            path = os.path.join(self.reffilepath, relative)
+            stats = os.stat(path)
+            record[relative] = {'size': stats.st_size,
+                                'mtime': stats.st_mtime_ns,
+                                'sha256': file_hash(path)}
+        self.record = record
+        with open(self.bundle_path + '.tmp', 'w') as bundle:
+            json.dump({'version': self.version,
+                       'built': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'indexes': self.indexes,
+                       'files': record}, bundle, sort_keys=True, indent=4, separators=(',', ': '))
+        os.replace(self.bundle_path + '.tmp', self.bundle_path)
+        self.status = None
+        logging.info('Recorded {num} files in {bundle}'.format(num=len(record),
+                                                               bundle=self.bundle_path))
+
+    def verify(self, checksums=False):
+        """
+        Compare the files of the reference database folder to the bundle record
+        :param checksums: Boolean of whether to compare the checksums of the files, rather than their sizes and
+        modification times
+        :return: List of the problems found. Empty if the bundle is intact
+        """
+        if not self.record:
+            return ['No bundle found in {path}'.format(path=self.reffilepath)]
+        problems = list()
+        present = set()
+        for relative in self.files():
+            present.add(relative)
+            expected = self.record.get(relative)
+            if expected is None:
+                # Indexes created at runtime (e.g. for a database folder added after the bundle was built) do not
+                # change the databases
+                if runtime_artefact(relative):
+                    continue
+                problems.append('{file} is not part of the bundle'.format(file=relative))
+                continue
+            path = os.path.join(self.reffilepath, relative)
+            try:
+                stats = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stats.st_size != expected['size']:
+                problems.append('{file} has changed size'.format(file=relative))
+            elif checksums:
+                if file_hash(path) != expected['sha256']:
+                    problems.append('{file} has changed contents'.format(file=relative))
+            elif stats.st_mtime_ns != expected['mtime']:
+                problems.append('{file} has been modified'.format(file=relative))
+        for relative in sorted(set(self.record) - present):
+            problems.append('{file} is missing'.format(file=relative))
+        return problems
+
+    def valid(self):
+        """
+        Determine (once) whether the reference database folder is an intact bundle, using the sizes and modification
+        times of the files
+        :return: True if the bundle can be used without preparing any databases
+        """
+        with self.lock:
+            if self.status is None:
+                problems = self.verify()
+                self.status = not problems
+                if self.record and problems:
+                    logging.warning('The database bundle in {path} is out of date ({problem}); indexes will be checked '
+                                    'at runtime'.format(path=self.reffilepath,
+                                                        problem=problems[0]))
+                elif self.status:
+                    logging.info('Using database bundle {version}'.format(version=self.version))
+            return self.status
+
+    def database_digest(self, path):
+        """
+        Determine the version of a database in the bundle from the bundle version, rather than scanning its files
+        :param path: Path of the database folder (or file)
+        :return: Hex digest, or None if the path is not part of a valid bundle
+        """
+        relative = os.path.relpath(os.path.abspath(path), self.reffilepath)
+        if relative.startswith(os.pardir) or not self.valid():
+            return None
+        return hashlib.sha256('{version}:{built}:{path}'.format(version=self.version,
+                                                                built=self.built,
+                                                                path=relative).encode()).hexdigest()
+
+    def __init__(self, reffilepath, version=None, clarkpath=None):
+        """
+        :param reffilepath: Path of the reference database folder
+        :param version: Version of the bundle to build. Default is the date of the build
+        :param clarkpath: Path of the CLARK installation (containing set_targets.sh) in which to set the targets
+        """
+        self.reffilepath = os.path.abspath(reffilepath)
+        self.bundle_path = os.path.join(self.reffilepath, bundle_file)
+        self.clarkpath = clarkpath
+        self.devnull = open(os.devnull, 'wb')
+        self.indexes = {'blast': list(), 'kma': list(), 'clark': None}
+        # Analyses (top-level folders of the reference database folder) that are typed with KMA
+        self.kma_databases = ['cgMLST']
+        # Result of the validity check. None until the bundle has been checked
+        self.status = None
+        self.lock = Lock()
+        self.built = str()
+        self.record = dict()
+        try:
+            with open(self.bundle_path, 'r') as bundle:
+                existing = json.load(bundle)
+            self.record = existing['files']
+            self.built = existing['built']
+            self.indexes = existing['indexes']
+            self.version = version if version else existing['version']
+        except (FileNotFoundError, ValueError, KeyError):
+            self.version = version if version else time.strftime('%Y.%m.%d')
+
+
+if __name__ == '__main__':
+    # Parser for arguments
+    parser = ArgumentParser(description='Build a versioned bundle of the reference databases with all of their '
+                                        'indexes, or verify an existing bundle')
+    parser.add_argument('-r', '--referencefilepath',
+                        required=True,
+                        help='Path of the folder containing the pipeline accessory files (reference genomes, MLST '
+                             'data, etc.)')
+    parser.add_argument('-b', '--bundleversion',
+                        help='Version of the bundle. Default is the date of the build')
+    parser.add_argument('-c', '--clarkpath',
+                        help='Path of the CLARK installation (containing set_targets.sh). Default is found from the '
+                             'CLARK executable')
+    parser.add_argument('-V', '--verify',
+                        action='store_true',
+                        help='Verify the checksums of the files of an existing bundle rather than building it')
+    arguments = parser.parse_args()
+    SetupLogging()
+    clarkpath = arguments.clarkpath
+    if not clarkpath and which('CLARK'):
+        clarkpath = os.path.join(os.path.dirname(which('CLARK')), '..', 'opt', 'clark')
+    database_bundle = DatabaseBundle(reffilepath=arguments.referencefilepath,
+                                     version=arguments.bundleversion,
+                                     clarkpath=clarkpath)
+    if arguments.verify:
+        errors = database_bundle.verify(checksums=True)
+        for error in errors:
+            logging.error(error)
+        if errors:
+            quit(1)
+        logging.info('Database bundle {version} is intact'.format(version=database_bundle.version))
+    else:
+        database_bundle.build()
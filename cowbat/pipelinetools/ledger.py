@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+from olctools.accessoryFunctions.accessoryFunctions import GenObject, MetadataObject, make_path
+from functools import wraps
+from threading import Lock
+from fnmatch import fnmatch
+import logging
+import hashlib
+import pickle
+import json
+import copy
+import os
+__author__ = 'adamkoziol'
+
+
+def checkpoint(method):
+    """
+    Decorator for the stage methods of a pipeline. If the pipeline has a ledger, the ledger decides which samples still
+    require the stage, and restores the outputs of the samples that are already complete. If the pipeline has a stage
+    timer, the resources used by the stage are measured
+    :param method: Stage method e.g. RunAssemble.mash
+    :return: Wrapped method
+    """
+    @wraps(method)
+    def stage(pipeline, *args, **kwargs):
+        try:
+            timer = pipeline.timer
+        except AttributeError:
+            timer = None
+        if timer is None:
+            return run_stage(pipeline, method, args, kwargs)
+        try:
+            samples = pipeline.runmetadata.samples
+        except AttributeError:
+            samples = list()
+        with timer.measure(name=method.__name__,
+                           samples=samples):
+            return run_stage(pipeline, method, args, kwargs)
+    return stage
+
+
+def run_stage(pipeline, method, args, kwargs):
+    """
+    Run a stage method, through the ledger of the pipeline if it has one
+    :param pipeline: Pipeline object e.g. RunAssemble
+    :param method: Undecorated stage method
+    :param args: Positional arguments supplied to the stage method
+    :param kwargs: Keyword arguments supplied to the stage method
+    :return: Return value of the stage method
+    """
+    try:
+        ledger = pipeline.ledger
+    except AttributeError:
+        ledger = None
+    if ledger is None:
+        return method(pipeline, *args, **kwargs)
+    ledger.run(pipeline=pipeline,
+               method=method,
+               args=args,
+               kwargs=kwargs)
+
+
+class StageLedger(object):
+
+    def run(self, pipeline, method, args=(), kwargs=None):
+        """
+        Run a stage on only the samples that have not already completed it with the same inputs, parameters, and
+        databases. The outputs of the completed samples are restored from the ledger
+        :param pipeline: Pipeline object e.g. RunAssemble
+        :param method: Undecorated stage method
+        :param args: Positional arguments supplied to the stage method
+        :param kwargs: Keyword arguments supplied to the stage method
+        """
+        kwargs = kwargs if kwargs else dict()
+        stage = self.declaration(pipeline, method.__name__)
+        # Stages that have not been declared cannot be checkpointed
+        if stage is None:
+            method(pipeline, *args, **kwargs)
+            return
+        samples = pipeline.runmetadata.samples
+        # Arguments supplied to the method are treated as additional parameters of the stage
+        parameters = dict(stage.parameters)
+        parameters.update({'args': [str(arg) for arg in args]})
+        parameters.update({key: str(value) for key, value in kwargs.items()})
+        fingerprints = {sample.name: self.fingerprint(stage, sample, parameters) for sample in samples}
+        complete = [sample for sample in samples if self.is_complete(stage.name, sample, fingerprints[sample.name])]
+        incomplete = [sample for sample in samples if sample not in complete]
+        for sample in complete:
+            self.restore(stage, sample)
+        if not incomplete:
+            logging.info('Skipping {stage}; all samples are complete in the ledger'.format(stage=stage.name))
+            return
+        if not complete or stage.runwide:
+            # Run the stage on every sample
+            method(pipeline, *args, **kwargs)
+        elif not stage.mergeable():
+            # Reports that cannot be merged would be overwritten with only the results of the subset, so the stage is
+            # run on every sample
+            logging.info('Running {stage} for all {total} samples, as its reports cannot be merged'
+                         .format(stage=stage.name,
+                                 total=len(samples)))
+            method(pipeline, *args, **kwargs)
+        else:
+            logging.info('Resuming {stage} for {num} of {total} samples'.format(stage=stage.name,
+                                                                               num=len(incomplete),
+                                                                               total=len(samples)))
+            self.run_subset(pipeline, stage, method, args, kwargs, incomplete)
+        # Record the samples that have now completed the stage
+        for sample in incomplete:
+            self.record(stage, sample, fingerprints[sample.name])
+        self.save()
+
+    def run_subset(self, pipeline, stage, method, args, kwargs, samples):
+        """
+        Run a stage on a subset of the samples, and merge the rows of the reports declared by the stage with the rows of
+        the completed samples from the existing reports. Only the reports of the stage are merged, as stages running at
+        the same time re-write their own reports in the same folder
+        :param pipeline: Pipeline object
+        :param stage: Stage object
+        :param method: Undecorated stage method
+        :param args: Positional arguments supplied to the stage method
+        :param kwargs: Keyword arguments supplied to the stage method
+        :param samples: List of the samples to run
+        """
+        view = copy.copy(pipeline)
+        view.runmetadata = MetadataObject()
+        view.runmetadata.samples = samples
+        # Stages must not re-use the existing reports, as they only contain the results of the completed samples
+        view.subset = True
+        # The quality object keeps its own reference to the samples, so it must also be restricted to the subset
+        try:
+            view.qualityobject = copy.copy(pipeline.qualityobject)
+            view.qualityobject.metadata = samples
+        except AttributeError:
+            pass
+        # Store the contents of the existing reports, and remove them, as the stage will re-write them with only the
+        # subset. Some analyses parse an existing report rather than running again, so the reports must not be present
+        previous = dict()
+        for report in self.stage_reports(pipeline.reportpath, stage):
+            with open(report, 'r') as report_file:
+                previous[report] = report_file.readlines()
+            os.remove(report)
+        try:
+            method(view, *args, **kwargs)
+        except (Exception, SystemExit):
+            # Restore the existing reports, so that the results of the completed samples are not lost
+            for report, lines in previous.items():
+                restore_report(report, lines)
+            raise
+        names = set(sample.name for sample in samples)
+        for report, lines in previous.items():
+            if os.path.isfile(report):
+                merge_report(report, lines, names)
+            else:
+                # Restore reports that were not created for the subset e.g. the MLST report of a genus without any
+                # samples in the subset
+                restore_report(report, lines)
+
+    @staticmethod
+    def stage_reports(reportpath, stage):
+        """
+        Find the existing reports declared by a stage
+        :param reportpath: Path to the folder of reports
+        :param stage: Stage object
+        :return: List of the absolute paths of the reports
+        """
+        try:
+            return sorted(os.path.join(reportpath, report) for report in os.listdir(reportpath)
+                          if any(fnmatch(report, pattern) for pattern in stage.reports))
+        except FileNotFoundError:
+            return list()
+
+    @staticmethod
+    def text_reports(reportpath):
+        """
+        Find the text reports that can be merged
+        :param reportpath: Path to the folder of reports
+        :return: List of the absolute paths of .csv and .tsv reports
+        """
+        try:
+            return sorted(os.path.join(reportpath, report) for report in os.listdir(reportpath)
+                          if os.path.splitext(report)[1] in ['.csv', '.tsv'])
+        except FileNotFoundError:
+            return list()
+
+    def declaration(self, pipeline, name):
+        """
+        Find the declaration of a stage
+        :param pipeline: Pipeline object with a stage_graph method
+        :param name: Name of the stage
+        :return: Stage object, or None if the stage has not been declared
+        """
+        with self.lock:
+            if not self.declarations:
+                self.declarations = {stage.name: stage for stage in pipeline.stage_graph().stages}
+        try:
+            return self.declarations[name]
+        except KeyError:
+            return None
+
+    def fingerprint(self, stage, sample, parameters):
+        """
+        Calculate the fingerprint of a stage for a sample from the attributes (and files) it reads, the parameters of
+        the stage, and the versions of the databases it uses
+        :param stage: Stage object
+        :param sample: Metadata object of the sample
+        :param parameters: Dictionary of the parameters of the stage
+        :return: Hex digest
+        """
+        fingerprint = hashlib.sha256()
+        fingerprint.update(self.version.encode())
+        fingerprint.update(json.dumps(parameters, sort_keys=True).encode())
+        for attribute in sorted(stage.reads):
+            fingerprint.update(attribute.encode())
+            fingerprint.update(self.digest(find_attribute(sample, attribute)).encode())
+        for database in sorted(stage.databases):
+            fingerprint.update(database.encode())
+            fingerprint.update(self.database_digest(os.path.join(self.reffilepath, database)).encode())
+        return fingerprint.hexdigest()
+
+    def digest(self, value):
+        """
+        Create a stable digest of an attribute. Paths of existing files are represented by the hash of their contents
+        :param value: Value of the attribute
+        :return: String digest
+        """
+        if isinstance(value, (GenObject, MetadataObject)):
+            return '{' + ','.join('{key}:{value}'.format(key=key, value=self.digest(value.datastore[key]))
+                                  for key in sorted(value.datastore)) + '}'
+        if isinstance(value, dict):
+            return '{' + ','.join('{key}:{value}'.format(key=key, value=self.digest(value[key]))
+                                  for key in sorted(value, key=str)) + '}'
+        if isinstance(value, (list, tuple)):
+            return '[' + ','.join(self.digest(item) for item in value) + ']'
+        if isinstance(value, set):
+            return '[' + ','.join(sorted(self.digest(item) for item in value)) + ']'
+        if isinstance(value, str) and os.path.isfile(value):
+            return file_digest(value)
+        return str(value)
+
+    def database_digest(self, path):
+        """
+        Determine the version of a database from the names, sizes, and modification times of its files, or from the
+        version of the database bundle if the database is part of a valid bundle. Digests are calculated once per run
+        :param path: Path of the database folder (or file)
+        :return: Hex digest
+        """
+        with self.lock:
+            if path not in self.databases and self.bundle is not None:
+                bundled = self.bundle.database_digest(path)
+                if bundled:
+                    self.databases[path] = bundled
+            if path not in self.databases:
+                version = hashlib.sha256()
+                if os.path.isfile(path):
+                    stats = os.stat(path)
+                    version.update('{size}:{mtime}'.format(size=stats.st_size,
+                                                           mtime=stats.st_mtime_ns).encode())
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(files):
+                        filepath = os.path.join(root, name)
+                        try:
+                            stats = os.stat(filepath)
+                        except FileNotFoundError:
+                            continue
+                        version.update('{name}:{size}:{mtime}'.format(name=os.path.relpath(filepath, path),
+                                                                      size=stats.st_size,
+                                                                      mtime=stats.st_mtime_ns).encode())
+                self.databases[path] = version.hexdigest()
+            return self.databases[path]
+
+    def is_complete(self, stage, sample, fingerprint):
+        """
+        Determine whether a sample has completed a stage with the same fingerprint
+        :param stage: Name of the stage
+        :param sample: Metadata object of the sample
+        :param fingerprint: Current fingerprint of the stage for the sample
+        :return: True if the stage can be skipped for the sample
+        """
+        if self.fresh:
+            return False
+        with self.lock:
+            try:
+                recorded = self.ledger[stage][sample.name]
+            except KeyError:
+                return False
+        return recorded == fingerprint and os.path.isfile(self.snapshot_file(stage, sample))
+
+    def record(self, stage, sample, fingerprint):
+        """
+        Record the completion of a stage for a sample, and store the attributes written by the stage
+        :param stage: Stage object
+        :param sample: Metadata object of the sample
+        :param fingerprint: Fingerprint of the stage for the sample
+        """
+        snapshot = dict()
+        for attribute in stage.writes:
+            try:
+                value = plain(find_attribute(sample, attribute, missing=KeyError))
+                # Ensure that the value can be stored before adding it to the snapshot
+                pickle.dumps(value)
+                snapshot[attribute] = value
+            except KeyError:
+                pass
+            except (pickle.PicklingError, TypeError, AttributeError):
+                logging.warning('Cannot store {attribute} for {name} in the ledger'.format(attribute=attribute,
+                                                                                            name=sample.name))
+        snapshot_file = self.snapshot_file(stage.name, sample)
+        make_path(os.path.dirname(snapshot_file))
+        with open(snapshot_file + '.tmp', 'wb') as pickled:
+            pickle.dump(snapshot, pickled)
+        os.replace(snapshot_file + '.tmp', snapshot_file)
+        with self.lock:
+            self.ledger.setdefault(stage.name, dict())[sample.name] = fingerprint
+
+    def restore(self, stage, sample):
+        """
+        Restore the attributes written by a stage for a sample from the stored snapshot
+        :param stage: Stage object
+        :param sample: Metadata object of the sample
+        """
+        with open(self.snapshot_file(stage.name, sample), 'rb') as pickled:
+            snapshot = pickle.load(pickled)
+        for attribute, value in snapshot.items():
+            set_attribute(sample, attribute, genobject(value))
+
+    def snapshot_file(self, stage, sample):
+        return os.path.join(self.path, stage, '{sn}.pickle'.format(sn=sample.name))
+
+    def save(self):
+        """
+        Write the ledger to file. The file is replaced atomically, so an interrupted write cannot corrupt the ledger
+        """
+        with self.lock:
+            make_path(self.path)
+            with open(self.ledger_file + '.tmp', 'w') as ledger:
+                json.dump(self.ledger, ledger, sort_keys=True, indent=4, separators=(',', ': '))
+            os.replace(self.ledger_file + '.tmp', self.ledger_file)
+
+    def __init__(self, path, reffilepath, version, fresh=False, bundle=None):
+        """
+        :param path: Path of the folder in which to store the ledger and the snapshots of the stage outputs
+        :param reffilepath: Path of the reference database folder
+        :param version: Pipeline version. A new version invalidates all the entries in the ledger
+        :param fresh: Boolean of whether to ignore existing entries, and re-run all the stages
+        :param bundle: Optional DatabaseBundle of the reference database folder
+        """
+        self.path = path
+        self.reffilepath = reffilepath
+        self.version = str(version)
+        self.fresh = fresh
+        self.ledger_file = os.path.join(self.path, 'ledger.json')
+        self.lock = Lock()
+        self.declarations = dict()
+        self.databases = dict()
+        self.bundle = bundle
+        try:
+            with open(self.ledger_file, 'r') as ledger:
+                self.ledger = json.load(ledger)
+        except (FileNotFoundError, ValueError):
+            self.ledger = dict()
+
+
+def file_digest(path, blocksize=1048576):
+    """
+    Hash a file. Small files are hashed completely. For files larger than two blocks (e.g. FASTQ files), the size, the
+    first block, and the last block are hashed, as reading the whole file would take longer than many of the stages
+    :param path: Path of the file
+    :param blocksize: Size in bytes of the blocks to read
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    size = os.path.getsize(path)
+    digest.update(str(size).encode())
+    with open(path, 'rb') as hashed:
+        if size <= 2 * blocksize:
+            digest.update(hashed.read())
+        else:
+            digest.update(hashed.read(blocksize))
+            hashed.seek(-blocksize, os.SEEK_END)
+            digest.update(hashed.read(blocksize))
+    return digest.hexdigest()
+
+
+def find_attribute(sample, attribute, missing=None):
+    """
+    Find the value of a (dotted) sample attribute e.g. 'general.bestassemblyfile'
+    :param sample: Metadata object of the sample
+    :param attribute: Name of the attribute
+    :param missing: Value to return if the attribute does not exist. If it is an exception class, it is raised instead
+    :return: Value of the attribute
+    """
+    value = sample
+    for key in attribute.split('.'):
+        try:
+            value = value[key]
+        except (AttributeError, KeyError, TypeError):
+            if missing is KeyError:
+                raise KeyError(attribute)
+            return missing
+    return value
+
+
+def set_attribute(sample, attribute, value):
+    """
+    Set the value of a (dotted) sample attribute, creating intermediate GenObjects as required
+    :param sample: Metadata object of the sample
+    :param attribute: Name of the attribute e.g. 'general.referencegenus'
+    :param value: Value to set
+    """
+    keys = attribute.split('.')
+    parent = sample
+    for key in keys[:-1]:
+        try:
+            parent = parent[key]
+        except (AttributeError, KeyError):
+            setattr(parent, key, GenObject())
+            parent = parent[key]
+    setattr(parent, keys[-1], value)
+
+
+def plain(value):
+    """
+    Convert GenObjects to tagged dictionaries, so that attributes can be pickled. GenObjects cannot be pickled
+    directly, as their __getattr__ requires the datastore to exist
+    :param value: Value to convert
+    :return: Converted value
+    """
+    if isinstance(value, GenObject):
+        return {'__genobject__': {key: plain(item) for key, item in value.datastore.items()}}
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+def genobject(value):
+    """
+    Convert tagged dictionaries created by plain back to GenObjects
+    :param value: Value to convert
+    :return: Converted value
+    """
+    if isinstance(value, dict):
+        if list(value) == ['__genobject__']:
+            return GenObject({key: genobject(item) for key, item in value['__genobject__'].items()})
+        return {key: genobject(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [genobject(item) for item in value]
+    return value
+
+
+def merge_report(report, previous, names):
+    """
+    Merge a report re-written for a subset of samples with the rows of the other samples from the previous version of
+    the report. Rows are identified by the sample name in the first column, or, for rows with a blank first column, by
+    the sample name of the preceding row
+    :param report: Path of the re-written report
+    :param previous: List of the lines of the previous version of the report
+    :param names: Set of the names of the samples in the subset
+    """
+    delimiter = '\t' if report.endswith('.tsv') else ','
+    with open(report, 'r') as report_file:
+        current = report_file.readlines()
+    # Rows of the samples that were not part of the subset are retained from the previous report. Rows with a blank
+    # first column (e.g. additional results of a sample with multiple results) belong to the sample of the preceding
+    # row. Lines that are already present in the new report (e.g. headers) are not duplicated
+    present = set(current)
+    retained = list()
+    sample = None
+    for line in previous[1:]:
+        name = line.split(delimiter)[0].strip().strip('"')
+        if name:
+            sample = name
+        if sample in names or (name and line in present):
+            continue
+        retained.append(line)
+    merged = current[:1] + retained + current[1:]
+    with open(report + '.tmp', 'w') as merged_report:
+        merged_report.write(''.join(merged))
+    os.replace(report + '.tmp', report)
+
+
+def restore_report(report, lines):
+    """
+    Write the previous version of a report
+    :param report: Path of the report
+    :param lines: List of the lines of the previous version of the report
+    """
+    with open(report + '.tmp', 'w') as restored:
+        restored.write(''.join(lines))
+    os.replace(report + '.tmp', report)
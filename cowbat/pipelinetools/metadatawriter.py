@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+from threading import Lock
+import hashlib
+import logging
+import time
+import json
+import os
+__author__ = 'adamkoziol'
+
+
+class MetadataWriter(object):
+
+    def write(self, samples, force=False):
+        """
+        Queue the metadata of samples to be written to their .json files. The queued samples are written once the flush
+        interval has elapsed since the previous flush, or immediately if force is True
+        :param samples: List of metadata objects of the samples
+        :param force: Boolean of whether to write the queued samples regardless of the flush interval
+        """
+        with self.lock:
+            for sample in samples:
+                self.pending[sample.name] = sample
+            if force or time.time() - self.flushed >= self.interval:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the .json files of the queued samples whose metadata have changed since they were last written. Must be
+        called while holding the lock
+        """
+        for name, sample in sorted(self.pending.items()):
+            # Set the name of the json file
+            try:
+                jsonfile = os.path.join(sample.general.outputdirectory, '{sn}_metadata.json'.format(sn=name))
+            except AttributeError:
+                continue
+            try:
+                # Create the json dump of the object dump
+                dump = json.dumps(sample.dump(), sort_keys=True, indent=4, separators=(',', ': '))
+            except TypeError as e:
+                logging.debug(f'Encountered TypeError writing metadata to file with the following details: {e}')
+                continue
+            digest = hashlib.sha1(dump.encode()).hexdigest()
+            # Skip the samples whose metadata have not changed since the last time the file was written
+            if self.written.get(jsonfile) == digest and os.path.isfile(jsonfile):
+                continue
+            try:
+                # Write to a temporary file, and then replace the metadata file, so that the file is never truncated
+                with open(jsonfile + '.tmp', 'w') as metadatafile:
+                    metadatafile.write(dump)
+                os.replace(jsonfile + '.tmp', jsonfile)
+            except IOError:
+                # Print useful information in case of an error
+                logging.warning('Error creating .json file for {sample}'.format(sample=name))
+                raise
+            self.written[jsonfile] = digest
+        self.pending = dict()
+        self.flushed = time.time()
+
+    def __init__(self, interval=0):
+        """
+        :param interval: Minimum number of seconds between writes of the metadata files. 0 writes the files every time
+        write is called
+        """
+        self.interval = float(interval) if interval else 0
+        self.lock = Lock()
+        # Dictionary of sample name: metadata object of the samples waiting to be written
+        self.pending = dict()
+        # Dictionary of json file: digest of the contents last written to the file
+        self.written = dict()
+        self.flushed = 0
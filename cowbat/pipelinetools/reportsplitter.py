@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+from olctools.accessoryFunctions.accessoryFunctions import make_path
+import logging
+import os
+__author__ = 'adamkoziol'
+
+
+def split_reports(reportpath, samplereports):
+    """
+    Split the reports created for a pooled set of samples into the reports folders of the runs of the samples
+    :param reportpath: Path of the folder containing the pooled reports
+    :param samplereports: Dictionary of sample name: path of the reports folder of the run of the sample
+    """
+    destinations = sorted(set(samplereports.values()))
+    for destination in destinations:
+        make_path(destination)
+    for name in sorted(os.listdir(reportpath)):
+        report = os.path.join(reportpath, name)
+        if not os.path.isfile(report):
+            continue
+        if name.endswith(('.csv', '.tsv', '.txt')):
+            split_report(report=report,
+                         samplereports=samplereports)
+        else:
+            # Reports that are not delimited text (e.g. spreadsheets) cannot be split by sample, and are left in the
+            # pooled reports folder
+            logging.warning('Cannot split report {report} by sample; it remains in {path}'
+                            .format(report=name,
+                                    path=reportpath))
+
+
+def split_report(report, samplereports):
+    """
+    Split a delimited report into a report with the same name in the reports folder of each run. Rows are assigned to
+    samples by the sample name in the first column (or, failing that, in any column). Lines before the first sample row
+    are the header, and are written to every report. Rows that cannot be assigned to a sample (e.g. additional rows of
+    a sample with multiple results) belong to the sample of the preceding row
+    :param report: Name and path of the pooled report
+    :param samplereports: Dictionary of sample name: path of the reports folder of the run of the sample
+    """
+    delimiter = '\t' if report.endswith('.tsv') else ','
+    header = list()
+    rows = {destination: list() for destination in set(samplereports.values())}
+    destination = None
+    with open(report, 'r') as pooled:
+        for line in pooled:
+            fields = [field.strip().strip('"') for field in line.split(delimiter)]
+            if fields[0] in samplereports:
+                destination = samplereports[fields[0]]
+            else:
+                # Reports such as the legacy reports do not always start with the sample name
+                matches = [samplereports[field] for field in fields if field in samplereports]
+                if matches:
+                    destination = matches[0]
+            if destination is None:
+                header.append(line)
+            else:
+                rows[destination].append(line)
+    filename = os.path.basename(report)
+    for destination, lines in rows.items():
+        # Write to a temporary file, and then replace the report, so that an interrupted split never truncates a report
+        output = os.path.join(destination, filename)
+        with open(output + '.tmp', 'w') as run_report:
+            run_report.write(''.join(header + lines))
+        os.replace(output + '.tmp', output)
+
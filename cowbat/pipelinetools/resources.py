@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+from contextlib import contextmanager
+from threading import Condition, Lock
+import multiprocessing
+import subprocess
+import logging
+import os
+__author__ = 'adamkoziol'
+
+# The resource manager shared by all the stages and commands of the pipeline process
+shared_manager = None
+shared_lock = Lock()
+
+
+def node_cores():
+    """
+    Determine the number of cores that this process may use
+    :return: Number of cores
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def meminfo(field):
+    """
+    Read a field of /proc/meminfo
+    :param field: Name of the field e.g. MemAvailable
+    :return: Value of the field in bytes, or None if it cannot be read
+    """
+    try:
+        with open('/proc/meminfo', 'r') as memory:
+            for line in memory:
+                if line.startswith(field + ':'):
+                    # Values are reported in kB
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def node_memory():
+    """
+    Determine the total memory of the node
+    :return: Memory in bytes
+    """
+    total = meminfo('MemTotal')
+    if total is None:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return total
+
+
+def available_memory():
+    """
+    Determine the memory that is currently available on the node, including memory used by other users of a shared node
+    :return: Memory in bytes
+    """
+    available = meminfo('MemAvailable')
+    if available is None:
+        available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    return available
+
+
+def resource_manager():
+    """
+    Get the resource manager shared by the pipeline, creating it with the capacity of the node if it does not exist
+    :return: ResourceManager object
+    """
+    global shared_manager
+    with shared_lock:
+        if shared_manager is None:
+            shared_manager = ResourceManager()
+        return shared_manager
+
+
+def configure(cores=None, memory=None):
+    """
+    Set the capacity of the shared resource manager
+    :param cores: Number of cores available to the pipeline. Default is the number of cores of the node
+    :param memory: Memory in bytes available to the pipeline. Default is the total memory of the node
+    :return: ResourceManager object
+    """
+    manager = resource_manager()
+    manager.set_capacity(cores=cores,
+                         memory=memory)
+    return manager
+
+
+def call(command, cores=0, memory=0, name=None, **kwargs):
+    """
+    Run an external command once the shared resource manager admits its expected cores and memory
+    :param command: Command to run, as accepted by subprocess.call
+    :param cores: Number of cores the command is expected to use. Commands run within a stage that has already reserved
+    its cores should not reserve them again
+    :param memory: Memory in bytes the command is expected to use
+    :param name: Name of the reservation, used in log messages. Default is the first word of the command
+    :param kwargs: Additional keyword arguments for subprocess.call e.g. shell=True
+    :return: Return code of the command
+    """
+    if name is None:
+        name = command.split()[0] if isinstance(command, str) else command[0]
+    with resource_manager().reserve(name=name,
+                                    cores=cores,
+                                    memory=memory):
+        return subprocess.call(command, **kwargs)
+
+
+class ResourceManager(object):
+    """
+    Admission control for the cores and memory used by the stages of the pipeline, and the external commands they
+    launch. A reservation is admitted once its cores and memory fit in the capacity that is not already reserved, and
+    its memory is actually available on the node while other reservations hold memory. A reservation is always
+    admitted when nothing else is reserved, so a request larger than the node still runs (on its own) rather than
+    waiting forever
+    """
+
+    @contextmanager
+    def reserve(self, name, cores=0, memory=0):
+        """
+        Wait until the resources are admitted, and release them when the block exits
+        :param name: Name of the reservation e.g. the stage or command
+        :param cores: Number of cores to reserve
+        :param memory: Memory in bytes to reserve
+        """
+        reservation = self.acquire(name=name,
+                                   cores=cores,
+                                   memory=memory)
+        try:
+            yield reservation
+        finally:
+            self.release(reservation)
+
+    def acquire(self, name, cores=0, memory=0):
+        """
+        Wait until the resources are admitted
+        :param name: Name of the reservation
+        :param cores: Number of cores to reserve
+        :param memory: Memory in bytes to reserve
+        :return: Reservation tuple of (name, cores, memory)
+        """
+        with self.condition:
+            reservation = self.request(name, cores, memory)
+            waited = False
+            while not self.admissible(reservation):
+                if not waited:
+                    logging.info('Waiting for {cores} cores and {memory:.1f} GB for {name}'
+                                 .format(cores=reservation[1],
+                                         memory=reservation[2] / 1024 ** 3,
+                                         name=name))
+                    waited = True
+                # Memory used by other processes on the node may be freed without a release, so check again periodically
+                self.condition.wait(timeout=self.interval)
+            self.admit(reservation)
+        return reservation
+
+    def try_acquire(self, name, cores=0, memory=0):
+        """
+        Reserve the resources only if they can be admitted immediately
+        :param name: Name of the reservation
+        :param cores: Number of cores to reserve
+        :param memory: Memory in bytes to reserve
+        :return: Reservation tuple, or None if the resources cannot be admitted
+        """
+        with self.condition:
+            reservation = self.request(name, cores, memory)
+            if not self.admissible(reservation):
+                return None
+            self.admit(reservation)
+        return reservation
+
+    def release(self, reservation):
+        """
+        Return the resources of a reservation, and wake the waiting requests
+        :param reservation: Reservation tuple returned by acquire or try_acquire
+        """
+        with self.condition:
+            self.reservations.remove(reservation)
+            self.reserved_cores -= reservation[1]
+            self.reserved_memory -= reservation[2]
+            self.condition.notify_all()
+
+    def request(self, name, cores, memory):
+        # Requests larger than the capacity are limited to the capacity, so that they can be admitted on their own
+        return name, min(int(cores), self.cores), min(int(memory), self.memory)
+
+    def admissible(self, reservation):
+        """
+        Determine whether a reservation fits in the free capacity. Must be called while holding the condition
+        :param reservation: Reservation tuple
+        :return: True if the reservation can be admitted
+        """
+        if not self.reservations:
+            return True
+        name, cores, memory = reservation
+        if self.reserved_cores + cores > self.cores or self.reserved_memory + memory > self.memory:
+            return False
+        # The capacity may not reflect the other users of a shared node, so the memory must also actually be available.
+        # Waiting only helps if memory reserved by the pipeline will be released; otherwise the request could wait
+        # forever on a node that never has enough memory available
+        if memory and self.reserved_memory:
+            return memory <= available_memory()
+        return True
+
+    def admit(self, reservation):
+        self.reservations.append(reservation)
+        self.reserved_cores += reservation[1]
+        self.reserved_memory += reservation[2]
+
+    def set_capacity(self, cores=None, memory=None):
+        """
+        Set the cores and memory that may be reserved
+        :param cores: Number of cores. Default is the number of cores of the node
+        :param memory: Memory in bytes. Default is the total memory of the node
+        """
+        with self.condition:
+            self.cores = max(1, int(cores)) if cores else node_cores()
+            self.memory = int(memory) if memory else node_memory()
+            self.condition.notify_all()
+
+    def __init__(self, cores=None, memory=None, interval=5):
+        """
+        :param cores: Number of cores that may be reserved. Default is the number of cores of the node
+        :param memory: Memory in bytes that may be reserved. Default is the total memory of the node
+        :param interval: Number of seconds between checks of the available memory while a request is waiting
+        """
+        self.interval = interval
+        self.condition = Condition()
+        self.reservations = list()
+        self.reserved_cores = 0
+        self.reserved_memory = 0
+        self.cores = 0
+        self.memory = 0
+        self.set_capacity(cores=cores,
+                          memory=memory)
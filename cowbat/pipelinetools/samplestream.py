@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+from olctools.accessoryFunctions.accessoryFunctions import MetadataObject
+from cowbat.pipelinetools.resources import resource_manager
+from threading import Lock, Thread
+from queue import Queue
+import logging
+import copy
+__author__ = 'adamkoziol'
+
+
+class SampleStream(object):
+
+    def run(self):
+        """
+        Send every sample through the chain of stages. Each worker takes the next sample as soon as it is free, so a
+        large sample only holds up its own worker
+        """
+        logging.info('Streaming {num} samples through {stages} with {workers} workers'
+                     .format(num=len(self.pipeline.runmetadata.samples),
+                             stages=', '.join(self.stages),
+                             workers=self.workers))
+        for i in range(self.workers):
+            # Send the threads to the appropriate destination function
+            threads = Thread(target=self.stream, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
+        for sample in self.pipeline.runmetadata.samples:
+            self.samplequeue.put(sample)
+        self.samplequeue.join()
+        # Raise the first error encountered once all the other samples have finished
+        if self.errors:
+            name, stage, error = self.errors[0]
+            logging.error('{stage} failed for sample {name}'.format(stage=stage,
+                                                                    name=name))
+            raise error
+
+    def stream(self):
+        while True:
+            sample = self.samplequeue.get()
+            view = self.sample_view(sample)
+            for stage in self.stages:
+                try:
+                    # Wait until the expected memory of memory-intensive stages (e.g. assembly) is available. The
+                    # cores of the workers are already covered by the reservation of the streaming stage
+                    with self.manager.reserve(name='{stage} ({name})'.format(stage=stage,
+                                                                             name=sample.name),
+                                              memory=self.memory.get(stage, 0)):
+                        getattr(view, stage)()
+                except (Exception, SystemExit) as error:
+                    # Stop processing this sample, but allow the remaining samples to finish
+                    with self.errorlock:
+                        self.errors.append((sample.name, stage, error))
+                    break
+            logging.info('Finished streaming {name}'.format(name=sample.name))
+            self.samplequeue.task_done()
+
+    def sample_view(self, sample):
+        """
+        Create a shallow copy of the pipeline with runmetadata restricted to a single sample. Stages run on the copy
+        therefore only process (and print the metadata of) that sample
+        :param sample: Metadata object of the sample
+        :return: Copy of the pipeline object
+        """
+        view = copy.copy(self.pipeline)
+        view.runmetadata = MetadataObject()
+        view.runmetadata.samples = [sample]
+        view.cpus = self.threads
+        return view
+
+    def __init__(self, pipeline, stages, workers, manager=None, memory=None):
+        """
+        :param pipeline: Object with a method for each stage, and a populated runmetadata e.g. RunAssemble
+        :param stages: List of the names of the methods to run on each sample, in order
+        :param workers: Maximum number of samples to process at once
+        :param manager: ResourceManager that admits the memory of each stage. Default is the shared manager
+        :param memory: Dictionary of stage name: memory in bytes that the stage is expected to use for one sample
+        """
+        self.pipeline = pipeline
+        self.stages = stages
+        self.workers = max(1, min(int(workers), len(self.pipeline.runmetadata.samples)))
+        # Divide the cores of the pipeline between the workers
+        self.threads = max(1, int(self.pipeline.cpus) // self.workers)
+        self.samplequeue = Queue()
+        self.errors = list()
+        self.errorlock = Lock()
+        self.manager = manager if manager else resource_manager()
+        self.memory = memory if memory else dict()
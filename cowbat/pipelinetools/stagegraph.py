@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+from cowbat.pipelinetools.resources import ResourceManager
+from threading import Condition, Thread
+from queue import Queue
+import logging
+import copy
+import os
+__author__ = 'adamkoziol'
+
+
+class Stage(object):
+
+    def depends_on(self, other):
+        """
+        Determine whether this stage must wait for a previously declared stage to finish
+        :param other: Stage object declared before this stage
+        :return: True if the stages share a sample attribute that at least one of them writes
+        """
+        # Read after write, write after write, and write after read all require the original order to be kept
+        return overlap(self.reads, other.writes) or overlap(self.writes, other.writes) or \
+            overlap(self.writes, other.reads)
+
+    def mergeable(self):
+        """
+        Determine whether the reports of the stage can be merged with the rows of other samples, so that the stage can be
+        run on a subset of the samples. Only .csv and .tsv reports can be merged; reports such as .xlsx workbooks and
+        FASTA files would only contain the results of the subset
+        :return: True if all the reports of the stage can be merged
+        """
+        return all(os.path.splitext(report)[1] in ['.csv', '.tsv'] for report in self.reports)
+
+    def __init__(self, name, reads=None, writes=None, cores=0, parameters=None, databases=None, runwide=False,
+                 memory=0, reports=None):
+        """
+        :param name: Name of the pipeline method that runs the stage e.g. 'mash'
+        :param reads: List of the sample attributes used by the stage e.g. ['general.bestassemblyfile']
+        :param writes: List of the sample attributes populated by the stage e.g. ['mash', 'general.referencegenus']
+        :param cores: Number of cores to allot to the stage. 0 means that the stage requires the entire CPU budget,
+        and will be run on its own
+        :param parameters: Dictionary of the settings that affect the outputs of the stage e.g. {'cutoff': 100}
+        :param databases: List of the folders in the reference file path used by the stage e.g. ['rMLST']
+        :param runwide: Boolean of whether the outputs of the stage depend on all the samples in the run, so the stage
+        cannot be run on a subset of the samples
+        :param memory: Memory in bytes that the stage is expected to use at its peak e.g. for SKESA. Memory used by
+        external commands that reserve their own memory through the resource manager should not be included
+        :param reports: List of the names (or glob patterns) of the reports that the stage writes to the reports folder
+        e.g. ['mlst.csv', 'mlst_*.csv']. When the stage is resumed for a subset of the samples, only these reports are
+        merged with the rows of the completed samples
+        """
+        self.name = name
+        self.reads = reads if reads else list()
+        self.writes = writes if writes else list()
+        self.cores = cores
+        self.parameters = parameters if parameters else dict()
+        self.databases = databases if databases else list()
+        self.runwide = runwide
+        self.memory = memory
+        self.reports = reports if reports else list()
+        # Set of the names of the stages that must be complete before this stage can start
+        self.dependencies = set()
+
+
+def overlap(first, second):
+    """
+    Determine whether two lists of sample attributes refer to any of the same data. 'general' overlaps with
+    'general.bestassemblyfile', but 'general.bestassemblyfile' does not overlap with 'general.referencegenus'
+    :param first: List of attributes
+    :param second: List of attributes
+    :return: True if any of the attributes overlap
+    """
+    for attribute in first:
+        for other in second:
+            if attribute == other or attribute.startswith(other + '.') or other.startswith(attribute + '.'):
+                return True
+    return False
+
+
+def allot_quality(worker, cores):
+    """
+    The quality object sets its threads and the size of its queues from the cpus of the pipeline when it is created,
+    so a copy of the pipeline with fewer cores would still run bbduk, tadpole, and FastQC with the entire CPU budget.
+    Give the copy its own quality object restricted to the allotted cores. The sample objects are still shared
+    :param worker: Shallow copy of the pipeline on which a stage is run
+    :param cores: Number of cores allotted to the stage
+    """
+    quality = getattr(worker, 'qualityobject', None)
+    if quality is None or not hasattr(quality, 'qcqueue'):
+        return
+    worker.qualityobject = copy.copy(quality)
+    worker.qualityobject.cpus = cores
+    try:
+        worker.qualityobject.threads = max(1, int(cores / len(quality.metadata)))
+    except (AttributeError, TypeError, ZeroDivisionError):
+        worker.qualityobject.threads = cores
+    worker.qualityobject.qcqueue = Queue(maxsize=cores)
+    worker.qualityobject.correctqueue = Queue(maxsize=cores)
+
+
+class StageGraph(object):
+
+    def add(self, name, reads=None, writes=None, cores=0, parameters=None, databases=None, runwide=False, memory=0,
+            reports=None):
+        """
+        Declare a stage. Stages must be added in the order in which they would be run serially; dependencies are
+        determined from the attributes shared with the stages declared before this one
+        :param name: Name of the pipeline method that runs the stage
+        :param reads: List of the sample attributes used by the stage
+        :param writes: List of the sample attributes populated by the stage
+        :param cores: Number of cores to allot to the stage. 0 reserves the entire CPU budget
+        :param parameters: Dictionary of the settings that affect the outputs of the stage
+        :param databases: List of the database folders used by the stage
+        :param runwide: Boolean of whether the stage must always be run on all the samples
+        :param memory: Memory in bytes that the stage is expected to use
+        :param reports: List of the names (or glob patterns) of the reports that the stage writes
+        """
+        stage = Stage(name=name,
+                      reads=reads,
+                      writes=writes,
+                      cores=cores,
+                      parameters=parameters,
+                      databases=databases,
+                      runwide=runwide,
+                      memory=memory,
+                      reports=reports)
+        for previous in self.stages:
+            if stage.depends_on(previous):
+                stage.dependencies.add(previous.name)
+        self.stages.append(stage)
+
+    def run(self, pipeline):
+        """
+        Run all the declared stages. Every stage whose dependencies are complete is started as long as the resource
+        manager admits its cores and memory. Stages are started in the order in which they were declared
+        :param pipeline: Object with a method for each stage e.g. RunAssemble
+        """
+        # Stages that are already complete are not run again
+        pending = [stage for stage in self.stages if stage.name not in self.complete]
+        with self.condition:
+            while pending or self.running:
+                # Do not start any new stages after a failure; only wait for the running stages to finish
+                if not self.errors:
+                    for stage in list(pending):
+                        # The stage cannot be started until all the stages it depends on are complete
+                        if not stage.dependencies.issubset(self.complete):
+                            continue
+                        cores = self.allot(stage)
+                        reservation = self.manager.try_acquire(name=stage.name,
+                                                               cores=cores,
+                                                               memory=stage.memory)
+                        # Preserve the declared order: if this stage doesn't fit, later stages have to wait as well
+                        if reservation is None:
+                            break
+                        pending.remove(stage)
+                        self.running.add(stage.name)
+                        logging.info('Starting {stage} with {cores} of {total} cores'
+                                     .format(stage=stage.name,
+                                             cores=cores,
+                                             total=self.cpus))
+                        thread = Thread(target=self.execute, args=(stage, pipeline, cores, reservation))
+                        thread.daemon = True
+                        thread.start()
+                elif not self.running:
+                    break
+                # Wait for a running stage to finish before evaluating the pending stages again. Resources reserved by
+                # other users of the resource manager may also be released, so check again periodically
+                self.condition.wait(timeout=self.manager.interval)
+        # Raise the first error encountered, as the serial pipeline would have done
+        if self.errors:
+            name, error = self.errors[0]
+            logging.error('Stage {stage} failed'.format(stage=name))
+            raise error
+
+    def allot(self, stage):
+        """
+        Determine the number of cores to give a stage
+        :param stage: Stage object
+        :return: Number of cores
+        """
+        if not stage.cores:
+            return self.cpus
+        return min(stage.cores, self.cpus)
+
+    def execute(self, stage, pipeline, cores, reservation):
+        """
+        Run a single stage in a worker thread
+        :param stage: Stage object to run
+        :param pipeline: Object with a method for each stage
+        :param cores: Number of cores allotted to the stage
+        :param reservation: Reservation of the resources of the stage, released once the stage is complete
+        """
+        # A stage with the entire budget runs alone, so it is run directly on the pipeline object; any attributes it
+        # sets (e.g. runmetadata) are then available to later stages. Stages that share the node are run on a shallow
+        # copy of the pipeline with the number of cpus set to the cores allotted. The copy shares the sample objects
+        if cores == self.cpus:
+            worker = pipeline
+        else:
+            worker = copy.copy(pipeline)
+            worker.cpus = cores
+            allot_quality(worker, cores)
+        try:
+            getattr(worker, stage.name)()
+        except (Exception, SystemExit) as error:
+            self.errors.append((stage.name, error))
+        finally:
+            with self.condition:
+                self.running.discard(stage.name)
+                self.complete.add(stage.name)
+                self.manager.release(reservation)
+                self.condition.notify_all()
+
+    def __init__(self, cpus, complete=None, manager=None):
+        """
+        :param cpus: Total number of cores available to the pipeline
+        :param complete: Optional list of the names of stages that have already been run. These stages are skipped,
+        and the stages that depend on them can start immediately
+        :param manager: ResourceManager that admits the stages, shared with the external commands of the pipeline.
+        Default is a manager of the cores of this graph and the memory of the node
+        """
+        self.cpus = max(int(cpus), 1)
+        self.manager = manager if manager else ResourceManager(cores=self.cpus)
+        self.stages = list()
+        self.running = set()
+        self.complete = set(complete) if complete else set()
+        self.errors = list()
+        self.condition = Condition()
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+from olctools.accessoryFunctions.accessoryFunctions import make_path
+from contextlib import contextmanager
+from threading import Lock, Thread, current_thread
+import resource
+import logging
+import re
+import time
+import json
+import os
+__author__ = 'adamkoziol'
+
+
+def process_tree(pid):
+    """
+    Find a process and all of its descendants in /proc
+    :param pid: Process ID of the root of the process tree
+    :return: Dictionary of process ID: (name, start time in clock ticks since boot, resident set size in bytes, user CPU
+    seconds, system CPU seconds). Empty if /proc is not available
+    """
+    parents = dict()
+    processes = dict()
+    ticks = os.sysconf('SC_CLK_TCK')
+    try:
+        pids = [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    except FileNotFoundError:
+        return processes
+    for entry in pids:
+        try:
+            with open(os.path.join('/proc', entry, 'stat'), 'r') as stat:
+                # The process name is in parentheses, and may contain spaces, so split after the closing parenthesis
+                name, fields = stat.read().split('(', 1)[1].rsplit(')', 1)
+                fields = fields.split()
+        except (OSError, IndexError, ValueError):
+            # The process exited while /proc was being read
+            continue
+        # Fields following the name: state, ppid, ... utime and stime are the 12th and 13th, starttime the 20th, and rss
+        # the 22nd field after the name
+        parents[int(entry)] = int(fields[1])
+        processes[int(entry)] = (name, int(fields[19]), int(fields[21]) * resource.getpagesize(),
+                                 int(fields[11]) / ticks, int(fields[12]) / ticks)
+    tree = dict()
+    for process in processes:
+        # Walk up the tree to determine whether the process descends from the root process
+        ancestor = process
+        while ancestor not in (pid, 0, 1) and ancestor in parents:
+            ancestor = parents[ancestor]
+        if ancestor == pid:
+            tree[process] = processes[process]
+    return tree
+
+
+def process_tree_rss(pid):
+    """
+    Calculate the resident set size of a process and all of its descendants from /proc
+    :param pid: Process ID of the root of the process tree
+    :return: Resident set size in bytes, or 0 if /proc is not available
+    """
+    return sum(rss for name, start, rss, user, system in process_tree(pid).values())
+
+
+def command_line(pid):
+    """
+    Read the command line of a process
+    :param pid: Process ID
+    :return: Command line, or an empty string if the process has exited
+    """
+    try:
+        with open(os.path.join('/proc', str(pid), 'cmdline'), 'rb') as cmdline:
+            return cmdline.read().replace(b'\0', b' ').decode(errors='replace').strip()
+    except OSError:
+        return str()
+
+
+def command_samples(cmdline, names):
+    """
+    Find the samples named in the command line of an external command. A sample is named if a word or path component
+    of the command line is the sample name, or starts with the sample name followed by '.' or '_' (e.g. the assembly or
+    reads files of the sample)
+    :param cmdline: Command line of the external command
+    :param names: Set of the names of the samples
+    :return: Set of the names of the samples named in the command line
+    """
+    found = set()
+    for word in re.split(r'[\s/=,;:\'"]+', cmdline):
+        for name in names:
+            if word == name or word.startswith((name + '.', name + '_')):
+                found.add(name)
+    return found
+
+
+class StageTimer(object):
+    """
+    Record the wall time, CPU time, and peak memory of each stage of a pipeline. CPU time includes the child processes
+    (e.g. skesa, bbduk, CLARK) that have finished during the stage, and the peak resident set size is sampled from the
+    whole process tree. Stages that run concurrently share the process, so their CPU times and peaks overlap. Stages run
+    on several samples at once (batch stages) are also broken down by sample: each external command run by the stage
+    is attributed to the sample named in its command line
+    """
+
+    @contextmanager
+    def measure(self, name, samples=None):
+        """
+        Measure a stage
+        :param name: Name of the stage
+        :param samples: List of the metadata objects of the samples processed by the stage
+        """
+        samples = samples if samples else list()
+        measurement = {'stage': name,
+                       # Stages run on a single sample (e.g. streamed samples) are recorded against the sample
+                       'sample': samples[0].name if len(samples) == 1 else 'all',
+                       'samples': len(samples),
+                       'thread': current_thread().name,
+                       'start': time.time(),
+                       'attributed': False,
+                       'peak_rss': self.current_rss()}
+        wall = time.perf_counter()
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self.lock:
+            self.active.append(measurement)
+        try:
+            yield measurement
+        finally:
+            finished_own = resource.getrusage(resource.RUSAGE_SELF)
+            finished_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            measurement['wall'] = time.perf_counter() - wall
+            measurement['end'] = measurement['start'] + measurement['wall']
+            measurement['user_cpu'] = (finished_own.ru_utime - own.ru_utime) + \
+                (finished_children.ru_utime - children.ru_utime)
+            measurement['system_cpu'] = (finished_own.ru_stime - own.ru_stime) + \
+                (finished_children.ru_stime - children.ru_stime)
+            # A child process that started and finished between samples is only visible in the maximum resident set
+            # size of the finished children, which is reported in kilobytes. It only applies to this stage if it
+            # increased during the stage
+            if finished_children.ru_maxrss > children.ru_maxrss:
+                measurement['peak_rss'] = max(measurement['peak_rss'], finished_children.ru_maxrss * 1024)
+            with self.lock:
+                self.active.remove(measurement)
+                self.measurements.append(measurement)
+            if len(samples) > 1:
+                self.attribute(measurement, samples)
+            self.prune()
+
+    def attribute(self, measurement, samples):
+        """
+        Break the measurement of a batch stage down by sample. The external commands seen while the stage was running
+        that name a single sample are attributed to that sample. Commands that process several samples at once (or
+        none) cannot be attributed, and only appear in the measurement of the whole stage. The commands are sampled, so
+        their durations are accurate to the sampling interval, and their CPU times are the times at the last sample
+        :param measurement: Dictionary of the measurement of the stage
+        :param samples: List of the metadata objects of the samples processed by the stage
+        """
+        names = set(sample.name for sample in samples)
+        totals = dict()
+        with self.lock:
+            processes = [process for process in self.processes.values() if id(measurement) in process['stages']]
+        for process in processes:
+            matches = command_samples(process['cmdline'], names)
+            if len(matches) != 1:
+                continue
+            name = matches.pop()
+            total = totals.setdefault(name, {'stage': measurement['stage'],
+                                             'sample': name,
+                                             'samples': 1,
+                                             'thread': measurement['thread'],
+                                             'start': process['start'],
+                                             'end': process['end'],
+                                             'attributed': True,
+                                             'commands': 0,
+                                             'wall': 0,
+                                             'user_cpu': 0,
+                                             'system_cpu': 0,
+                                             'peak_rss': 0})
+            total['start'] = min(total['start'], process['start'])
+            total['end'] = max(total['end'], process['end'])
+            total['commands'] += 1
+            total['wall'] += max(process['end'] - process['start'], self.interval)
+            total['user_cpu'] += process['user_cpu']
+            total['system_cpu'] += process['system_cpu']
+            total['peak_rss'] = max(total['peak_rss'], process['peak_rss'])
+        with self.lock:
+            self.measurements.extend(totals[name] for name in sorted(totals))
+
+    def prune(self):
+        """
+        Discard the external commands that are no longer needed: those that were only seen during stages that have
+        finished. All the commands are kept for the trace-event file if the run is traced
+        """
+        if self.trace:
+            return
+        with self.lock:
+            active = set(id(measurement) for measurement in self.active)
+            for key in [key for key, process in self.processes.items() if not process['stages'] & active]:
+                del self.processes[key]
+
+    def current_rss(self):
+        """
+        Sample the resident set size of the process tree, and update the peaks of the stages in progress
+        :return: Resident set size in bytes
+        """
+        tree = process_tree(self.pid)
+        rss = sum(size for name, start, size, user, system in tree.values())
+        self.track_processes(tree, rss)
+        if not rss:
+            # Fall back to the peak of the pipeline process itself (in kilobytes) if /proc is not available
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        with self.lock:
+            for measurement in self.active:
+                measurement['peak_rss'] = max(measurement['peak_rss'], rss)
+        return rss
+
+    def track_processes(self, tree, rss):
+        """
+        Record the first and last time each external command of the process tree was seen, its CPU time, and the stages
+        running when it was first seen. The memory of the tree is also recorded if the run is traced
+        :param tree: Dictionary of process ID: (name, start time, resident set size, user CPU, system CPU) from
+        process_tree
+        :param rss: Resident set size of the process tree in bytes
+        """
+        now = time.time()
+        with self.lock:
+            if self.trace:
+                self.memory.append((now, rss))
+            for pid, (name, start, size, user, system) in tree.items():
+                if pid == self.pid:
+                    continue
+                # Process IDs may be re-used, so processes are identified by their ID and start time
+                process = self.processes.get((pid, start))
+                if process is None:
+                    process = {'pid': pid,
+                               'name': name,
+                               'cmdline': command_line(pid),
+                               'start': now,
+                               'stages': set(id(measurement) for measurement in self.active),
+                               'peak_rss': size}
+                    self.processes[(pid, start)] = process
+                process['end'] = now
+                process['user_cpu'] = user
+                process['system_cpu'] = system
+                process['peak_rss'] = max(process['peak_rss'], size)
+
+    def sampler(self):
+        while True:
+            time.sleep(self.interval)
+            if self.active:
+                self.current_rss()
+
+    def write(self, reportpath):
+        """
+        Write the measurements to pipeline_timing.csv, and the trace of the stages to pipeline_timing.json. The Source
+        column distinguishes the measurements of whole stages (stage) from the breakdown of batch stages by sample,
+        which is attributed from their external commands (commands)
+        :param reportpath: Path of the folder in which to write the reports
+        """
+        make_path(reportpath)
+        with self.lock:
+            measurements = sorted(self.measurements, key=lambda x: x['start'])
+        with open(os.path.join(reportpath, 'pipeline_timing.csv'), 'w') as timing:
+            timing.write('Stage,Sample,Samples,WallTime(s),UserCPU(s),SystemCPU(s),PeakRSS(MB),Source\n')
+            for measurement in measurements:
+                timing.write('{stage},{sample},{samples},{wall:.2f},{user:.2f},{system:.2f},{rss:.1f},{source}\n'
+                             .format(stage=measurement['stage'],
+                                     sample=measurement['sample'],
+                                     samples=measurement['samples'],
+                                     wall=measurement['wall'],
+                                     user=measurement['user_cpu'],
+                                     system=measurement['system_cpu'],
+                                     rss=measurement['peak_rss'] / 1024 ** 2,
+                                     source='commands' if measurement['attributed'] else 'stage'))
+        with open(os.path.join(reportpath, 'pipeline_timing.json'), 'w') as trace:
+            json.dump(measurements, trace, sort_keys=True, indent=4, separators=(',', ': '))
+        if self.trace:
+            self.write_trace(reportpath)
+
+    def write_trace(self, reportpath):
+        """
+        Write the stages, samples, and external commands as a trace-event file (pipeline_trace.json) that can be opened
+        in Perfetto or chrome://tracing. Stages are shown on the lane of the thread that ran them, and each external
+        command on its own process lane. Commands are sampled, so their durations are accurate to the sampling interval
+        :param reportpath: Path of the folder in which to write the trace
+        """
+        make_path(reportpath)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': 0,
+                   'args': {'name': 'pipeline'}}]
+        threads = dict()
+        with self.lock:
+            # The breakdowns of batch stages by sample are not shown, as their external commands have their own lanes
+            measurements = sorted([measurement for measurement in self.measurements if not measurement['attributed']],
+                                  key=lambda x: x['start'])
+            processes = sorted(self.processes.values(), key=lambda x: x['start'])
+            memory = list(self.memory)
+        for measurement in measurements:
+            # Give each thread its own lane, numbered in the order in which the threads started a stage
+            tid = threads.setdefault(measurement['thread'], len(threads) + 1)
+            name = measurement['stage'] if measurement['sample'] == 'all' \
+                else '{stage} ({sample})'.format(stage=measurement['stage'],
+                                                 sample=measurement['sample'])
+            events.append({'name': name, 'cat': 'stage', 'ph': 'X', 'pid': self.pid, 'tid': tid,
+                           'ts': measurement['start'] * 1e6, 'dur': measurement['wall'] * 1e6,
+                           'args': {'sample': measurement['sample'],
+                                    'samples': measurement['samples'],
+                                    'user_cpu': measurement['user_cpu'],
+                                    'system_cpu': measurement['system_cpu'],
+                                    'peak_rss_mb': measurement['peak_rss'] / 1024 ** 2}})
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': thread}})
+        for process in processes:
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': process['pid'], 'tid': 0,
+                           'args': {'name': process['name']}})
+            # Processes seen in a single sample are shown with the duration of one sampling interval
+            events.append({'name': process['name'], 'cat': 'command', 'ph': 'X', 'pid': process['pid'], 'tid': 0,
+                           'ts': process['start'] * 1e6,
+                           'dur': max(process['end'] - process['start'], self.interval) * 1e6,
+                           'args': {'cmdline': process['cmdline'],
+                                    'peak_rss_mb': process['peak_rss'] / 1024 ** 2}})
+        for sampled, rss in memory:
+            events.append({'name': 'memory', 'ph': 'C', 'pid': self.pid, 'tid': 0, 'ts': sampled * 1e6,
+                           'args': {'rss_mb': rss / 1024 ** 2}})
+        with open(os.path.join(reportpath, 'pipeline_trace.json'), 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace)
+
+    def summary(self):
+        """
+        Log the total wall time, CPU time, and peak memory of each stage, with the slowest stages first
+        """
+        stages = dict()
+        with self.lock:
+            for measurement in self.measurements:
+                # The breakdowns of batch stages by sample are already included in the measurements of the stages
+                if measurement['attributed']:
+                    continue
+                total = stages.setdefault(measurement['stage'], {'wall': 0, 'cpu': 0, 'peak_rss': 0})
+                total['wall'] += measurement['wall']
+                total['cpu'] += measurement['user_cpu'] + measurement['system_cpu']
+                total['peak_rss'] = max(total['peak_rss'], measurement['peak_rss'])
+        logging.info('Stage timing summary (wall time, CPU time, peak RSS):')
+        for stage, total in sorted(stages.items(), key=lambda x: x[1]['wall'], reverse=True):
+            logging.info('{stage:<28}{wall:>10.1f} s{cpu:>10.1f} s{rss:>10.1f} MB'
+                         .format(stage=stage,
+                                 wall=total['wall'],
+                                 cpu=total['cpu'],
+                                 rss=total['peak_rss'] / 1024 ** 2))
+
+    def __init__(self, interval=1, trace=False):
+        """
+        :param interval: Number of seconds between samples of the resident set size of the process tree
+        :param trace: Boolean of whether to record the external commands of the process tree for the trace-event file
+        """
+        self.interval = interval
+        self.trace = trace
+        # Dictionary of (process ID, start time): first and last time the external command was seen, its CPU time, and
+        # the stages running when it was first seen
+        self.processes = dict()
+        # List of (time, resident set size) of the process tree
+        self.memory = list()
+        self.pid = os.getpid()
+        self.lock = Lock()
+        self.active = list()
+        self.measurements = list()
+        # Send the threads to the appropriate destination function
+        threads = Thread(target=self.sampler, args=())
+        # Set the daemon to true - something to do with thread management
+        threads.setDaemon(True)
+        # Start the threading
+        threads.start()
@@ -2,6 +2,7 @@
 from olctools.accessoryFunctions.accessoryFunctions import SetupLogging
 from validator_helper import validate
 from argparse import ArgumentParser
+import pandas as pd
 import logging
 import os
 
@@ -221,18 +222,108 @@ class ValidateCowbat(object):
         validation_list = [validator.same_columns_in_ref_and_test(),
                            validator.all_test_columns_in_ref_and_test(),
                            validator.check_samples_present(),
-                           validator.check_columns_match()]
+                           ValidateCowbat.check_columns_match(validator)]
         if False in validation_list:
             self.validate_pass = False
         else:
             self.validate_pass = True
 
+    @staticmethod
+    def find_all_columns(csv_file, columns_to_exclude, range_fraction=0.1, separator=','):
+        """
+        Create a column object for each column of a report, as validator_helper's find_all_columns does. Numeric
+        columns may vary by range_fraction of their mean. The numeric columns are found with pandas rather than
+        numpy.issubdtype, which cannot interpret the string columns of current pandas versions
+        :param csv_file: Name and path of the report
+        :param columns_to_exclude: List of the headers of the columns to exclude
+        :param range_fraction: Fraction of the mean of a numeric column by which the values may vary
+        :param separator: Delimiter of the report
+        :return: List of column objects to be used by a Validator
+        """
+        column_list = list()
+        df = pd.read_csv(csv_file, sep=separator)
+        for column in df.columns:
+            if column in columns_to_exclude:
+                continue
+            if pd.api.types.is_numeric_dtype(df[column]) and not pd.api.types.is_bool_dtype(df[column]):
+                column_list.append(validate.Column(name=column,
+                                                   column_type='Range',
+                                                   acceptable_range=df[column].mean() * range_fraction))
+            else:
+                column_list.append(validate.Column(name=column))
+        return column_list
+
+    @staticmethod
+    def percent_depth(value):
+        """
+        Split a Percent_Depth value e.g. 98.5% (25.3) into the percent and the depth
+        :param value: Value of the report
+        :return: Tuple of the percent and the depth
+        """
+        percent, depth = value.split()[:2]
+        return float(percent.replace('%', '')), float(depth.replace('(', '').replace(')', ''))
+
+    @staticmethod
+    def check_columns_match(report_validate):
+        """
+        Compare the values of the columns of the test report to the values of the reference report, as the
+        check_columns_match method of validator_helper's Validator does. The Validator compares every row of the test
+        report to every row of the reference report, which takes minutes for reports with thousands of samples, so
+        the reference rows are found by sample in a dictionary instead
+        :param report_validate: Validator object of the reference and test reports
+        :return: True if every value of the test report matches the reference report
+        """
+        identifier = report_validate.identifying_column
+        reference = dict()
+        for refrow in report_validate.reference_csv_df.to_dict('records'):
+            if not pd.isna(refrow[identifier]):
+                reference.setdefault(refrow[identifier], list()).append(refrow)
+        columns_match = True
+        for testrow in report_validate.test_csv_df.to_dict('records'):
+            for refrow in reference.get(testrow[identifier], list()):
+                for column in report_validate.column_list:
+                    test = testrow[column.name]
+                    ref = refrow[column.name]
+                    # Equality does not work for missing values, and 'ND' values are not compared
+                    if (pd.isna(test) and pd.isna(ref)) or (test == 'ND' and ref == 'ND'):
+                        continue
+                    if column.column_type == 'Categorical':
+                        if test != ref:
+                            logging.warning('Attribute {header} ({test}) does not match reference value ({ref}) '
+                                            'for sample {sample}'
+                                            .format(header=column.name,
+                                                    test=test,
+                                                    ref=ref,
+                                                    sample=testrow[identifier]))
+                            columns_match = False
+                    elif column.column_type == 'Range':
+                        if not float(ref) - column.acceptable_range <= float(test) \
+                                <= float(ref) + column.acceptable_range:
+                            logging.warning('Attribute {header} is out of range for sample {sample}'
+                                            .format(header=column.name,
+                                                    sample=testrow[identifier]))
+                            columns_match = False
+                    elif column.column_type == 'Percent_Depth':
+                        test_percent, test_depth = ValidateCowbat.percent_depth(test)
+                        ref_percent, ref_depth = ValidateCowbat.percent_depth(ref)
+                        if not ref_depth - column.depth_range <= test_depth <= ref_depth + column.depth_range:
+                            logging.warning('Depth is out of range for column {header} for sample {sample}'
+                                            .format(header=column.name,
+                                                    sample=testrow[identifier]))
+                            columns_match = False
+                        if not ref_percent - column.percent_range <= test_percent <= ref_percent + column.percent_range:
+                            logging.warning('Percent is out of range for column {header} for sample {sample}'
+                                            .format(header=column.name,
+                                                    sample=testrow[identifier]))
+                            columns_match = False
+        return columns_match
+
     @staticmethod
     def validate_report(reference_report, test_report, columns_to_exclude, identifying_column, one_to_one=False,
                         resfinder=False, separator=',', check_rows=True):
-        columns = validate.find_all_columns(csv_file=test_report,
-                                            columns_to_exclude=columns_to_exclude,
-                                            separator=separator)
+        columns = ValidateCowbat.find_all_columns(csv_file=test_report,
+                                                  columns_to_exclude=columns_to_exclude,
+                                                  separator=separator)
         report_validate = validate.Validator(reference_csv=reference_report,
                                              test_csv=test_report,
                                              column_list=columns,
@@ -247,7 +338,7 @@ class ValidateCowbat(object):
             assert report_validate.all_test_columns_in_ref_and_test() is True
             assert report_validate.same_columns_in_ref_and_test() is True
             assert report_validate.check_samples_present() is True
-            assert report_validate.check_columns_match() is True
+            assert ValidateCowbat.check_columns_match(report_validate) is True
 
     def __init__(self, reference_folder, test_folder, assembly_typer=False):
         """
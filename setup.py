@@ -9,6 +9,7 @@ setup(
     packages=find_packages(),
     scripts=[os.path.join('cowbat', 'assembly_pipeline.py'),
              os.path.join('cowbat', 'assembly_typing.py'),
+             os.path.join('cowbat', 'pipelinetools', 'bundle.py'),
              os.path.join('cowbat', 'validation', 'validate_cowbat.py')
              ],
     license='MIT',
@@ -0,0 +1,53 @@
+#!/usr/bin/env python 3
+from cowbat.pipelinetools.reportsplitter import split_reports
+from cowbat.assembly_typing import batches, read_manifest, run_samples
+import shutil
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+batchtestpath = os.path.join(testpath, 'testdata', 'batchtyping_test')
+__author__ = 'adamkoziol'
+
+
+def test_run_samples():
+    for run, names in [('run1', ['2014-SEQ-0001', '2014-SEQ-0002']), ('run2', ['2014-SEQ-0001'])]:
+        os.makedirs(os.path.join(batchtestpath, run), exist_ok=True)
+        for name in names:
+            with open(os.path.join(batchtestpath, run, '{name}.fasta'.format(name=name)), 'w') as assembly:
+                assembly.write('>contig\nACGT\n')
+    assert run_samples(os.path.join(batchtestpath, 'run1')) == ['2014-SEQ-0001', '2014-SEQ-0002']
+
+
+def test_manifest():
+    manifest = os.path.join(batchtestpath, 'manifest.txt')
+    with open(manifest, 'w') as manifest_file:
+        manifest_file.write('# Runs to retype\n{run1}\n\n{run2}\n'.format(run1=os.path.join(batchtestpath, 'run1'),
+                                                                          run2=os.path.join(batchtestpath, 'run2')))
+    assert read_manifest(manifest) == [os.path.join(batchtestpath, 'run1'), os.path.join(batchtestpath, 'run2')]
+
+
+def test_batches():
+    # Runs sharing a sample name cannot be pooled
+    assert batches({'run1': ['a', 'b'], 'run2': ['a'], 'run3': ['c']}) == [['run1', 'run3'], ['run2']]
+
+
+def test_split_reports():
+    reportpath = os.path.join(batchtestpath, 'batch', 'reports')
+    os.makedirs(reportpath, exist_ok=True)
+    with open(os.path.join(reportpath, 'resfinder_assembled.csv'), 'w') as report:
+        report.write('Strain,Resistance,Gene\n'
+                     'a,Aminoglycoside,aph\n'
+                     ',Tetracycline,tetA\n'
+                     'c,Beta-lactam,blaTEM\n')
+    samplereports = {'a': os.path.join(batchtestpath, 'run1', 'reports'),
+                     'c': os.path.join(batchtestpath, 'run3', 'reports')}
+    split_reports(reportpath=reportpath,
+                  samplereports=samplereports)
+    with open(os.path.join(batchtestpath, 'run1', 'reports', 'resfinder_assembled.csv'), 'r') as report:
+        assert report.read() == 'Strain,Resistance,Gene\na,Aminoglycoside,aph\n,Tetracycline,tetA\n'
+    with open(os.path.join(batchtestpath, 'run3', 'reports', 'resfinder_assembled.csv'), 'r') as report:
+        assert report.read() == 'Strain,Resistance,Gene\nc,Beta-lactam,blaTEM\n'
+
+
+def test_clear_batchtyping():
+    shutil.rmtree(batchtestpath)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python 3
+from cowbat.benchmark.benchmark_cowbat import Benchmark
+from cowbat.validation.validate_cowbat import ValidateCowbat
+import subprocess
+import shutil
+import json
+import sys
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+benchmarkpath = os.path.join(testpath, 'testdata', 'benchmark_test')
+__author__ = 'adamkoziol'
+
+
+def benchmark_init(update=False, benchmarks=None):
+    return Benchmark(path=benchmarkpath,
+                     baseline=os.path.join(benchmarkpath, 'baseline.json'),
+                     samples=2,
+                     reads=200,
+                     contigs=200,
+                     taxa=4,
+                     loci=3,
+                     alleles=5,
+                     metadatasamples=5,
+                     reportrows=10,
+                     cpus=2,
+                     update=update,
+                     benchmarks=benchmarks if benchmarks else ['filter_genome', 'clark_reports', 'combine_alleles',
+                                                               'metadata_printing'],
+                     launches=1)
+
+
+def test_baseline():
+    benchmark = benchmark_init(update=True)
+    assert benchmark.main()
+    assert sorted(benchmark.results) == ['clark_reports', 'combine_alleles', 'filter_genome', 'metadata_printing']
+    with open(os.path.join(benchmark.data.path, 'alleles', 'rMLST_combined.fasta'), 'r') as combined:
+        sequences = combined.read()
+    # Gaps and Ns are removed from the combined alleles
+    assert '>BACT000001_1' in sequences
+    assert '-' not in sequences and 'N' not in sequences
+
+
+def test_regression():
+    with open(os.path.join(benchmarkpath, 'baseline.json'), 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    benchmark = benchmark_init()
+    # A baseline that no run can match
+    baseline['results']['metadata_printing']['throughput'] = 1e12
+    with open(benchmark.baseline, 'w') as baseline_file:
+        json.dump(baseline, baseline_file)
+    assert not benchmark.main()
+
+
+def test_report_validation():
+    benchmark = benchmark_init(benchmarks=['report_validation'])
+    assert benchmark.main()
+    assert benchmark.results['report_validation']['unit'] == 'rows/s'
+
+
+def test_report_mismatch():
+    benchmark = benchmark_init()
+    reference, test = benchmark.data.reports()
+    with open(test, 'r') as report:
+        rows = report.readlines()
+    # Change the genus of a sample, or move a numeric value well outside of its range
+    for original, changed in [('Escherichia', 'Salmonella'), (',53,', ',5300,')]:
+        with open(test, 'w') as report:
+            report.write(''.join(rows[:2] + [rows[2].replace(original, changed)] + rows[3:]))
+        mismatch = False
+        try:
+            ValidateCowbat.validate_report(reference_report=reference,
+                                           test_report=test,
+                                           columns_to_exclude=['Strain'],
+                                           identifying_column='Strain')
+        except AssertionError:
+            mismatch = True
+        assert mismatch
+
+
+def test_startup():
+    benchmark = benchmark_init(benchmarks=['startup'])
+    benchmark.startup_budget = 60
+    assert benchmark.main()
+    assert benchmark.results['startup']['unit'] == 'launches/s'
+
+
+def test_startup_budget():
+    benchmark = benchmark_init(benchmarks=['startup'])
+    benchmark.startup_budget = 0
+    assert not benchmark.main()
+    assert len(benchmark.over_budget) == 2
+
+
+def test_lazy_imports():
+    # The typing methods are only imported when their stages run
+    modules = subprocess.check_output([sys.executable, '-c',
+                                       'import sys, cowbat.assembly_pipeline, cowbat.assembly_typing; '
+                                       'print(" ".join(sys.modules))'],
+                                      cwd=os.path.dirname(testpath)).decode().split()
+    assert 'cowbat.assembly_pipeline' in modules
+    assert not [module for module in modules if module.startswith('genemethods')]
+
+
+def test_clear_benchmark():
+    shutil.rmtree(benchmarkpath)
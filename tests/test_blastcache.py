@@ -0,0 +1,74 @@
+#!/usr/bin/env python 3
+from olctools.accessoryFunctions.accessoryFunctions import MetadataObject, GenObject
+from cowbat.pipelinetools.blastcache import BlastCache
+import shutil
+import time
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+cachetestpath = os.path.join(testpath, 'testdata', 'blastcache_test')
+__author__ = 'adamkoziol'
+
+
+class FakeBLAST(object):
+
+    def seekr(self):
+        for sample in self.metadata:
+            report = os.path.join(sample[self.analysistype].reportdir,
+                                  '{name}_{program}_{at}.tsv'.format(name=sample.name,
+                                                                     program=self.program,
+                                                                     at=self.analysistype))
+            # Mimic GeneSeekr.run_blast, which only runs BLAST if the report does not exist
+            if not os.path.isfile(report):
+                self.blasted.append(sample.name)
+                with open(report, 'w') as blast_report:
+                    blast_report.write('{name}\tgene1\t100\n'.format(name=sample.name))
+
+    def __init__(self, names):
+        self.analysistype = 'rmlst'
+        self.program = 'blastn'
+        self.cutoff = 100
+        self.blasted = list()
+        self.metadata = list()
+        database = os.path.join(cachetestpath, 'combinedtargets.fasta')
+        with open(database, 'w') as targets:
+            targets.write('>gene1\nACGT\n')
+        for name in names:
+            sample = MetadataObject()
+            sample.name = name
+            sample.general = GenObject()
+            sample.general.bestassemblyfile = os.path.join(cachetestpath, '{name}.fasta'.format(name=name))
+            with open(sample.general.bestassemblyfile, 'w') as assembly:
+                assembly.write('>contig\nACGTACGT\n')
+            setattr(sample, self.analysistype, GenObject())
+            sample[self.analysistype].combinedtargets = database
+            sample[self.analysistype].reportdir = os.path.join(cachetestpath, 'run_{time}'.format(time=time.time()),
+                                                               name)
+            os.makedirs(sample[self.analysistype].reportdir)
+            self.metadata.append(sample)
+
+
+def test_cache():
+    os.makedirs(cachetestpath, exist_ok=True)
+    cache = BlastCache(path=os.path.join(cachetestpath, 'cache'))
+    first = FakeBLAST(names=['sample1'])
+    cache.seekr(first)
+    assert first.blasted == ['sample1']
+    # A new run with the same assembly and database re-uses the cached report
+    second = FakeBLAST(names=['sample1', 'sample2'])
+    with open(second.metadata[1].general.bestassemblyfile, 'w') as assembly:
+        assembly.write('>contig\nTTTTTTTT\n')
+    cache.seekr(second)
+    assert second.blasted == ['sample2']
+
+
+def test_eviction():
+    cache = BlastCache(path=os.path.join(cachetestpath, 'cache'),
+                       maxsize=1)
+    cache.evict()
+    reports = [name for root, dirs, files in os.walk(cache.path) for name in files]
+    assert not reports
+
+
+def test_clear_blastcache():
+    shutil.rmtree(cachetestpath)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python 3
+from olctools.accessoryFunctions.accessoryFunctions import GenObject, MetadataObject
+from cowbat.pipelinetools.bundle import DatabaseBundle
+from cowbat.metagenomefilter.automateCLARK import CLARK
+from cowbat.pipelinetools.ledger import StageLedger
+import shutil
+import json
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+bundlepath = os.path.join(testpath, 'testdata', 'bundle_test')
+__author__ = 'adamkoziol'
+
+
+def database_files():
+    """
+    Create a small reference database folder with a genus-agnostic and a genus-specific target folder
+    """
+    for folder, targets in [('resfinder', {'blaTEM.tfa': '>blaTEM_1_AB\nACGT\n', 'sul1.tfa': '>sul1_1_CD\nTTGA\n'}),
+                            (os.path.join('serosippr', 'Escherichia'), {'O157.tfa': '>wzx_O157\nGGCC\n'})]:
+        os.makedirs(os.path.join(bundlepath, folder), exist_ok=True)
+        for name, sequence in targets.items():
+            with open(os.path.join(bundlepath, folder, name), 'w') as target:
+                target.write(sequence)
+    os.makedirs(os.path.join(bundlepath, 'mash'), exist_ok=True)
+    with open(os.path.join(bundlepath, 'mash', 'refseq.msh'), 'wb') as sketch:
+        sketch.write(b'sketch')
+
+
+def test_build():
+    database_files()
+    bundle = DatabaseBundle(bundlepath, version='1.0')
+    bundle.build()
+    assert os.path.isfile(os.path.join(bundlepath, 'resfinder', 'combinedtargets.fasta'))
+    assert os.path.isfile(os.path.join(bundlepath, 'serosippr', 'Escherichia', 'combinedtargets.fasta'))
+    with open(os.path.join(bundlepath, 'bundle.json'), 'r') as bundle_file:
+        record = json.load(bundle_file)
+    assert record['version'] == '1.0'
+    assert os.path.join('mash', 'refseq.msh') in record['files']
+    assert os.path.join('resfinder', 'combinedtargets.fasta') in record['files']
+    # A newly-loaded bundle is valid without calculating any checksums
+    assert DatabaseBundle(bundlepath).valid()
+
+
+def test_modified_bundle():
+    sketch = os.path.join(bundlepath, 'mash', 'refseq.msh')
+    stats = os.stat(sketch)
+    # Change the contents of a file without changing its size or modification time
+    with open(sketch, 'wb') as modified:
+        modified.write(b'SKETCH')
+    os.utime(sketch, ns=(stats.st_atime_ns, stats.st_mtime_ns))
+    bundle = DatabaseBundle(bundlepath)
+    assert bundle.valid()
+    assert bundle.verify(checksums=True) == [os.path.join('mash', 'refseq.msh') + ' has changed contents']
+    # A new file invalidates the bundle
+    with open(os.path.join(bundlepath, 'resfinder', 'new.tfa'), 'w') as target:
+        target.write('>new_1\nAAAA\n')
+    assert not DatabaseBundle(bundlepath).valid()
+    os.remove(os.path.join(bundlepath, 'resfinder', 'new.tfa'))
+
+
+def test_ledger_digest():
+    bundle = DatabaseBundle(bundlepath)
+    ledger = StageLedger(path=os.path.join(bundlepath, 'ledger'),
+                         reffilepath=bundlepath,
+                         version='1',
+                         bundle=bundle)
+    digest = ledger.database_digest(os.path.join(bundlepath, 'resfinder'))
+    # The digest follows the bundle version rather than the files of the database
+    rebuilt = DatabaseBundle(bundlepath, version='2.0')
+    rebuilt.write()
+    ledger = StageLedger(path=os.path.join(bundlepath, 'ledger'),
+                         reffilepath=bundlepath,
+                         version='1',
+                         bundle=DatabaseBundle(bundlepath))
+    assert ledger.database_digest(os.path.join(bundlepath, 'resfinder')) != digest
+
+
+def test_runtime_stage():
+    runtimepath = os.path.join(bundlepath, 'runtime')
+    reffilepath = os.path.join(runtimepath, 'databases')
+    clarkpath = os.path.join(runtimepath, 'clark_install')
+    for folder in [os.path.join(reffilepath, 'resfinder'), os.path.join(reffilepath, 'clark', 'Bacteria'), clarkpath]:
+        os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(reffilepath, 'resfinder', 'blaTEM.tfa'), 'w') as target:
+        target.write('>blaTEM_1_AB\nACGT\n')
+    # Mimic the CLARK scripts: the database files are created by the first classification
+    with open(os.path.join(clarkpath, 'set_targets.sh'), 'w') as targets:
+        targets.write('#!/bin/sh\necho "$1" > .settings\necho "$@" >> targets.log\n')
+    with open(os.path.join(clarkpath, 'classify_metagenome.sh'), 'w') as classify:
+        classify.write('#!/bin/sh\ndb="$(head -n 1 .settings)db_central_k31_t15_s0_m0.tsk.lgt"\n'
+                       '[ -f "$db" ] || echo db > "$db"\n'
+                       'while read report; do touch "$report.csv"; done < "$4"\n')
+    for script in ['set_targets.sh', 'classify_metagenome.sh']:
+        os.chmod(os.path.join(clarkpath, script), 0o755)
+    DatabaseBundle(reffilepath, version='1.0', clarkpath=clarkpath).build()
+    assert os.path.isfile(os.path.join(reffilepath, 'clark', 'db_central_k31_t15_s0_m0.tsk.lgt'))
+    # Run the CLARK stage against the bundle
+    clark = CLARK.__new__(CLARK)
+    clark.clarkpath = clarkpath
+    clark.databasepath = os.path.join(reffilepath, 'clark', '')
+    clark.database = 'bacteria'
+    clark.rank = 'species'
+    clark.service = False
+    clark.adaptive = False
+    clark.light = True
+    clark.cpus = 1
+    clark.devnull = open(os.devnull, 'wb')
+    clark.bundle = DatabaseBundle(reffilepath)
+    clark.filelist = os.path.join(runtimepath, 'sampleList.txt')
+    clark.reportlist = os.path.join(runtimepath, 'reportList.txt')
+    sample = MetadataObject()
+    sample.name = 'sample1'
+    sample.general = GenObject()
+    sample.general.combined = os.path.join(runtimepath, 'sample1.fasta')
+    clark.runmetadata = MetadataObject()
+    clark.runmetadata.samples = [sample]
+    with open(clark.filelist, 'w') as filelist:
+        filelist.write(sample.general.combined + '\n')
+    with open(clark.reportlist, 'w') as reportlist:
+        reportlist.write(os.path.join(runtimepath, 'sample1') + '\n')
+    clark.settargets()
+    clark.classifymetagenome()
+    assert os.path.isfile(os.path.join(runtimepath, 'sample1.csv'))
+    # The targets were set once, when the bundle was built
+    with open(os.path.join(clarkpath, 'targets.log'), 'r') as targets:
+        assert len(targets.readlines()) == 1
+    # A typing stage creates the BLAST database that could not be built with the bundle
+    with open(os.path.join(reffilepath, 'resfinder', 'combinedtargets.nhr'), 'wb') as index:
+        index.write(b'index')
+    assert DatabaseBundle(reffilepath).valid()
+    assert not DatabaseBundle(reffilepath).verify(checksums=True)
+
+
+def test_clear_bundle():
+    shutil.rmtree(bundlepath)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python 3
+from cowbat.metagenomefilter.automateCLARK import CLARK
+from cowbat.metagenomefilter import clarkservice, clarktargets
+from multiprocessing.connection import Client
+from multiprocessing import AuthenticationError
+from threading import Thread
+import shutil
+import time
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+__author__ = 'adamkoziol'
+
+
+def test_contigindex():
+    classification = os.path.join(testpath, 'testdata', 'clark_classification.csv')
+    with open(classification, 'w') as classificationfile:
+        classificationfile.write('Object_ID, Length, Assignment\n'
+                                 'contig1,1000,562\n'
+                                 'contig2,500,28901\n'
+                                 'contig1,1000,562\n'
+                                 'contig3,250,562\n')
+    contigindex = CLARK.contigindex(classification)
+    assert contigindex['562'] == [('contig1', 1000), ('contig1', 1000), ('contig3', 250)]
+    assert contigindex['28901'] == [('contig2', 500)]
+    os.remove(classification)
+
+
+def test_service():
+    clarkpath = os.path.join(testpath, 'testdata', 'clark_service')
+    os.makedirs(clarkpath, exist_ok=True)
+    # Mimic the CLARK scripts: classification creates a .csv for each report prefix in the report list
+    with open(os.path.join(clarkpath, 'set_targets.sh'), 'w') as targets:
+        targets.write('#!/bin/sh\necho "$@" > .settings\necho "$@" >> targets.log\n')
+    with open(os.path.join(clarkpath, 'classify_metagenome.sh'), 'w') as classify:
+        classify.write('#!/bin/sh\nwhile read report; do touch "$report.csv"; done < "$4"\n')
+    for script in ['set_targets.sh', 'classify_metagenome.sh']:
+        os.chmod(os.path.join(clarkpath, script), 0o755)
+    address = os.path.join(clarkservice.service_directory(), 'test_{pid}.sock'.format(pid=os.getpid()))
+    service = clarkservice.ClassificationService(clarkpath=clarkpath,
+                                                 databasepath=clarkpath,
+                                                 address=address)
+    thread = Thread(target=service.main)
+    thread.daemon = True
+    thread.start()
+    while not clarkservice.running(address):
+        time.sleep(0.1)
+    for sample in ['sample1', 'sample2']:
+        request = {'clarkpath': clarkpath,
+                   'databasepath': clarkpath,
+                   'database': 'bacteria',
+                   'rank': 'species',
+                   'light': True,
+                   'cpus': 1,
+                   'files': [os.path.join(clarkpath, sample + '.fasta')],
+                   'reports': [os.path.join(clarkpath, sample)]}
+        assert clarkservice.classify(request=request, address=address) == 0
+        assert os.path.isfile(os.path.join(clarkpath, sample + '.csv'))
+    # The targets are only set once for requests with the same settings
+    with open(os.path.join(clarkpath, 'targets.log'), 'r') as targets:
+        assert len(targets.readlines()) == 1
+    # Clients without the key of the current user are disconnected before any request is exchanged
+    try:
+        Client(address, family='AF_UNIX', authkey=b'wrong key')
+        assert False
+    except (AuthenticationError, EOFError, OSError):
+        pass
+    # The exit status of a failed classification is returned to the client
+    with open(os.path.join(clarkpath, 'classify_metagenome.sh'), 'w') as classify:
+        classify.write('#!/bin/sh\nexit 3\n')
+    request['reports'] = [os.path.join(clarkpath, 'sample3')]
+    assert clarkservice.classify(request=request, address=address) == 3
+    shutil.rmtree(clarkpath)
+
+
+def test_service_directory():
+    directory = clarkservice.service_directory()
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    assert clarkservice.service_authkey() == clarkservice.service_authkey()
+    assert os.stat(os.path.join(directory, 'authkey')).st_mode & 0o777 == 0o600
+
+
+def test_service_idle():
+    service = clarkservice.ClassificationService(clarkpath=testpath,
+                                                 databasepath=testpath,
+                                                 address=os.path.join(clarkservice.service_directory(), 'idle.sock'),
+                                                 idle=1)
+    service.lastrequest = time.time() - 10
+    # A classification that runs longer than the idle timeout does not stop the service
+    service.busy = True
+    assert not service.expired()
+    service.busy = False
+    assert service.expired()
+
+
+def test_shards():
+    clark = CLARK.__new__(CLARK)
+    clark.cpus = 4
+    clark.threads = 48
+    clark.light = True
+    processes, threads = clark.shards(files=100)
+    # Each CLARK process is limited to four threads
+    assert threads <= 4
+    assert 1 <= processes <= 12
+    # There are never more processes than files
+    assert clark.shards(files=2)[0] <= 2
+
+
+def test_set_targets():
+    clarkpath = os.path.join(testpath, 'testdata', 'clark_targets')
+    databasepath = os.path.join(clarkpath, 'database')
+    os.makedirs(databasepath, exist_ok=True)
+    # Mimic set_targets.sh: record the settings in the installation, slowly enough for concurrent calls to overlap
+    with open(os.path.join(clarkpath, 'set_targets.sh'), 'w') as targets:
+        targets.write('#!/bin/sh\nsleep 0.2\necho "$@" > .settings\necho "$@" >> targets.log\n')
+    os.chmod(os.path.join(clarkpath, 'set_targets.sh'), 0o755)
+    assert clarktargets.set_targets(clarkpath, databasepath, 'bacteria', 'species')
+    # The unchanged configuration is not set again
+    assert not clarktargets.set_targets(clarkpath, databasepath, 'bacteria', 'species')
+    # A changed configuration is only set once, even when several pipelines request it at the same time
+    threads = [Thread(target=clarktargets.set_targets, args=(clarkpath, databasepath, 'bacteria', 'genus'))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(os.path.join(clarkpath, 'targets.log'), 'r') as targets:
+        assert [line.split()[-1] for line in targets.readlines()] == ['--species', '--genus']
+    # Adding genomes to the database sets the targets again
+    os.makedirs(os.path.join(databasepath, 'Bacteria'))
+    assert clarktargets.set_targets(clarkpath, databasepath, 'bacteria', 'genus')
+    # Creating the CLARK database files in the database folder does not change the targets
+    with open(os.path.join(databasepath, 'db_central_k31_t15_s0_m0.tsk.lgt'), 'w') as database:
+        database.write('db')
+    assert not clarktargets.set_targets(clarkpath, databasepath, 'bacteria', 'genus')
+    shutil.rmtree(clarkpath)
+
+
+def test_classification_lock():
+    clarkpath = os.path.join(testpath, 'testdata', 'clark_lock')
+    databasepath = os.path.join(clarkpath, 'database')
+    os.makedirs(databasepath, exist_ok=True)
+    with open(os.path.join(clarkpath, 'set_targets.sh'), 'w') as targets:
+        targets.write('#!/bin/sh\necho "$@" > .settings\necho "$@" >> targets.log\n')
+    os.chmod(os.path.join(clarkpath, 'set_targets.sh'), 0o755)
+
+    def logged():
+        with open(os.path.join(clarkpath, 'targets.log'), 'r') as log:
+            return [line.split()[-1] for line in log.readlines()]
+    # A classification sets the targets it needs, and another pipeline cannot change them until it finishes
+    with clarktargets.classification(clarkpath, databasepath, 'bacteria', 'species'):
+        assert logged() == ['--species']
+        other = Thread(target=clarktargets.set_targets, args=(clarkpath, databasepath, 'bacteria', 'genus'))
+        other.start()
+        other.join(0.5)
+        assert other.is_alive()
+        # Pipelines classifying with the same targets share the lock
+        with clarktargets.classification(clarkpath, databasepath, 'bacteria', 'species'):
+            assert logged() == ['--species']
+    other.join()
+    assert logged() == ['--species', '--genus']
+    # The targets of a bundle are used as they are
+    with clarktargets.classification(clarkpath, databasepath, 'bacteria', 'species', ready=lambda: True):
+        assert logged() == ['--species', '--genus']
+    shutil.rmtree(clarkpath)
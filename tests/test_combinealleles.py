@@ -0,0 +1,59 @@
+#!/usr/bin/env python 3
+from cowbat.get.get_rmlst import Get, normalise_alleles
+from Bio.Seq import Seq
+from Bio import SeqIO
+import shutil
+import time
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+allelepath = os.path.join(testpath, 'testdata', 'combinealleles_test')
+__author__ = 'adamkoziol'
+
+
+def seqio_combine(alleles):
+    """
+    Combine the allele files by parsing and writing each record with SeqIO
+    """
+    records = list()
+    for allele in sorted(alleles):
+        for record in SeqIO.parse(allele, 'fasta'):
+            record.id = record.id.replace('-', '_')
+            record.seq = Seq(str(record.seq).replace('-', '').replace('N', ''))
+            record.name = ''
+            record.description = ''
+            records.append(record.format('fasta'))
+    return ''.join(records)
+
+
+def allele_files():
+    os.makedirs(allelepath, exist_ok=True)
+    alleles = list()
+    contents = ['>BACT000001-1 description\nACGT-NNACGT\nacgtn\n\n>BACT000001-2\r\n' + 'ACGTN-' * 40 + '\r\n',
+                'leading text\n>BACT000002-1\n>BACT000002-2 second allele\nAC GT\t\nNNNN\n',
+                '>BACT000003-1\n' + 'ACGTACGTAC' * 13 + '\n']
+    for num, content in enumerate(contents):
+        allele = os.path.join(allelepath, 'BACT{num:06d}.tfa'.format(num=num + 1))
+        with open(allele, 'w', newline='') as tfa:
+            tfa.write(content)
+        alleles.append(allele)
+    return alleles
+
+
+def test_normalise_alleles():
+    alleles = allele_files()
+    assert ''.join(normalise_alleles(allele) for allele in sorted(alleles)) == seqio_combine(alleles)
+
+
+def test_combine_alleles():
+    alleles = allele_files()
+    get = Get.__new__(Get)
+    get.start = time.time()
+    for processes in [1, 2]:
+        get.combinealleles(allelepath, alleles, processes=processes)
+        with open(os.path.join(allelepath, 'rMLST_combined.fasta'), 'r') as combined:
+            assert combined.read() == seqio_combine(alleles)
+
+
+def test_clear_combinealleles():
+    shutil.rmtree(allelepath)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python 3
+from olctools.accessoryFunctions.accessoryFunctions import MetadataObject, GenObject
+from cowbat.metagenomefilter.filtermetagenome import FilterGenome
+from cowbat.metagenomefilter.readindex import ReadIndex, build_index
+import multiprocessing
+import shutil
+import gzip
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+filterpath = os.path.join(testpath, 'testdata', 'filter_test')
+__author__ = 'adamkoziol'
+
+
+def sample_init():
+    os.makedirs(filterpath, exist_ok=True)
+    sample = MetadataObject()
+    sample.name = 'metagenome'
+    sample.general = GenObject()
+    sample.general.fastqfiles = [os.path.join(filterpath, 'metagenome.fastq')]
+    with open(sample.general.fastqfiles[0], 'w') as fastq:
+        for read in ['read1', 'read2', 'read3', 'read4']:
+            fastq.write('@{read} 1:N:0\nACGT\n+\nIIII\n'.format(read=read))
+    sample.general.taxids = ['562', '28901']
+    sample.general.filteredfastq = dict()
+    for taxid in sample.general.taxids:
+        sample.general.filteredfastq[taxid] = os.path.join(filterpath, '{taxid}.fastq.gz'.format(taxid=taxid))
+    sample.general.assignmentfile = os.path.join(filterpath, 'metagenome.csv')
+    with open(sample.general.assignmentfile, 'w') as assignment:
+        assignment.write('Object_ID, Length, Assignment\n'
+                         'read1,4,562\n'
+                         'read2,4,28901\n'
+                         'read3,4,562\n'
+                         'read3,4,562\n'
+                         'read4,4,1280\n')
+    return sample
+
+
+def filtered_reads(filteredfastq):
+    with gzip.open(filteredfastq, 'rt') as fastq:
+        return [line.split()[0] for line in fastq.readlines()[::4]]
+
+
+def test_readindex():
+    sample = sample_init()
+    # A small chunk size ensures that the reads are split between multiple index files
+    readindex = ReadIndex(taxids=sample.general.taxids,
+                          path=os.path.join(filterpath, 'readindex'),
+                          chunksize=2)
+    readindex.build(sample.general.assignmentfile)
+    assert len(readindex.chunks) == 2
+    assert readindex.counts == [3, 1]
+    assert readindex.lookup(['read3', 'read4', 'read2']) == [['562'], [], ['28901']]
+    readindex.remove()
+    assert not os.listdir(os.path.join(filterpath, 'readindex'))
+
+
+def test_demultiplex():
+    sample = sample_init()
+    readindex = ReadIndex(taxids=sample.general.taxids,
+                          path=os.path.join(filterpath, 'readindex'))
+    readindex.build(sample.general.assignmentfile)
+    FilterGenome.demultiplex(sample.general.fastqfiles[0], sample.general.filteredfastq, readindex, batchsize=3)
+    assert filtered_reads(sample.general.filteredfastq['562']) == ['@read1', '@read3']
+    assert filtered_reads(sample.general.filteredfastq['28901']) == ['@read2']
+
+
+def test_process_pool():
+    sample = sample_init()
+    with multiprocessing.Pool(processes=2) as pool:
+        readindex = pool.apply(build_index, (sample.general.taxids, os.path.join(filterpath, 'readindex'),
+                                             sample.general.assignmentfile))
+    # The index created in the worker process can be searched in this process
+    assert readindex.lookup(['read1']) == [['562']]
+
+
+def test_clear_filter():
+    shutil.rmtree(filterpath)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python 3
+from olctools.accessoryFunctions.accessoryFunctions import MetadataObject, GenObject
+from cowbat.pipelinetools.ledger import StageLedger, checkpoint, merge_report
+from cowbat.pipelinetools.stagegraph import StageGraph
+import shutil
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+__author__ = 'adamkoziol'
+
+
+class FakePipeline(object):
+
+    def stage_graph(self):
+        graph = StageGraph(cpus=1)
+        graph.add(name='typing',
+                  reads=['general.bestassemblyfile'],
+                  writes=['typing'],
+                  parameters={'cutoff': self.cutoff},
+                  reports=['typing.csv'])
+        graph.add(name='workbook',
+                  reads=['general.bestassemblyfile'],
+                  writes=['workbook'],
+                  reports=['workbook.xlsx'])
+        return graph
+
+    @checkpoint
+    def typing(self):
+        self.subsets.append(self.subset)
+        # The existing report is not present while the stage runs, so it cannot be parsed instead of running the stage
+        self.existing.append(os.path.isfile(os.path.join(self.reportpath, 'typing.csv')))
+        # Another stage running at the same time re-writes its own report in the same folder
+        with open(os.path.join(self.reportpath, 'other.csv'), 'w') as other:
+            other.write('Strain,Other\nsample1,new\n')
+        with open(os.path.join(self.reportpath, 'typing.csv'), 'w') as report:
+            report.write('Strain,Result\n')
+            for sample in self.runmetadata.samples:
+                self.ran.append(sample.name)
+                sample.typing = GenObject()
+                sample.typing.result = '{name}_result'.format(name=sample.name)
+                report.write('{name},{result}\n'.format(name=sample.name,
+                                                        result=sample.typing.result))
+
+    @checkpoint
+    def workbook(self):
+        # Mimic a workbook report, which cannot be merged
+        with open(os.path.join(self.reportpath, 'workbook.xlsx'), 'w') as report:
+            for sample in self.runmetadata.samples:
+                self.ran.append(sample.name)
+                sample.workbook = GenObject()
+                sample.workbook.result = sample.name
+                report.write(sample.name + '\n')
+
+    def __init__(self, path, names, cutoff=90):
+        self.path = path
+        self.reportpath = os.path.join(path, 'reports')
+        os.makedirs(self.reportpath, exist_ok=True)
+        self.cutoff = cutoff
+        self.ran = list()
+        self.subset = False
+        self.subsets = list()
+        self.existing = list()
+        self.runmetadata = MetadataObject()
+        self.runmetadata.samples = list()
+        for name in names:
+            sample = MetadataObject()
+            sample.name = name
+            sample.general = GenObject()
+            sample.general.bestassemblyfile = os.path.join(path, '{name}.fasta'.format(name=name))
+            with open(sample.general.bestassemblyfile, 'w') as fasta:
+                fasta.write('>{name}\nACGT\n'.format(name=name))
+            self.runmetadata.samples.append(sample)
+        self.ledger = StageLedger(path=os.path.join(path, 'ledger'),
+                                  reffilepath=path,
+                                  version='test')
+
+
+ledgerpath = os.path.join(testpath, 'testdata', 'ledger_test')
+
+
+def test_resume():
+    first = FakePipeline(path=ledgerpath, names=['sample1', 'sample2'])
+    with open(os.path.join(ledgerpath, 'reports', 'other.csv'), 'w') as other:
+        other.write('Strain,Other\nsample1,old\nsample2,old\n')
+    first.typing()
+    assert first.ran == ['sample1', 'sample2']
+    # A new run of the same folder only needs to run the sample that was added
+    second = FakePipeline(path=ledgerpath, names=['sample1', 'sample2', 'sample3'])
+    second.typing()
+    assert second.ran == ['sample3']
+    # The stage is told that it is running on a subset of the samples, so it does not re-use the existing reports
+    assert first.subsets == [False] and second.subsets == [True]
+    assert second.existing == [False]
+    # The outputs of the skipped samples are restored from the ledger
+    assert second.runmetadata.samples[0].typing.result == 'sample1_result'
+    with open(os.path.join(ledgerpath, 'reports', 'typing.csv'), 'r') as report:
+        lines = report.readlines()
+    assert lines[0] == 'Strain,Result\n'
+    assert sorted(line.split(',')[0] for line in lines[1:]) == ['sample1', 'sample2', 'sample3']
+    # The report of another stage is not merged with its previous contents
+    with open(os.path.join(ledgerpath, 'reports', 'other.csv'), 'r') as other:
+        assert other.readlines() == ['Strain,Other\n', 'sample1,new\n']
+
+
+def test_unmergeable_report():
+    first = FakePipeline(path=ledgerpath, names=['sample1', 'sample2'])
+    first.workbook()
+    second = FakePipeline(path=ledgerpath, names=['sample1', 'sample2', 'sample3'])
+    second.workbook()
+    # The workbook cannot be merged, so the stage is run on every sample rather than only on the new sample
+    assert second.ran == ['sample1', 'sample2', 'sample3']
+    with open(os.path.join(ledgerpath, 'reports', 'workbook.xlsx'), 'r') as report:
+        assert report.read().split() == ['sample1', 'sample2', 'sample3']
+    # Once every sample is complete, the stage is skipped
+    third = FakePipeline(path=ledgerpath, names=['sample1', 'sample2', 'sample3'])
+    third.workbook()
+    assert third.ran == []
+    assert third.runmetadata.samples[2].workbook.result == 'sample3'
+
+
+def test_failed_subset():
+    first = FakePipeline(path=ledgerpath, names=['sample1', 'sample2', 'sample3'])
+    first.typing()
+    with open(os.path.join(ledgerpath, 'reports', 'typing.csv'), 'r') as report:
+        lines = report.readlines()
+
+    def fail(pipeline):
+        raise RuntimeError('stage failed')
+    fail.__name__ = 'typing'
+    second = FakePipeline(path=ledgerpath, names=['sample1', 'sample2', 'sample4'])
+    try:
+        second.ledger.run(pipeline=second, method=fail)
+        raised = False
+    except RuntimeError:
+        raised = True
+    assert raised
+    # The existing report is restored when the stage fails
+    with open(os.path.join(ledgerpath, 'reports', 'typing.csv'), 'r') as report:
+        assert report.readlines() == lines
+
+
+def test_changed_input():
+    pipeline = FakePipeline(path=ledgerpath, names=['sample1', 'sample2', 'sample3'])
+    with open(os.path.join(ledgerpath, 'sample2.fasta'), 'w') as fasta:
+        fasta.write('>sample2\nTTTT\n')
+    pipeline.typing()
+    assert pipeline.ran == ['sample2']
+
+
+def test_changed_parameter():
+    pipeline = FakePipeline(path=ledgerpath, names=['sample1', 'sample2', 'sample3'], cutoff=80)
+    pipeline.typing()
+    # A different parameter requires every sample to be run again
+    assert pipeline.ran == ['sample1', 'sample2', 'sample3']
+
+
+def test_merge_report():
+    report = os.path.join(ledgerpath, 'reports', 'resfinder.csv')
+    previous = ['Strain,Resistance,Gene\n', 'a,Aminoglycoside,aph\n', ',Tetracycline,tetA\n', 'b,Beta-lactam,blaTEM\n',
+                ',Tetracycline,tetA\n']
+    with open(report, 'w') as report_file:
+        report_file.write('Strain,Resistance,Gene\na,Aminoglycoside,aph2\n')
+    merge_report(report, previous, {'a'})
+    with open(report, 'r') as report_file:
+        # The additional row of the re-run sample is replaced, and the additional row of the other sample is retained
+        assert report_file.readlines() == ['Strain,Resistance,Gene\n', 'b,Beta-lactam,blaTEM\n', ',Tetracycline,tetA\n',
+                                           'a,Aminoglycoside,aph2\n']
+
+
+def test_clear_ledger():
+    shutil.rmtree(ledgerpath)
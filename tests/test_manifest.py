@@ -0,0 +1,201 @@
+#!/usr/bin/env python 3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cowbat.get.manifest import Manifest
+from cowbat.get.get_mlst import LocusFetcher
+from cowbat.get import get_mlst
+from argparse import Namespace
+from threading import Thread
+import requests
+import hashlib
+import shutil
+import json
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+manifestpath = os.path.join(testpath, 'testdata', 'manifest_test')
+__author__ = 'adamkoziol'
+
+# Contents of the files served by the test server, and the status codes of the responses
+served = dict()
+statuses = list()
+# Number of times each path fails before it is served
+failures = dict()
+
+
+class SchemeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if failures.get(self.path):
+            failures[self.path] -= 1
+            self.reply(503, str(), b'')
+            return
+        body = served[self.path]
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.reply(304, etag, b'')
+        elif self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.reply(206, etag, body[start:])
+        else:
+            self.reply(200, etag, body)
+
+    def reply(self, status, etag, body):
+        statuses.append(status)
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SchemeHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{port}'.format(port=server.server_port)
+
+
+def test_conditional_download():
+    server, address = start_server()
+    os.makedirs(manifestpath, exist_ok=True)
+    served['/abcZ.tfa'] = b'>abcZ_1\nACGT\n'
+    path = os.path.join(manifestpath, 'abcZ.tfa')
+    manifest = Manifest(manifestpath)
+    with requests.Session() as session:
+        assert manifest.download(session, address + '/abcZ.tfa', path)
+        # The server reports that the file is unchanged
+        assert not manifest.download(session, address + '/abcZ.tfa', path)
+        assert statuses[-1] == 304
+        served['/abcZ.tfa'] = b'>abcZ_1\nACGT\n>abcZ_2\nACGA\n'
+        assert manifest.download(session, address + '/abcZ.tfa', path)
+    manifest.write()
+    server.shutdown()
+    with open(path, 'rb') as allele:
+        assert allele.read() == served['/abcZ.tfa']
+    with open(os.path.join(manifestpath, 'manifest.json'), 'r') as manifest_file:
+        entry = json.load(manifest_file)['abcZ.tfa']
+    assert entry['size'] == len(served['/abcZ.tfa'])
+    assert entry['sha256'] == hashlib.sha256(served['/abcZ.tfa']).hexdigest()
+    assert entry['etag'] and entry['retrieved']
+
+
+def test_resume_download():
+    server, address = start_server()
+    served['/adk.tfa'] = b'>adk_1\n' + b'ACGT' * 1000 + b'\n'
+    path = os.path.join(manifestpath, 'adk.tfa')
+    # An interrupted download of the current version of the file
+    with open(path + '.part', 'wb') as partial:
+        partial.write(served['/adk.tfa'][:1000])
+    with open(path + '.part.json', 'w') as partial_info:
+        json.dump({'url': address + '/adk.tfa',
+                   'validator': '"{}"'.format(hashlib.md5(served['/adk.tfa']).hexdigest())}, partial_info)
+    manifest = Manifest(manifestpath)
+    with requests.Session() as session:
+        assert manifest.download(session, address + '/adk.tfa', path)
+    server.shutdown()
+    assert statuses[-1] == 206
+    with open(path, 'rb') as allele:
+        assert allele.read() == served['/adk.tfa']
+    assert not os.path.isfile(path + '.part')
+
+
+def test_refresh_scheme():
+    server, address = start_server()
+    served['/dbases.xml'] = '''<data><species>Listeria monocytogenes<mlst><database>
+<url>{address}/listeria</url><retrieved>2026-10-01</retrieved>
+<profiles><count>2</count><url>{address}/profiles.txt</url></profiles>
+<loci><locus>abcZ<url>{address}/abcZ.tfa</url></locus><locus>bglA<url>{address}/bglA.tfa</url></locus></loci>
+</database></mlst></species></data>'''.format(address=address).encode()
+    served['/profiles.txt'] = b'ST\tabcZ\tbglA\n1\t1\t1\n'
+    served['/abcZ.tfa'] = b'>abcZ_1\nACGT\n'
+    served['/bglA.tfa'] = b'>bglA_1\nTTGA\n'
+    schemepath = os.path.join(manifestpath, 'scheme')
+    args = Namespace(repository_url=address + '/dbases.xml',
+                     genus='Listeria',
+                     force_scheme_name=False,
+                     path=schemepath)
+    get_mlst.main(args)
+    with open(os.path.join(schemepath, 'Listeria_monocytogenes.fasta'), 'r') as combined:
+        assert combined.read() == '>abcZ_1\nACGT\n>bglA_1\nTTGA\n'
+    # Only the changed locus is downloaded by the refresh, and the cached index is re-used
+    del statuses[:]
+    served['/bglA.tfa'] = b'>bglA_1\nTTGA\n>bglA_2\nTTGG\n'
+    get_mlst.main(args)
+    server.shutdown()
+    assert statuses.count(200) == 1 and statuses.count(304) == 2
+    with open(os.path.join(schemepath, 'Listeria_monocytogenes.fasta'), 'r') as combined:
+        assert combined.read() == '>abcZ_1\nACGT\n>bglA_1\nTTGA\n>bglA_2\nTTGG\n'
+
+
+def test_locus_fetcher():
+    server, address = start_server()
+    fetcherpath = os.path.join(manifestpath, 'fetcher')
+    os.makedirs(fetcherpath, exist_ok=True)
+    loci = list()
+    for num in range(12):
+        served['/locus{num}.tfa'.format(num=num)] = '>locus{num}_1\n{seq}\n'.format(num=num,
+                                                                                  seq='ACGT' * num).encode()
+        loci.append((address + '/locus{num}.tfa'.format(num=num),
+                     os.path.join(fetcherpath, 'locus{num}.tfa'.format(num=num))))
+    # The first loci fail before they are downloaded, so they finish after the loci that follow them
+    failures['/locus0.tfa'] = 1
+    failures['/locus1.tfa'] = 1
+    combined = os.path.join(fetcherpath, 'combined.fasta')
+    fetcher = LocusFetcher(loci=loci,
+                           combined=combined,
+                           manifest=Manifest(fetcherpath),
+                           threads=4,
+                           retries=2)
+    assert fetcher.main()
+    server.shutdown()
+    with open(combined, 'rb') as combined_file:
+        assert combined_file.read() == b''.join(served['/locus{num}.tfa'.format(num=num)] for num in range(12))
+
+
+def test_sync():
+    server, address = start_server()
+    served['/dbases.xml'] = '''<data>
+<species>Listeria monocytogenes<mlst><database><url>{address}/listeria</url><retrieved>2026-10-01</retrieved>
+<profiles><count>1</count><url>{address}/lmo/profiles.txt</url></profiles>
+<loci><locus>abcZ<url>{address}/lmo/abcZ.tfa</url></locus></loci></database></mlst></species>
+<species>Escherichia coli#1<mlst><database><url>{address}/ecoli</url><retrieved>2026-10-02</retrieved>
+<profiles><count>1</count><url>{address}/eco/profiles.txt</url></profiles>
+<loci><locus>adk<url>{address}/eco/adk.tfa</url></locus><locus>fumC<url>{address}/eco/fumC.tfa</url></locus></loci>
+</database></mlst></species>
+<species>Escherichia coli#2<mlst><database><url>{address}/ecoli2</url><retrieved>2026-10-02</retrieved>
+<profiles><count>1</count><url>{address}/eco2/profiles.txt</url></profiles>
+<loci><locus>dinB<url>{address}/eco2/dinB.tfa</url></locus></loci></database></mlst></species>
+</data>'''.format(address=address).encode()
+    for path, content in [('/lmo/profiles.txt', b'ST\tabcZ\n1\t1\n'), ('/lmo/abcZ.tfa', b'>abcZ_1\nACGT\n'),
+                          ('/eco/profiles.txt', b'ST\tadk\tfumC\n1\t1\t1\n'), ('/eco/adk.tfa', b'>adk_1\nAAAA\n'),
+                          ('/eco/fumC.tfa', b'>fumC_1\nCCCC\n')]:
+        served[path] = content
+    syncpath = os.path.join(manifestpath, 'sync')
+    args = Namespace(repository_url=address + '/dbases.xml',
+                     genera=['Listeria', 'Shigella', 'Vibrio'],
+                     force_scheme_name=False,
+                     path=syncpath,
+                     threads=2,
+                     retries=0,
+                     timeout=10,
+                     schemes=2,
+                     index_age=24)
+    del statuses[:]
+    # Vibrio is not in the index
+    assert get_mlst.sync(args) == ['Vibrio']
+    server.shutdown()
+    # The index is only downloaded once for all the genera
+    assert len(statuses) == 6
+    with open(os.path.join(syncpath, 'Shigella', 'Escherichia_coli#1.fasta'), 'r') as combined:
+        assert combined.read() == '>adk_1\nAAAA\n>fumC_1\nCCCC\n'
+    assert os.path.isfile(os.path.join(syncpath, 'Listeria', 'Listeria_monocytogenes.fasta'))
+    assert os.path.isfile(os.path.join(syncpath, 'dbases.xml'))
+
+
+def test_clear_manifest():
+    shutil.rmtree(manifestpath)
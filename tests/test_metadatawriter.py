@@ -0,0 +1,55 @@
+#!/usr/bin/env python 3
+from olctools.accessoryFunctions.accessoryFunctions import MetadataObject, GenObject
+from cowbat.pipelinetools.metadatawriter import MetadataWriter
+import shutil
+import json
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+outputpath = os.path.join(testpath, 'testdata', 'metadatawriter_test')
+__author__ = 'adamkoziol'
+
+
+def sample_init(name):
+    sample = MetadataObject()
+    sample.name = name
+    sample.general = GenObject()
+    sample.general.outputdirectory = os.path.join(outputpath, name)
+    os.makedirs(sample.general.outputdirectory, exist_ok=True)
+    return sample
+
+
+def jsonfile(sample):
+    return os.path.join(sample.general.outputdirectory, '{sn}_metadata.json'.format(sn=sample.name))
+
+
+def test_debounce():
+    sample = sample_init('sample1')
+    writer = MetadataWriter(interval=3600)
+    writer.write(samples=[sample])
+    # The first write is never postponed
+    assert os.path.isfile(jsonfile(sample))
+    sample.general.referencegenus = 'Escherichia'
+    writer.write(samples=[sample])
+    with open(jsonfile(sample), 'r') as metadata:
+        assert 'referencegenus' not in json.load(metadata)['general']
+    writer.write(samples=[sample], force=True)
+    with open(jsonfile(sample), 'r') as metadata:
+        assert json.load(metadata)['general']['referencegenus'] == 'Escherichia'
+
+
+def test_unchanged():
+    first = sample_init('sample2')
+    second = sample_init('sample3')
+    writer = MetadataWriter()
+    writer.write(samples=[first, second])
+    mtime = os.path.getmtime(jsonfile(first))
+    os.remove(jsonfile(second))
+    writer.write(samples=[first, second])
+    # Only the missing file is written again
+    assert os.path.getmtime(jsonfile(first)) == mtime
+    assert os.path.isfile(jsonfile(second))
+
+
+def test_clear_metadatawriter():
+    shutil.rmtree(outputpath)
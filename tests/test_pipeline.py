@@ -292,6 +292,10 @@ def test_clear_reports():
     shutil.rmtree(os.path.join(var.sequencepath, 'reports'))
 
 
+def test_clear_ledger():
+    shutil.rmtree(os.path.join(var.sequencepath, 'ledger'))
+
+
 def test_clear_assemblies():
     shutil.rmtree(os.path.join(var.sequencepath, 'BestAssemblies'))
 
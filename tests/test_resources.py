@@ -0,0 +1,55 @@
+#!/usr/bin/env python 3
+from cowbat.pipelinetools.resources import ResourceManager
+from threading import Thread
+import time
+
+__author__ = 'adamkoziol'
+
+
+def test_admission():
+    manager = ResourceManager(cores=4,
+                              memory=8 * 1024 ** 3,
+                              interval=0.1)
+    first = manager.try_acquire(name='skesa',
+                                cores=2,
+                                memory=6 * 1024 ** 3)
+    assert first is not None
+    # The memory of a second reservation does not fit in the capacity that remains
+    assert manager.try_acquire(name='clark',
+                               cores=1,
+                               memory=4 * 1024 ** 3) is None
+    # The cores of a reservation without memory still have to fit
+    assert manager.try_acquire(name='mash',
+                               cores=3) is None
+    second = manager.try_acquire(name='mash',
+                                 cores=2)
+    assert second is not None
+    manager.release(first)
+    manager.release(second)
+    assert manager.reserved_cores == 0 and manager.reserved_memory == 0
+
+
+def test_oversize():
+    manager = ResourceManager(cores=2,
+                              memory=1024 ** 3)
+    # A request larger than the capacity is admitted when nothing else is reserved
+    with manager.reserve(name='full', cores=8, memory=64 * 1024 ** 3) as reservation:
+        assert reservation == ('full', 2, 1024 ** 3)
+
+
+def test_wait():
+    manager = ResourceManager(cores=1,
+                              interval=0.1)
+    started = list()
+
+    def job(name):
+        with manager.reserve(name=name, cores=1):
+            started.append((name, time.time()))
+            time.sleep(0.2)
+    threads = [Thread(target=job, args=(name,)) for name in ['first', 'second']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The second job waits for the core of the first job to be released
+    assert abs(started[1][1] - started[0][1]) >= 0.2
@@ -0,0 +1,84 @@
+#!/usr/bin/env python 3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cowbat.get.rest_auth_class import REST, RateLimit
+from argparse import Namespace
+from threading import Lock, Thread
+import shutil
+import time
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+restpath = os.path.join(testpath, 'testdata', 'rest_test')
+__author__ = 'adamkoziol'
+
+# Client ports of the connections made to the test server
+connections = set()
+connection_lock = Lock()
+
+
+class AlleleHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with connection_lock:
+            connections.add(self.client_address[1])
+        locus = self.path.split('/')[-2]
+        body = '>{locus}_1\n{sequence}\n'.format(locus=locus,
+                                                 sequence='ACGT' * 50).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_download_loci():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), AlleleHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    os.makedirs(restpath, exist_ok=True)
+    rest = REST(Namespace(secret_file=str(),
+                          file_path=restpath,
+                          output_path=restpath,
+                          start=time.time(),
+                          threads=3,
+                          rate=0))
+    rest.loci_url = ['http://127.0.0.1:{port}/loci/BACT{num:06d}'.format(port=server.server_port,
+                                                                         num=num)
+                     for num in range(30)]
+    rest.download_loci()
+    assert not rest.failed
+    assert len(rest.changed) == 30
+    assert len([allele for allele in os.listdir(restpath) if allele.endswith('.tfa')]) == 30
+    # Files that the server sends again without changes are not rewritten
+    refresh = REST(Namespace(secret_file=str(),
+                             file_path=restpath,
+                             output_path=restpath,
+                             start=time.time(),
+                             threads=3,
+                             rate=0))
+    refresh.loci_url = rest.loci_url
+    refresh.download_loci()
+    server.shutdown()
+    assert not refresh.failed and not refresh.changed
+    with open(os.path.join(restpath, 'BACT000007.tfa'), 'r') as allele:
+        assert allele.readline() == '>BACT000007_1\n'
+    # Each thread re-uses its connection rather than connecting for each file
+    assert len(connections) <= 6
+
+
+def test_rate_limit():
+    limit = RateLimit(rate=50)
+    started = time.monotonic()
+    for _ in range(11):
+        limit.wait()
+    assert time.monotonic() - started >= 0.19
+
+
+def test_clear_rest():
+    shutil.rmtree(restpath)
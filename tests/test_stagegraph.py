@@ -0,0 +1,137 @@
+#!/usr/bin/env python 3
+from cowbat.pipelinetools.stagegraph import StageGraph
+from threading import Lock
+from queue import Queue
+import time
+
+__author__ = 'adamkoziol'
+
+
+class FakePipeline(object):
+
+    def stage(self, name):
+        with self.lock:
+            self.started.append((name, self.cpus))
+            self.counts['active'] += 1
+            self.counts['max'] = max(self.counts['max'], self.counts['active'])
+        time.sleep(0.05)
+        with self.lock:
+            self.counts['active'] -= 1
+
+    def assemble(self):
+        self.stage('assemble')
+
+    def mash(self):
+        self.stage('mash')
+
+    def prophages(self):
+        self.stage('prophages')
+
+    def mlst(self):
+        self.stage('mlst')
+
+    def report(self):
+        self.stage('report')
+
+    def quality_trim(self):
+        with self.lock:
+            quality = self.qualityobject
+            self.quality.append((quality.cpus, quality.threads, quality.qcqueue.maxsize, quality.correctqueue.maxsize))
+
+    def __init__(self, cpus):
+        self.cpus = cpus
+        self.lock = Lock()
+        self.started = list()
+        # Shared between the copies of the pipeline that the stages are run on
+        self.counts = {'active': 0, 'max': 0}
+        self.quality = list()
+
+
+class FakeQuality(object):
+
+    def __init__(self, cpus, samples):
+        # Sized from the entire CPU budget, as genemethods' Quality object is
+        self.metadata = list(range(samples))
+        self.cpus = cpus
+        self.threads = max(1, int(cpus / samples))
+        self.qcqueue = Queue(maxsize=cpus)
+        self.correctqueue = Queue(maxsize=cpus)
+
+
+def graph_init(cpus):
+    graph = StageGraph(cpus=cpus)
+    graph.add(name='assemble',
+              writes=['general.bestassemblyfile'])
+    graph.add(name='mash',
+              reads=['general.bestassemblyfile'],
+              writes=['mash', 'general.referencegenus'],
+              cores=2)
+    graph.add(name='prophages',
+              reads=['general.bestassemblyfile'],
+              writes=['prophages'],
+              cores=2)
+    graph.add(name='mlst',
+              reads=['general.bestassemblyfile', 'general.referencegenus'],
+              writes=['mlst'],
+              cores=2)
+    graph.add(name='report',
+              reads=['general', 'mash', 'prophages', 'mlst'],
+              writes=['reports'])
+    return graph
+
+
+def test_dependencies():
+    graph = graph_init(cpus=8)
+    dependencies = {stage.name: stage.dependencies for stage in graph.stages}
+    assert dependencies['mash'] == {'assemble'}
+    assert dependencies['prophages'] == {'assemble'}
+    assert dependencies['mlst'] == {'assemble', 'mash'}
+    assert dependencies['report'] == {'assemble', 'mash', 'prophages', 'mlst'}
+
+
+def test_concurrent_stages():
+    pipeline = FakePipeline(cpus=8)
+    graph_init(cpus=8).run(pipeline=pipeline)
+    started = [name for name, cpus in pipeline.started]
+    assert started[0] == 'assemble'
+    assert started[-1] == 'report'
+    assert started.index('mlst') > started.index('mash')
+    assert pipeline.counts['max'] == 2
+    # Stages sharing the node are run with their allotted cores, without changing the pipeline
+    assert dict(pipeline.started)['prophages'] == 2
+    assert pipeline.cpus == 8
+
+
+def test_budget():
+    pipeline = FakePipeline(cpus=2)
+    graph_init(cpus=2).run(pipeline=pipeline)
+    assert pipeline.counts['max'] == 1
+
+
+def test_failure():
+    graph = StageGraph(cpus=4)
+    graph.add(name='missing')
+    try:
+        graph.run(pipeline=FakePipeline(cpus=4))
+        raised = False
+    except AttributeError:
+        raised = True
+    assert raised
+
+
+def test_quality_cores():
+    pipeline = FakePipeline(cpus=8)
+    pipeline.qualityobject = FakeQuality(cpus=8, samples=2)
+    graph = StageGraph(cpus=8)
+    graph.add(name='quality_trim',
+              reads=['qualityobject'],
+              writes=['general.trimmedfastqfiles'],
+              cores=6)
+    graph.add(name='mash',
+              writes=['mash'],
+              cores=2)
+    graph.run(pipeline=pipeline)
+    # The stage sees a quality object restricted to its allotted cores, and the pipeline's object is unchanged
+    assert pipeline.quality == [(6, 3, 6, 6)]
+    assert pipeline.qualityobject.cpus == 8
+    assert pipeline.qualityobject.qcqueue.maxsize == 8
@@ -0,0 +1,96 @@
+#!/usr/bin/env python 3
+from olctools.accessoryFunctions.accessoryFunctions import MetadataObject
+from cowbat.pipelinetools.stagetimer import StageTimer, command_samples, process_tree_rss
+from cowbat.pipelinetools.ledger import checkpoint
+import subprocess
+import shutil
+import json
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+timertestpath = os.path.join(testpath, 'testdata', 'stagetimer_test')
+__author__ = 'adamkoziol'
+
+
+class Pipeline(object):
+
+    @checkpoint
+    def external(self):
+        subprocess.call('sleep 0.2', shell=True)
+
+    @checkpoint
+    def batch(self):
+        # One command for each sample, and one command that processes every sample at once
+        for sample in self.runmetadata.samples:
+            subprocess.call(['sh', '-c', 'sleep 0.3', '{name}.fasta'.format(name=sample.name)])
+        subprocess.call(['sh', '-c', 'sleep 0.3', 'sample1_R1.fastq', 'sample2_R1.fastq'])
+
+    def __init__(self, names):
+        self.timer = StageTimer(interval=0.05,
+                                trace=True)
+        self.runmetadata = MetadataObject()
+        self.runmetadata.samples = list()
+        for name in names:
+            sample = MetadataObject()
+            sample.name = name
+            self.runmetadata.samples.append(sample)
+
+
+def test_process_tree_rss():
+    assert process_tree_rss(os.getpid()) > 0
+
+
+def test_measure():
+    pipeline = Pipeline(names=['sample1', 'sample2'])
+    pipeline.external()
+    # Stages run on a single sample are recorded against that sample
+    pipeline.runmetadata.samples = pipeline.runmetadata.samples[:1]
+    pipeline.external()
+    pipeline.timer.write(reportpath=timertestpath)
+    pipeline.timer.summary()
+    with open(os.path.join(timertestpath, 'pipeline_timing.csv'), 'r') as timing:
+        rows = [line.split(',') for line in timing.read().splitlines()]
+    assert rows[0][:3] == ['Stage', 'Sample', 'Samples']
+    assert [row[:3] for row in rows[1:]] == [['external', 'all', '2'], ['external', 'sample1', '1']]
+    assert float(rows[1][3]) >= 0.2
+    with open(os.path.join(timertestpath, 'pipeline_timing.json'), 'r') as trace:
+        measurements = json.load(trace)
+    assert measurements[0]['end'] > measurements[0]['start']
+    assert measurements[0]['peak_rss'] > 0
+
+
+def test_trace():
+    with open(os.path.join(timertestpath, 'pipeline_trace.json'), 'r') as trace:
+        events = json.load(trace)['traceEvents']
+    stages = [event['name'] for event in events if event.get('cat') == 'stage']
+    assert stages == ['external', 'external (sample1)']
+    # The external commands are shown on their own lanes
+    assert 'sleep' in [event['name'] for event in events if event.get('cat') == 'command']
+
+
+def test_command_samples():
+    names = {'sample1', 'sample10'}
+    assert command_samples('blastn -query /path/sample1/sample1.fasta -db rmlst', names) == {'sample1'}
+    assert command_samples('bbduk.sh in=sample10_R1.fastq.gz', names) == {'sample10'}
+    assert command_samples('mash sketch sample2.fasta', names) == set()
+
+
+def test_batch_samples():
+    pipeline = Pipeline(names=['sample1', 'sample2'])
+    pipeline.batch()
+    measurements = pipeline.timer.measurements
+    assert [(measurement['sample'], measurement['attributed']) for measurement in measurements] == \
+        [('all', False), ('sample1', True), ('sample2', True)]
+    # The command that processes both samples is only included in the measurement of the whole stage
+    assert measurements[0]['wall'] >= 0.9
+    for measurement in measurements[1:]:
+        assert measurement['commands'] == 1
+        assert 0.2 <= measurement['wall'] < 0.6
+    pipeline.timer.write(reportpath=timertestpath)
+    with open(os.path.join(timertestpath, 'pipeline_timing.csv'), 'r') as timing:
+        rows = [line.split(',') for line in timing.read().splitlines()]
+    assert [row[-1] for row in rows] == ['Source', 'stage', 'commands', 'commands']
+
+
+def test_clear_stagetimer():
+    shutil.rmtree(timertestpath)
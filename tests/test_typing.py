@@ -0,0 +1,83 @@
+#!/usr/bin/env python 3
+from cowbat.assembly_typing import Typing
+from time import time
+import shutil
+import os
+
+testpath = os.path.abspath(os.path.dirname(__file__))
+typingtestpath = os.path.join(testpath, 'testdata', 'typing_test')
+__author__ = 'adamkoziol'
+
+
+def typing_run(names):
+    """
+    Create a sequence folder with an assembly for each sample, and restrict the samples to the changed assemblies
+    """
+    os.makedirs(os.path.join(typingtestpath, 'reports'), exist_ok=True)
+    for name, sequence in names.items():
+        with open(os.path.join(typingtestpath, '{name}.fasta'.format(name=name)), 'w') as assembly:
+            assembly.write('>contig\n{sequence}\n'.format(sequence=sequence))
+    typing = Typing(start=time(),
+                    sequencepath=typingtestpath,
+                    referencefilepath=testpath,
+                    scriptpath=testpath,
+                    debug=False,
+                    incremental=True)
+    typing.objects()
+    typing.changed_assemblies()
+    return typing
+
+
+def write_report(typing):
+    with open(os.path.join(typing.reportpath, 'mlst.csv'), 'w') as report:
+        report.write('Strain,SequenceType\n')
+        for sample in typing.runmetadata.samples:
+            report.write('{name},{st}\n'.format(name=sample.name,
+                                                st=len(sample.name)))
+
+
+def test_incremental():
+    first = typing_run({'a': 'ACGT', 'bb': 'ACGT'})
+    assert [sample.name for sample in first.runmetadata.samples] == ['a', 'bb']
+    write_report(first)
+    first.merge_reports()
+    first.record_assemblies()
+    # Only the new and the modified assemblies are typed in the second run
+    second = typing_run({'a': 'ACGT', 'bb': 'TTTT', 'ccc': 'ACGT'})
+    assert [sample.name for sample in second.runmetadata.samples] == ['bb', 'ccc']
+    write_report(second)
+    second.merge_reports()
+    with open(os.path.join(second.reportpath, 'mlst.csv'), 'r') as report:
+        assert report.read() == 'Strain,SequenceType\na,1\nbb,2\nccc,3\n'
+
+
+def write_resistance_report(typing):
+    # Samples with several results have a row for each result, and only the first row has the sample name
+    with open(os.path.join(typing.reportpath, 'resfinder.csv'), 'w') as report:
+        report.write('Strain,Resistance,Gene\n')
+        for sample in typing.runmetadata.samples:
+            with open(sample.general.bestassemblyfile, 'r') as assembly:
+                sequence = assembly.read().split()[-1]
+            report.write('{name},Aminoglycoside,aph_{sequence}\n,Tetracycline,tetA_{sequence}\n'
+                         .format(name=sample.name,
+                                 sequence=sequence))
+
+
+def test_incremental_multiple_rows():
+    shutil.rmtree(typingtestpath)
+    first = typing_run({'a': 'ACGT', 'bb': 'ACGT'})
+    write_resistance_report(first)
+    first.merge_reports()
+    first.record_assemblies()
+    second = typing_run({'a': 'TTTT', 'bb': 'ACGT'})
+    assert [sample.name for sample in second.runmetadata.samples] == ['a']
+    write_resistance_report(second)
+    second.merge_reports()
+    with open(os.path.join(second.reportpath, 'resfinder.csv'), 'r') as report:
+        assert report.read() == 'Strain,Resistance,Gene\n' \
+                                'bb,Aminoglycoside,aph_ACGT\n,Tetracycline,tetA_ACGT\n' \
+                                'a,Aminoglycoside,aph_TTTT\n,Tetracycline,tetA_TTTT\n'
+
+
+def test_clear_typing():
+    shutil.rmtree(typingtestpath)